@@ -14,3 +14,23 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings
+
+if settings.WARMUP_ON_START:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from django.db import connections
+
+    from api.warmup import warm_up
+
+    def _warm_up_in_thread():
+        # servers may import this module inside their event loop, where Django
+        # refuses database access
+        try:
+            warm_up()
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(_warm_up_in_thread).result()
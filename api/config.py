@@ -15,6 +15,25 @@ class EnvSettings(BaseSettings):
     DB_PASSWORD: str = "postgres"
     DB_HOST: str = "localhost"
     DB_PORT: str = "5432"
+    # seconds to keep connections open between requests, 0 closes them after each
+    DB_CONN_MAX_AGE: int = 0
+    # region -> database name (same server and credentials) for rides sharded by
+    # region, e.g. {"us_east": "rides_us_east"}; unlisted regions stay in DB_NAME
+    RIDE_SHARD_DATABASES: dict[str, str] = {}
+    # cache shared by every worker, Redis (redis://...) or memcached
+    # (host:port); one of them is required unless DEBUG
+    REDIS_URL: str = ""
+    MEMCACHED_LOCATION: str = ""
+    # run the ride list as prepared statements, see rides.prepared
+    DB_PREPARED_STATEMENTS: bool = False
+
+    # run api.warmup before the worker serves requests
+    WARMUP_ON_START: bool = False
+    # log requests whose peak RSS rises this many MB, 0 is off; see api.memory
+    MEMORY_RSS_LOG_MB: int = 0
+    # where on-demand request profiles are kept, see api.profiling; defaults to
+    # a directory in the system's temp dir
+    REQUEST_PROFILE_DIR: str = ""
 
     model_config = SettingsConfigDict(
         env_file=".env", env_file_encoding="utf-8", extra="ignore"
@@ -0,0 +1,248 @@
+"""
+Memory instrumentation for large responses.
+
+`MemoryProfile` traces allocations with `tracemalloc` through the phases of one
+request (see `RideViewSet.list()` and `?memory_profile=1`): each `mark()` takes a
+snapshot and records what the phase since the previous mark left allocated, its
+top allocating lines and the traced peak while it ran. Finished reports go to
+the cache, the latest `MEMORY_PROFILE_MAX_REPORTS` are kept.
+
+Tracing is process-wide, so only one request per process is profiled at a time
+and allocations of other threads in the meantime are counted too.
+
+Resident set sizes come from `/proc/self/status` (Linux). Writing "5" to
+`/proc/self/clear_refs` resets the peak (VmHWM), which makes it per request;
+`PeakRSSMiddleware` logs the requests whose peak goes well above the RSS they
+started with. With several requests per process (threads) they reset each
+other's peaks.
+"""
+
+import logging
+import threading
+import time
+import tracemalloc
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+
+logger = logging.getLogger(__name__)
+
+MEMORY_PROFILE_MAX_REPORTS = 50
+MEMORY_PROFILE_TIMEOUT = 60 * 60 * 24
+# allocating lines listed per phase
+MEMORY_PROFILE_TOP = 15
+MEMORY_PROFILE_INDEX_KEY = "memory_profiles:index"
+
+# held by the request being profiled
+_profile_lock = threading.Lock()
+
+# allocations of the profiler itself
+_IGNORED = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def rss_kib() -> tuple[int, int] | None:
+    """
+    (current, peak) resident set size of this process in KiB, None where
+    /proc isn't available.
+    """
+    values = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, value = line.split(":")
+                    values[name] = int(value.split()[0])
+    except OSError:
+        return None
+    if len(values) != 2:
+        return None
+    return values["VmRSS"], values["VmHWM"]
+
+
+def reset_peak_rss() -> bool:
+    """
+    Start the peak RSS over at the current RSS, False where that isn't
+    supported.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def memory_profile_key(id_profile: str) -> str:
+    return f"memory_profiles:{id_profile}"
+
+
+def _kib(size: int) -> float:
+    return round(size / 1024, 1)
+
+
+class MemoryProfile:
+    """
+    One request's allocations by phase, from `start()` to `finish()`.
+    """
+
+    def __init__(self, request):
+        self.id = uuid.uuid4().hex
+        self.path = request.get_full_path()
+        self.phases = []
+        self.snapshot = None
+        self.started = None
+        self.owns_tracing = False
+
+    @classmethod
+    def start(cls, request) -> "MemoryProfile | None":
+        """
+        Begin profiling `request`, None when another request of this process
+        is being profiled.
+        """
+        if not _profile_lock.acquire(blocking=False):
+            logger.warning("Memory profile of %s skipped, one is running", request)
+            return None
+        profile = cls(request)
+
+        profile.rss_reset = reset_peak_rss()
+        profile.rss_start = rss_kib()
+        profile.owns_tracing = not tracemalloc.is_tracing()
+        if profile.owns_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profile.snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED)
+        profile.started = time.perf_counter()
+        return profile
+
+    def mark(self, phase: str):
+        """
+        End `phase`: what it left allocated and its traced peak.
+        """
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED)
+        stats = snapshot.compare_to(self.snapshot, "lineno")
+        self.phases.append(
+            {
+                "name": phase,
+                "ms": round((time.perf_counter() - self.started) * 1000, 1),
+                "retained_kib": _kib(sum(stat.size_diff for stat in stats)),
+                "peak_kib": _kib(peak),
+                "top": [
+                    {
+                        "location": f"{stat.traceback[0].filename}:"
+                        f"{stat.traceback[0].lineno}",
+                        "size_kib": _kib(stat.size_diff),
+                        "count": stat.count_diff,
+                    }
+                    for stat in sorted(stats, key=lambda s: s.size_diff, reverse=True)[
+                        :MEMORY_PROFILE_TOP
+                    ]
+                    if stat.size_diff > 0
+                ],
+            }
+        )
+        self.snapshot = snapshot
+        self.started = time.perf_counter()
+        tracemalloc.reset_peak()
+
+    def stop(self):
+        if self.snapshot is None:
+            return
+        if self.owns_tracing:
+            tracemalloc.stop()
+        self.snapshot = None
+        _profile_lock.release()
+
+    def finish(self, response) -> dict:
+        """
+        Stop tracing and store the report, returned as well.
+        """
+        self.stop()
+        rss_end = rss_kib()
+        report = {
+            "id": self.id,
+            "created_at": time.time(),
+            "path": self.path,
+            "status": response.status_code,
+            "response_kib": _kib(len(response.content)),
+            # includes tracemalloc's own bookkeeping
+            "rss_kib": {
+                "start": self.rss_start[0] if self.rss_start else None,
+                "peak": rss_end[1] if rss_end and self.rss_reset else None,
+                "end": rss_end[0] if rss_end else None,
+            },
+            "phases": self.phases,
+        }
+        store_report(report)
+        return report
+
+
+def store_report(report: dict):
+    cache.set(memory_profile_key(report["id"]), report, MEMORY_PROFILE_TIMEOUT)
+    # not atomic, a report stored concurrently may drop out of the index
+    index = cache.get(MEMORY_PROFILE_INDEX_KEY, [])
+    index = [report["id"], *index][:MEMORY_PROFILE_MAX_REPORTS]
+    cache.set(MEMORY_PROFILE_INDEX_KEY, index, MEMORY_PROFILE_TIMEOUT)
+
+
+def get_report(id_profile: str) -> dict | None:
+    return cache.get(memory_profile_key(id_profile))
+
+
+def list_reports() -> list[dict]:
+    """
+    The stored reports' summaries, newest first.
+    """
+    index = cache.get(MEMORY_PROFILE_INDEX_KEY, [])
+    reports = cache.get_many([memory_profile_key(id_profile) for id_profile in index])
+    summaries = []
+    for id_profile in index:
+        if report := reports.get(memory_profile_key(id_profile)):
+            summaries.append(
+                {
+                    **{name: report[name] for name in ("id", "created_at", "path")},
+                    "peak_rss_kib": report["rss_kib"]["peak"],
+                    "peak_traced_kib": max(
+                        (phase["peak_kib"] for phase in report["phases"]), default=0
+                    ),
+                }
+            )
+    return summaries
+
+
+class PeakRSSMiddleware:
+    """
+    Logs requests whose peak RSS rises `MEMORY_RSS_LOG_MB` or more above the
+    RSS they started with. Not used when that's 0 or /proc isn't available.
+    """
+
+    def __init__(self, get_response):
+        self.threshold_kib = settings.MEMORY_RSS_LOG_MB * 1024
+        if not self.threshold_kib or not reset_peak_rss() or rss_kib() is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reset_peak_rss()
+        start = rss_kib()
+        response = self.get_response(request)
+        end = rss_kib()
+
+        if start and end and end[1] - start[0] >= self.threshold_kib:
+            logger.warning(
+                "%s %s peaked at %d MiB RSS (+%d MiB, %d MiB after)",
+                request.method,
+                request.get_full_path(),
+                end[1] // 1024,
+                (end[1] - start[0]) // 1024,
+                end[0] // 1024,
+            )
+        return response
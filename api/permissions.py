@@ -8,3 +8,21 @@ class IsAdminUser(permissions.BasePermission):
             and request.user.is_authenticated
             and request.user.role == "admin"
         )
+
+
+class IsAdminOrDriverUser(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return (
+            request.user
+            and request.user.is_authenticated
+            and request.user.role in ("admin", "driver")
+        )
+
+
+class IsRiderOrDriverUser(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return (
+            request.user
+            and request.user.is_authenticated
+            and request.user.role in ("rider", "driver")
+        )
@@ -0,0 +1,223 @@
+"""
+On-demand CPU profiles of single requests.
+
+`RequestProfilerMiddleware` profiles a request when it carries either
+`X-Profile-Request` signed for its exact path and query (`sign_request()`, or
+`manage.py sign_profile_request`), or `?profile=1` along with an admin's access
+token. Everything else passes through after a header lookup and a substring
+check of the query string.
+
+A profiled request is sampled: a background thread records the request
+thread's Python stack every `PROFILE_INTERVAL` seconds, so the request runs
+close to full speed (unlike `cProfile`, which hooks every call) and the
+profile comes out as whole stacks. Samples are wall-clock, time spent waiting
+on the database shows up under the frame that waits. Those are stored as
+collapsed stacks (`frame;frame;frame count` per line, root first), which
+flamegraph.pl, speedscope and most other flame graph tools read. The latest
+`PROFILE_MAX_COUNT` profiles are kept in `settings.REQUEST_PROFILE_DIR`, one
+`.folded` file and one `.json` summary each, local to the machine.
+"""
+
+import json
+import logging
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+from django.core import signing
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "HTTP_X_PROFILE_REQUEST"
+PROFILE_FLAG = "profile"
+# seconds a signed header is accepted for
+PROFILE_SIGNATURE_MAX_AGE = 60 * 60
+# a request thread running Python code only yields the GIL to the sampler
+# every `sys.getswitchinterval()` (5ms), sampling more often doesn't add much
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_COUNT = 100
+# samples beyond this many stack frames keep the innermost ones (where the time
+# is spent), under a PROFILE_TRUNCATED_FRAME root
+PROFILE_MAX_DEPTH = 128
+PROFILE_TRUNCATED_FRAME = "(truncated)"
+
+PROFILE_ID_RE = re.compile(r"^\d{13}-[0-9a-f]{8}$")
+
+_signer = signing.TimestampSigner(salt="api.profiling")
+# one profiled request per process at a time
+_profile_lock = threading.Lock()
+
+
+def sign_request(full_path: str) -> str:
+    """
+    The `X-Profile-Request` value that profiles `full_path` (path and query,
+    as the client sends it).
+    """
+    return _signer.sign(full_path)[len(full_path) + 1 :]
+
+
+def _signature_valid(request, signature: str) -> bool:
+    try:
+        _signer.unsign(
+            f"{request.get_full_path()}:{signature}",
+            max_age=PROFILE_SIGNATURE_MAX_AGE,
+        )
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def _requested_by_admin(request) -> bool:
+    # avoid circular import
+    from rest_framework.exceptions import AuthenticationFailed
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+
+    try:
+        authenticated = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return authenticated is not None and authenticated[0].role == "admin"
+
+
+def _frame_name(frame) -> str:
+    # collapsed stacks separate frames with ";" and the count with a space
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{frame.f_code.co_qualname}".replace(";", ":").replace(" ", "_")
+
+
+class Sampler(threading.Thread):
+    """
+    Counts the stacks of thread `ident` until `stop()`.
+    """
+
+    def __init__(self, ident: int, interval: float = PROFILE_INTERVAL):
+        super().__init__(name="request-profiler", daemon=True)
+        self.target_ident = ident
+        self.interval = interval
+        self.stacks = Counter()
+        self.names = {PROFILE_TRUNCATED_FRAME: PROFILE_TRUNCATED_FRAME}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target_ident)
+            # leaf first
+            stack = []
+            while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                stack.append(frame.f_code)
+                if frame.f_code not in self.names:
+                    self.names[frame.f_code] = _frame_name(frame)
+                frame = frame.f_back
+            if frame is not None:
+                stack.append(PROFILE_TRUNCATED_FRAME)
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self) -> dict[str, int]:
+        """
+        {collapsed stack: samples}.
+        """
+        self.stopped.set()
+        self.join()
+        collapsed = Counter()
+        for stack, count in self.stacks.items():
+            collapsed[";".join(self.names[code] for code in stack)] += count
+        return collapsed
+
+
+def _store(summary: dict, stacks: dict[str, int]):
+    directory = Path(settings.REQUEST_PROFILE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / f"{summary['id']}.folded").write_text(
+        "".join(f"{stack} {count}\n" for stack, count in stacks.items())
+    )
+    (directory / f"{summary['id']}.json").write_text(json.dumps(summary))
+
+    # ids start with the time, oldest first
+    for path in sorted(directory.glob("*.json"))[:-PROFILE_MAX_COUNT]:
+        path.unlink(missing_ok=True)
+        path.with_suffix(".folded").unlink(missing_ok=True)
+
+
+def list_profiles() -> list[dict]:
+    """
+    The stored profiles' summaries, newest first.
+    """
+    directory = Path(settings.REQUEST_PROFILE_DIR)
+    summaries = []
+    for path in sorted(directory.glob("*.json"), reverse=True):
+        try:
+            summaries.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            # dropped (or being written) by another process
+            continue
+    return summaries
+
+
+def profile_path(id_profile: str) -> Path | None:
+    """
+    The collapsed stacks file of profile `id_profile`, None if there's none.
+    """
+    if not PROFILE_ID_RE.match(id_profile):
+        return None
+    path = Path(settings.REQUEST_PROFILE_DIR) / f"{id_profile}.folded"
+    return path if path.is_file() else None
+
+
+class RequestProfilerMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not self._triggered(request):
+            return self.get_response(request)
+
+        if not _profile_lock.acquire(blocking=False):
+            logger.warning("Profile of %s skipped, one is running", request)
+            return self.get_response(request)
+        try:
+            return self._profile(request)
+        finally:
+            _profile_lock.release()
+
+    def _triggered(self, request) -> bool:
+        if signature := request.META.get(PROFILE_HEADER):
+            return _signature_valid(request, signature)
+        return (
+            f"{PROFILE_FLAG}=" in request.META.get("QUERY_STRING", "")
+            and request.GET.get(PROFILE_FLAG) in ("1", "true")
+            and _requested_by_admin(request)
+        )
+
+    def _profile(self, request):
+        id_profile = f"{time.time_ns() // 1_000_000}-{secrets.token_hex(4)}"
+        sampler = Sampler(threading.get_ident())
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            stacks = sampler.stop()
+            duration = time.perf_counter() - started
+
+        summary = {
+            "id": id_profile,
+            "created_at": time.time(),
+            "method": request.method,
+            "path": request.get_full_path(),
+            "status": response.status_code,
+            "ms": round(duration * 1000, 1),
+            "samples": sum(stacks.values()),
+        }
+        try:
+            _store(summary, stacks)
+        except OSError:
+            logger.exception("Can't store profile of %s", request)
+            return response
+        response["X-Request-Profile"] = id_profile
+        return response
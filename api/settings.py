@@ -10,11 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import tempfile
 from datetime import timedelta
 from pathlib import Path
 
-from api.config import env
+from django.core.exceptions import ImproperlyConfigured
 
+from api.config import env
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -41,6 +43,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     # Third-party apps
     "rest_framework",
     "rest_framework_simplejwt",
@@ -71,6 +74,8 @@ SIMPLE_JWT = {
 }
 
 MIDDLEWARE = [
+    "api.memory.PeakRSSMiddleware",
+    "api.profiling.RequestProfilerMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -111,9 +116,62 @@ DATABASES = {
         "PASSWORD": env.DB_PASSWORD,
         "HOST": env.DB_HOST,
         "PORT": env.DB_PORT,
+        "CONN_MAX_AGE": env.DB_CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+# region -> database alias, see rides.sharding
+RIDE_SHARDS = {}
+for region, name in env.RIDE_SHARD_DATABASES.items():
+    RIDE_SHARDS[region] = f"rides_{region}"
+    DATABASES[RIDE_SHARDS[region]] = {**DATABASES["default"], "NAME": name}
+
+DATABASE_ROUTERS = ["rides.routers.RideShardRouter"]
+
+# Cached rides, tiles, email lookups etc. are invalidated by whichever worker
+# makes the write, so every worker has to share the cache. A process-local one
+# only does for development and tests (DEBUG), where there's a single process.
+if env.REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": env.REDIS_URL,
+        }
+    }
+elif env.MEMCACHED_LOCATION:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache",
+            "LOCATION": env.MEMCACHED_LOCATION,
+        }
+    }
+elif DEBUG:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            # a ride, tile or user lookup per entry
+            "OPTIONS": {"MAX_ENTRIES": 100_000},
+        }
+    }
+else:
+    raise ImproperlyConfigured(
+        "Set REDIS_URL or MEMCACHED_LOCATION, the workers have to share a cache"
+    )
+
+# see rides.prepared
+RIDE_LIST_PREPARED_STATEMENTS = env.DB_PREPARED_STATEMENTS
+
+WARMUP_ON_START = env.WARMUP_ON_START
+
+# see api.memory.PeakRSSMiddleware
+MEMORY_RSS_LOG_MB = env.MEMORY_RSS_LOG_MB
+
+# see api.profiling
+REQUEST_PROFILE_DIR = Path(
+    env.REQUEST_PROFILE_DIR or Path(tempfile.gettempdir()) / "wingz-request-profiles"
+)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -164,5 +222,10 @@ LOGGING = {
             "handlers": ["console"],
             "level": "DEBUG" if env.DEBUG else "WARNING",
         },
+        # the step timings, once per worker start
+        "api.warmup": {
+            "handlers": ["console"],
+            "level": "INFO",
+        },
     },
 }
@@ -0,0 +1,160 @@
+"""
+Query budgets, SQL shape snapshots and row-scaling checks for API tests.
+
+Snapshots live in `api/tests/snapshots/<name>.sql`, one normalized statement
+per line (literals replaced by `?`, IN lists collapsed). Regenerate them after
+an intended change with:
+
+    UPDATE_SQL_SNAPSHOTS=1 python manage.py test
+"""
+
+import difflib
+import json
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+SNAPSHOT_DIR = Path(__file__).parent / "snapshots"
+UPDATE_SNAPSHOTS_ENV = "UPDATE_SQL_SNAPSHOTS"
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w\"])-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b")
+_IN_LIST = re.compile(r"IN \(\?(?:, \?)*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    The shape of a statement: literals and IN list lengths vary per run and
+    row count, table, column and join structure don't.
+    """
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _IN_LIST.sub("IN (...)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def plan_access_paths(sql: str) -> list[str]:
+    """
+    How each relation is read, e.g. `["rides_ride: index", "users_user: seq"]`,
+    or [] for anything that isn't a SELECT.
+
+    Planned with sequential scans disabled, so "seq" means no index can serve
+    the query at all. Join algorithms and scan flavours (index vs bitmap) are
+    left out, the planner legitimately switches those as tables grow.
+    """
+    if not sql.lstrip().upper().startswith("SELECT"):
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute("SET enable_seqscan = off")
+        try:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+            raw = cursor.fetchone()[0]
+        finally:
+            cursor.execute("RESET enable_seqscan")
+    plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+
+    paths = set()
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        if relation := node.get("Relation Name"):
+            kind = "seq" if node["Node Type"] == "Seq Scan" else "index"
+            paths.add(f"{relation}: {kind}")
+        stack.extend(node.get("Plans", ()))
+    return sorted(paths)
+
+
+class QueryBudgetMixin:
+    """
+    For `TestCase` subclasses.
+    """
+
+    @contextmanager
+    def assertQueryBudget(self, budget: int):
+        """
+        Like `assertNumQueries()`, but fails only when going over `budget`.
+        Yields the `CaptureQueriesContext`.
+        """
+        with CaptureQueriesContext(connection) as ctx:
+            yield ctx
+
+        if len(ctx) > budget:
+            statements = "\n".join(
+                f"{i}. {query['sql']}" for i, query in enumerate(ctx, start=1)
+            )
+            self.fail(f"{len(ctx)} queries executed, budget is {budget}\n{statements}")
+
+    def assertSQLSnapshot(self, name: str, ctx: CaptureQueriesContext):
+        """
+        Compare the normalized statements in `ctx` with the checked-in snapshot.
+        """
+        actual = [normalize_sql(query["sql"]) for query in ctx]
+        path = SNAPSHOT_DIR / f"{name}.sql"
+
+        if os.environ.get(UPDATE_SNAPSHOTS_ENV):
+            SNAPSHOT_DIR.mkdir(exist_ok=True)
+            path.write_text("".join(f"{line}\n" for line in actual))
+            return
+
+        if not path.exists():
+            self.fail(
+                f"No SQL snapshot {path.name}, create it with {UPDATE_SNAPSHOTS_ENV}=1"
+            )
+
+        expected = path.read_text().splitlines()
+        if actual != expected:
+            diff = "\n".join(
+                difflib.unified_diff(
+                    expected, actual, "snapshot", "actual", lineterm=""
+                )
+            )
+            self.fail(
+                f"SQL for {name} doesn't match {path.name} (set "
+                f"{UPDATE_SNAPSHOTS_ENV}=1 if the change is intended):\n{diff}"
+            )
+
+    def assertScalesFlat(self, make_rows, request, sizes=(10, 1000)):
+        """
+        Run `request()` after `make_rows(n)` topped the data up to each size,
+        failing if the number of queries, their shape or how they access each
+        table (see `plan_access_paths()`) change between sizes.
+        """
+        runs = []
+        created = 0
+        for size in sizes:
+            make_rows(size - created)
+            created = size
+
+            with CaptureQueriesContext(connection) as ctx:
+                request()
+            statements = [query["sql"] for query in ctx]
+            runs.append(
+                (
+                    size,
+                    [normalize_sql(sql) for sql in statements],
+                    [plan_access_paths(sql) for sql in statements],
+                )
+            )
+
+        (base_size, base_shapes, base_plans), *rest = runs
+        for size, shapes, plans in rest:
+            self.assertEqual(
+                len(shapes),
+                len(base_shapes),
+                f"{len(base_shapes)} queries at {base_size} rows, "
+                f"{len(shapes)} at {size} rows",
+            )
+            self.assertEqual(
+                shapes, base_shapes, f"SQL changed between {base_size} and {size} rows"
+            )
+            self.assertEqual(
+                plans,
+                base_plans,
+                f"Table access changed between {base_size} and {size} rows",
+            )
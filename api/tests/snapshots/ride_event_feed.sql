@@ -0,0 +1,2 @@
+SELECT "users_user"."password", "users_user"."last_login", "users_user"."is_superuser", "users_user"."username", "users_user"."is_staff", "users_user"."is_active", "users_user"."date_joined", "users_user"."id_user", "users_user"."role", "users_user"."phone_number", "users_user"."first_name", "users_user"."last_name", "users_user"."email" FROM "users_user" WHERE "users_user"."id_user" = ? LIMIT ?
+SELECT "rides_rideevent"."id_ride_event", "rides_rideevent"."id_ride", "rides_rideevent"."description", "rides_rideevent"."created_at", "rides_rideevent"."idempotency_key" FROM "rides_rideevent" WHERE ("rides_rideevent"."id_ride_event" > ? AND (rides_rideevent.created_xid IS NULL OR rides_rideevent.created_xid < pg_snapshot_xmin(pg_current_snapshot()) OR rides_rideevent.created_xid = pg_current_xact_id_if_assigned())) ORDER BY "rides_rideevent"."id_ride_event" ASC LIMIT ?
@@ -0,0 +1,4 @@
+SELECT "users_user"."password", "users_user"."last_login", "users_user"."is_superuser", "users_user"."username", "users_user"."is_staff", "users_user"."is_active", "users_user"."date_joined", "users_user"."id_user", "users_user"."role", "users_user"."phone_number", "users_user"."first_name", "users_user"."last_name", "users_user"."email" FROM "users_user" WHERE "users_user"."id_user" = ? LIMIT ?
+SELECT COUNT(*) AS "__count" FROM "rides_ride"
+SELECT "rides_ride"."id_ride", "rides_ride"."status", "rides_ride"."id_rider", "rides_ride"."id_driver", "rides_ride"."pickup_latitude", "rides_ride"."pickup_longitude", "rides_ride"."dropoff_latitude", "rides_ride"."dropoff_longitude", "rides_ride"."pickup_time", "rides_ride"."distance_km", "rides_ride"."bbox_south", "rides_ride"."bbox_west", "rides_ride"."bbox_north", "rides_ride"."bbox_east", "rides_ride"."event_timeline", GREATEST((SELECT "U0"."created_at" AS "created_at" FROM "rides_rideevent" "U0" WHERE ("U0"."description" = ? AND "U0"."id_ride" = ("rides_ride"."id_ride")) ORDER BY ? DESC LIMIT ?), (SELECT max((event ->> ?)::timestamptz) FROM jsonb_array_elements("rides_ride"."event_timeline") event WHERE event ->> ? = ?)) AS "pickup_event_time", "users_user"."password", "users_user"."last_login", "users_user"."is_superuser", "users_user"."username", "users_user"."is_staff", "users_user"."is_active", "users_user"."date_joined", "users_user"."id_user", "users_user"."role", "users_user"."phone_number", "users_user"."first_name", "users_user"."last_name", "users_user"."email", "T3"."password", "T3"."last_login", "T3"."is_superuser", "T3"."username", "T3"."is_staff", "T3"."is_active", "T3"."date_joined", "T3"."id_user", "T3"."role", "T3"."phone_number", "T3"."first_name", "T3"."last_name", "T3"."email" FROM "rides_ride" INNER JOIN "users_user" ON ("rides_ride"."id_rider" = "users_user"."id_user") INNER JOIN "users_user" "T3" ON ("rides_ride"."id_driver" = "T3"."id_user") ORDER BY ? DESC LIMIT ?
+SELECT "rides_rideevent"."id_ride_event", "rides_rideevent"."id_ride", "rides_rideevent"."description", "rides_rideevent"."created_at", "rides_rideevent"."idempotency_key" FROM "rides_rideevent" WHERE ("rides_rideevent"."created_at" >= ?::timestamptz AND "rides_rideevent"."id_ride" IN (...)) ORDER BY "rides_rideevent"."created_at" DESC
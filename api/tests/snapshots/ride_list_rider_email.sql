@@ -0,0 +1,5 @@
+SELECT "users_user"."password", "users_user"."last_login", "users_user"."is_superuser", "users_user"."username", "users_user"."is_staff", "users_user"."is_active", "users_user"."date_joined", "users_user"."id_user", "users_user"."role", "users_user"."phone_number", "users_user"."first_name", "users_user"."last_name", "users_user"."email" FROM "users_user" WHERE "users_user"."id_user" = ? LIMIT ?
+SELECT "users_user"."id_user" AS "id_user" FROM "users_user" WHERE LOWER("users_user"."email") = ? ORDER BY "users_user"."id_user" ASC LIMIT ?
+SELECT COUNT(*) AS "__count" FROM "rides_ride" WHERE "rides_ride"."id_rider" = ?
+SELECT "rides_ride"."id_ride", "rides_ride"."status", "rides_ride"."id_rider", "rides_ride"."id_driver", "rides_ride"."pickup_latitude", "rides_ride"."pickup_longitude", "rides_ride"."dropoff_latitude", "rides_ride"."dropoff_longitude", "rides_ride"."pickup_time", "rides_ride"."distance_km", "rides_ride"."bbox_south", "rides_ride"."bbox_west", "rides_ride"."bbox_north", "rides_ride"."bbox_east", "rides_ride"."event_timeline", "users_user"."password", "users_user"."last_login", "users_user"."is_superuser", "users_user"."username", "users_user"."is_staff", "users_user"."is_active", "users_user"."date_joined", "users_user"."id_user", "users_user"."role", "users_user"."phone_number", "users_user"."first_name", "users_user"."last_name", "users_user"."email", "T3"."password", "T3"."last_login", "T3"."is_superuser", "T3"."username", "T3"."is_staff", "T3"."is_active", "T3"."date_joined", "T3"."id_user", "T3"."role", "T3"."phone_number", "T3"."first_name", "T3"."last_name", "T3"."email" FROM "rides_ride" INNER JOIN "users_user" ON ("rides_ride"."id_rider" = "users_user"."id_user") INNER JOIN "users_user" "T3" ON ("rides_ride"."id_driver" = "T3"."id_user") WHERE "rides_ride"."id_rider" = ? ORDER BY "rides_ride"."id_ride" ASC LIMIT ?
+SELECT "rides_rideevent"."id_ride_event", "rides_rideevent"."id_ride", "rides_rideevent"."description", "rides_rideevent"."created_at", "rides_rideevent"."idempotency_key" FROM "rides_rideevent" WHERE ("rides_rideevent"."created_at" >= ?::timestamptz AND "rides_rideevent"."id_ride" IN (...)) ORDER BY "rides_rideevent"."created_at" DESC
@@ -0,0 +1,3 @@
+SELECT "users_user"."password", "users_user"."last_login", "users_user"."is_superuser", "users_user"."username", "users_user"."is_staff", "users_user"."is_active", "users_user"."date_joined", "users_user"."id_user", "users_user"."role", "users_user"."phone_number", "users_user"."first_name", "users_user"."last_name", "users_user"."email" FROM "users_user" WHERE "users_user"."id_user" = ? LIMIT ?
+SELECT COUNT(*) AS "__count" FROM "rides_ride"
+SELECT "rides_ride"."id_ride", "rides_ride"."status" FROM "rides_ride" ORDER BY "rides_ride"."id_ride" ASC LIMIT ?
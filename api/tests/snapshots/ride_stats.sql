@@ -0,0 +1,2 @@
+SELECT "users_user"."password", "users_user"."last_login", "users_user"."is_superuser", "users_user"."username", "users_user"."is_staff", "users_user"."is_active", "users_user"."date_joined", "users_user"."id_user", "users_user"."role", "users_user"."phone_number", "users_user"."first_name", "users_user"."last_name", "users_user"."email" FROM "users_user" WHERE "users_user"."id_user" = ? LIMIT ?
+SELECT "rides_ridestatscounter"."key" AS "key", SUM("rides_ridestatscounter"."count") AS "total" FROM "rides_ridestatscounter" WHERE "rides_ridestatscounter"."dimension" = ? GROUP BY ? ORDER BY ? ASC
@@ -0,0 +1,48 @@
+from unittest import mock
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from api import memory
+
+
+class RSSTests(SimpleTestCase):
+    def test_rss(self):
+        self.assertTrue(memory.reset_peak_rss())
+        current, peak = memory.rss_kib()
+        self.assertGreater(current, 0)
+        self.assertGreaterEqual(peak, current)
+
+    def test_no_proc(self):
+        with mock.patch("builtins.open", side_effect=FileNotFoundError):
+            self.assertIsNone(memory.rss_kib())
+            self.assertFalse(memory.reset_peak_rss())
+
+
+class PeakRSSMiddlewareTests(SimpleTestCase):
+    def _allocating_view(self, request):
+        # touched, so it's resident
+        request.buffer = bytearray(64 * 1024 * 1024)
+        return HttpResponse()
+
+    @override_settings(MEMORY_RSS_LOG_MB=32)
+    def test_logs_requests_above_threshold(self):
+        middleware = memory.PeakRSSMiddleware(self._allocating_view)
+
+        with self.assertLogs("api.memory", "WARNING") as logs:
+            middleware(RequestFactory().get("/api/rides/?page_size=100"))
+
+        self.assertIn("GET /api/rides/?page_size=100 peaked at", logs.output[0])
+
+    @override_settings(MEMORY_RSS_LOG_MB=1024)
+    def test_quiet_below_threshold(self):
+        middleware = memory.PeakRSSMiddleware(self._allocating_view)
+
+        with self.assertNoLogs("api.memory"):
+            middleware(RequestFactory().get("/api/rides/"))
+
+    @override_settings(MEMORY_RSS_LOG_MB=0)
+    def test_off(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            memory.PeakRSSMiddleware(self._allocating_view)
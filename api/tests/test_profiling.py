@@ -0,0 +1,164 @@
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.test import override_settings
+from rest_framework import status
+
+from api import profiling
+from api.tests.base import BaseAPITestCase
+
+RIDES_PATH = "/api/rides/?status=pickup"
+PROFILES_PATH = "/api/request-profiles/"
+
+
+def _busy(seconds):
+    until = time.perf_counter() + seconds
+    while time.perf_counter() < until:
+        pass
+
+
+class SamplerTests(BaseAPITestCase):
+    def test_collapsed_stacks(self):
+        sampler = profiling.Sampler(threading.get_ident())
+        sampler.start()
+        _busy(0.05)
+        stacks = sampler.stop()
+
+        self.assertGreater(sum(stacks.values()), 0)
+        busy = [
+            stack
+            for stack in stacks
+            if stack.endswith("api.tests.test_profiling:_busy")
+        ]
+        self.assertTrue(busy)
+        # root first
+        self.assertIn(
+            "SamplerTests.test_collapsed_stacks;api.tests.test_profiling:_busy",
+            busy[0],
+        )
+        self.assertFalse(any(" " in stack for stack in stacks))
+
+    def test_deep_stacks_keep_the_leaves(self):
+        sampler = profiling.Sampler(threading.get_ident())
+        with mock.patch.object(profiling, "PROFILE_MAX_DEPTH", 2):
+            sampler.start()
+            _busy(0.05)
+            stacks = sampler.stop()
+
+        self.assertIn(
+            "(truncated);api.tests.test_profiling:SamplerTests."
+            "test_deep_stacks_keep_the_leaves;api.tests.test_profiling:_busy",
+            stacks,
+        )
+        self.assertTrue(all(stack.startswith("(truncated);") for stack in stacks))
+
+
+class RequestProfilerTests(BaseAPITestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(REQUEST_PROFILE_DIR=directory.name))
+        self._authenticate_as(self.admin_user)
+
+    def _signed_get(self, path, signed_path=None):
+        return self.client.get(
+            path, HTTP_X_PROFILE_REQUEST=profiling.sign_request(signed_path or path)
+        )
+
+    def test_signed_header(self):
+        response = self._signed_get(RIDES_PATH)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        id_profile = response["X-Request-Profile"]
+        [summary] = self.client.get(PROFILES_PATH).data
+        self.assertEqual(summary["id"], id_profile)
+        self.assertEqual(summary["path"], RIDES_PATH)
+        self.assertEqual(summary["status"], 200)
+
+        response = self.client.get(f"{PROFILES_PATH}{id_profile}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("attachment", response["Content-Disposition"])
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            sum(int(line.rsplit(" ", 1)[1]) for line in lines), summary["samples"]
+        )
+        self.assertTrue(
+            all(
+                "api.profiling:RequestProfilerMiddleware._profile" in line
+                for line in lines
+            )
+        )
+
+    def test_invalid_signatures(self):
+        # signed for another query
+        response = self._signed_get(RIDES_PATH, "/api/rides/?status=dropoff")
+        self.assertNotIn("X-Request-Profile", response)
+
+        response = self.client.get(RIDES_PATH, HTTP_X_PROFILE_REQUEST="1:forged")
+        self.assertNotIn("X-Request-Profile", response)
+
+        with mock.patch("api.profiling.PROFILE_SIGNATURE_MAX_AGE", -1):
+            response = self._signed_get(RIDES_PATH)
+        self.assertNotIn("X-Request-Profile", response)
+        self.assertEqual(profiling.list_profiles(), [])
+
+    def test_admin_flag(self):
+        response = self.client.get(RIDES_PATH, {"profile": 1})
+        self.assertIn("X-Request-Profile", response)
+
+        # riders and bad tokens get no profile, and the request carries on
+        self._authenticate_as(self.rider_user)
+        response = self.client.get("/api/rides/mine/", {"profile": 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("X-Request-Profile", response)
+
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer nope")
+        response = self.client.get(RIDES_PATH, {"profile": 1})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertNotIn("X-Request-Profile", response)
+
+    def test_untriggered(self):
+        response = self.client.get(RIDES_PATH, {"memory_profile": 0})
+
+        self.assertNotIn("X-Request-Profile", response)
+        self.assertEqual(self.client.get(PROFILES_PATH).data, [])
+
+    def test_keeps_latest(self):
+        with mock.patch("api.profiling.PROFILE_MAX_COUNT", 2):
+            ids = [
+                self.client.get(RIDES_PATH, {"profile": 1})["X-Request-Profile"]
+                for _ in range(3)
+            ]
+
+        self.assertEqual(
+            [summary["id"] for summary in self.client.get(PROFILES_PATH).data],
+            ids[:0:-1],
+        )
+        response = self.client.get(f"{PROFILES_PATH}{ids[0]}/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_admin_only(self):
+        id_profile = self.client.get(RIDES_PATH, {"profile": 1})["X-Request-Profile"]
+        self._authenticate_as(self.driver_user)
+
+        response = self.client.get(PROFILES_PATH)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(f"{PROFILES_PATH}{id_profile}/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_command(self):
+        out = StringIO()
+        call_command("sign_profile_request", RIDES_PATH, stdout=out)
+
+        name, value = out.getvalue().strip().split(": ")
+        self.assertEqual(name, "X-Profile-Request")
+        self.assertIn(
+            "X-Request-Profile",
+            self.client.get(RIDES_PATH, HTTP_X_PROFILE_REQUEST=value),
+        )
+        with self.assertRaises(CommandError):
+            call_command("sign_profile_request", "api/rides/")
@@ -0,0 +1,117 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework import status
+
+from api.tests.base import BaseAPITestCase
+from api.tests.query_budget import QueryBudgetMixin, normalize_sql
+from rides.models import Ride, RideEvent, RideEventType, RideStatus
+
+RIDES_PATH = "/api/rides/"
+RIDE_EVENTS_FEED_PATH = "/api/ride-events/feed/"
+
+
+class NormalizeSQLTests(BaseAPITestCase):
+    def test_literals_and_in_lists(self):
+        self.assertEqual(
+            normalize_sql(
+                'SELECT "T3"."id_user" FROM "users_user" "T3"\n'
+                'WHERE "T3"."email" = \'a\'\'b@example.com\' AND "T3"."id_user" '
+                "IN (1, 2, 3) AND x > -74.006 LIMIT 21"
+            ),
+            'SELECT "T3"."id_user" FROM "users_user" "T3" WHERE "T3"."email" = ? '
+            'AND "T3"."id_user" IN (...) AND x > ? LIMIT ?',
+        )
+
+
+class EndpointQueryBudgetTests(QueryBudgetMixin, BaseAPITestCase):
+    """
+    Query budget + SQL snapshot per endpoint, and scaling from 10 to 1000 rides.
+    """
+
+    def setUp(self):
+        # cached lookups (e.g. rider_email) would change the statements
+        cache.clear()
+        self._authenticate_as(self.admin_user)
+        self.pickup_time = timezone.now()
+
+    def _make_rides(self, count: int):
+        rides = Ride.objects.bulk_create(
+            Ride(
+                status=RideStatus.EN_ROUTE,
+                id_rider=self.rider_user if i % 2 else self.rider_user_2,
+                id_driver=self.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=self.pickup_time + timedelta(minutes=i),
+            )
+            for i in range(count)
+        )
+        RideEvent.objects.bulk_create(
+            RideEvent(id_ride=ride, description=RideEventType.STATUS_EN_ROUTE)
+            for ride in rides
+        )
+        return rides
+
+    def _get(self, path, params=None):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def _check(self, name, budget, path, params=None):
+        self._make_rides(10)
+        with self.assertQueryBudget(budget) as ctx:
+            self._get(path, params)
+        self.assertSQLSnapshot(name, ctx)
+
+    def test_ride_list(self):
+        # auth user, count, rides + rider/driver, today's events
+        self._check("ride_list", 4, RIDES_PATH)
+
+    def test_ride_list_sparse_fields(self):
+        self._check(
+            "ride_list_sparse_fields", 3, RIDES_PATH, {"fields": "id_ride,status"}
+        )
+
+    def test_ride_list_pickup_time_ordering(self):
+        self._check(
+            "ride_list_pickup_time_ordering",
+            4,
+            RIDES_PATH,
+            {"ordering": "-pickup_time", "page_size": 100},
+        )
+
+    def test_ride_list_rider_email(self):
+        self._check(
+            "ride_list_rider_email", 5, RIDES_PATH, {"rider_email": "jane@example.com"}
+        )
+
+    def test_ride_detail(self):
+        ride = self._make_rides(1)[0]
+        with self.assertQueryBudget(3) as ctx:
+            self._get(f"{RIDES_PATH}{ride.id_ride}/")
+        self.assertSQLSnapshot("ride_detail", ctx)
+
+    def test_ride_stats(self):
+        self._check("ride_stats", 2, f"{RIDES_PATH}stats/")
+
+    @mock.patch("rides.views.ride_event_notifier.start")
+    def test_ride_event_feed(self, _start):
+        self._check("ride_event_feed", 2, RIDE_EVENTS_FEED_PATH, {"limit": 500})
+
+    def test_ride_list_scales_flat(self):
+        self.assertScalesFlat(
+            self._make_rides, lambda: self._get(RIDES_PATH, {"page_size": 100})
+        )
+
+    def test_ride_list_sorted_scales_flat(self):
+        self.assertScalesFlat(
+            self._make_rides,
+            lambda: self._get(
+                RIDES_PATH, {"ordering": "pickup_time", "status": RideStatus.EN_ROUTE}
+            ),
+        )
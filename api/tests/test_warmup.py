@@ -0,0 +1,72 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+
+from api.warmup import warm_up
+
+WARMUP_STEPS = {"imports", "urls", "querysets", "caches", "total"}
+
+
+class WarmUpTests(TestCase):
+    def test_reports_every_step(self):
+        with self.assertLogs("api.warmup", "INFO"):
+            timings = warm_up()
+
+        self.assertEqual(set(timings), WARMUP_STEPS)
+        self.assertTrue(all(ms is not None and ms >= 0 for ms in timings.values()))
+
+    def test_failed_step_doesnt_stop_the_rest(self):
+        with (
+            mock.patch(
+                "rides.locations.driver_locations.ensure_loaded",
+                side_effect=RuntimeError("database is down"),
+            ),
+            self.assertLogs("api.warmup", "ERROR"),
+        ):
+            timings = warm_up()
+
+        self.assertIsNone(timings["caches"])
+        self.assertIsNotNone(timings["querysets"])
+
+    def test_timings_are_logged(self):
+        self.assertTrue(logging.getLogger("api.warmup").isEnabledFor(logging.INFO))
+
+    def test_wsgi_closes_warmed_connections(self):
+        script = (
+            "import api.wsgi\n"
+            "from django.db import connections\n"
+            "print(all(c.connection is None for c in connections.all()))\n"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=settings.BASE_DIR,
+            env={
+                **os.environ,
+                "DJANGO_SETTINGS_MODULE": "api.settings",
+                "DB_NAME": connection.settings_dict["NAME"],
+                "WARMUP_ON_START": "true",
+            },
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "True")
+        self.assertIn("Warm-up took", result.stderr)
+
+    def test_command(self):
+        out = StringIO()
+        with self.assertLogs("api.warmup", "INFO"):
+            call_command("warmup", stdout=out)
+
+        self.assertEqual(set(json.loads(out.getvalue())), WARMUP_STEPS)
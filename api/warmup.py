@@ -0,0 +1,102 @@
+"""
+Warm-up for a fresh worker process.
+
+Pays the one-off costs of the first requests up front: lazy imports, URL
+resolver population, building serializer fields and compiling the
+`RideViewSet` querysets, and priming in-process caches. Database connections
+aren't among them: the ones opened here are closed once it's done (see
+`api/wsgi.py`) and request threads open their own anyway. Run from `api/wsgi.py`/`api/asgi.py` when `WARMUP_ON_START` is set, or
+with `manage.py warmup`.
+"""
+
+import importlib
+import logging
+import time
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.urls import get_resolver, reverse
+
+logger = logging.getLogger(__name__)
+
+WARMUP_IMPORTS = [
+    "rest_framework_simplejwt.authentication",
+    "rest_framework_simplejwt.views",
+    "rides.views",
+    "users.serializers",
+]
+
+# query params of the ride list variants that get their SQL compiled
+WARMUP_RIDE_LIST_PARAMS = [
+    {},
+    {"status": "en-route"},
+    {"ordering": "-pickup_time"},
+    {"ordering": "distance", "latitude": "0", "longitude": "0"},
+    {"fields": "id_ride,status"},
+]
+
+
+@contextmanager
+def _step(timings: dict, name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        # best effort, e.g. a database that isn't up yet shouldn't stop the
+        # worker from booting
+        logger.exception("Warm-up step %s failed", name)
+        timings[name] = None
+    else:
+        timings[name] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def warm_up() -> dict[str, float | None]:
+    """
+    Returns the milliseconds spent per step (None if it failed), and in total.
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    with _step(timings, "imports"):
+        for module in WARMUP_IMPORTS:
+            importlib.import_module(module)
+
+    with _step(timings, "urls"):
+        get_resolver().resolve("/api/rides/")
+        reverse("token_obtain_pair")
+
+    with _step(timings, "querysets"):
+        _compile_ride_querysets()
+
+    with _step(timings, "caches"):
+        from rides.locations import driver_locations
+
+        cache.get("warmup")
+        driver_locations.ensure_loaded()
+
+    timings["total"] = round((time.perf_counter() - started) * 1000, 2)
+    logger.info("Warm-up took %.1fms: %s", timings["total"], timings)
+    return timings
+
+
+def _compile_ride_querysets():
+    from rest_framework.test import APIRequestFactory
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+
+    from rides.serializers import RideSerializer
+    from rides.views import RideViewSet
+    from users.serializers import BaseUserSerializer
+
+    JWTAuthentication()
+    factory = APIRequestFactory()
+    for params in WARMUP_RIDE_LIST_PARAMS:
+        view = RideViewSet(action_map={"get": "list"}, format_kwarg=None, kwargs={})
+        view.request = view.initialize_request(factory.get("/api/rides/", params))
+        queryset = view.get_queryset()
+        queryset.query.get_compiler(queryset.db).as_sql()
+
+        # DRF builds serializer fields (and the model field introspection behind
+        # them) lazily on first access
+        _ = RideSerializer(context=view.get_serializer_context()).fields
+
+    _ = BaseUserSerializer().fields
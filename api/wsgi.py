@@ -14,3 +14,17 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings
+
+if settings.WARMUP_ON_START:
+    from django.db import connections
+
+    from api.warmup import warm_up
+
+    try:
+        warm_up()
+    finally:
+        # servers that import this module before forking (e.g. gunicorn
+        # --preload) would share these connections between workers
+        connections.close_all()
@@ -1,23 +1,124 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import Q
 
-from .models import Ride, RideEvent
+from users.models import SEARCH_MIN_LENGTH, SearchTooBroad, User
+
+from .models import Ride, RideEvent, RideEventType
+from .pagination import EstimatedCountPaginator
+from .sharding import ScatteredQuerySet, shard_aliases, shard_for_ride_id
+
+
+class ScatteredChangeList(ChangeList):
+    """
+    Lists the rows of every shard, merged on the ordering, with their counts
+    added up. Bulk actions still go by the queryset on "default".
+    """
+
+    def get_results(self, request):
+        queryset = self.queryset
+        self.queryset = ScatteredQuerySet(queryset, shard_aliases())
+        try:
+            super().get_results(request)
+        finally:
+            self.queryset = queryset
+
+
+class ShardedModelAdmin(admin.ModelAdmin):
+    """
+    Changelists and change forms across the ride shards (see rides.sharding).
+    """
+
+    def get_changelist(self, request, **kwargs):
+        if len(shard_aliases()) > 1:
+            return ScatteredChangeList
+        return super().get_changelist(request, **kwargs)
+
+    def get_object(self, request, object_id, from_field=None):
+        if from_field is not None or len(shard_aliases()) == 1:
+            return super().get_object(request, object_id, from_field)
+        try:
+            pk = int(object_id)
+        except ValueError:
+            return None
+        # ride and event ids are interleaved the same way
+        queryset = self.get_queryset(request).using(shard_for_ride_id(pk))
+        return queryset.filter(pk=pk).first()
 
 
 @admin.register(Ride)
-class RideAdmin(admin.ModelAdmin):
+class RideAdmin(ShardedModelAdmin):
     list_display = ("id_ride", "status", "id_rider", "id_driver", "pickup_time")
+    list_select_related = ("id_rider", "id_driver")
+    # fixed date ranges, unlike date_hierarchy which scans for distinct dates
     list_filter = ("status", "pickup_time")
-    search_fields = (
-        "id_rider__email",
-        "id_rider__first_name",
-        "id_driver__email",
-        "id_driver__first_name",
+    search_fields = ("id_rider__email", "id_driver__email")
+    search_help_text = (
+        "Ride id, rider/driver email or part of their name or phone number"
     )
-    date_hierarchy = "pickup_time"
+    autocomplete_fields = ("id_rider", "id_driver")
+    # events of finished rides, see compact_ride_events
+    readonly_fields = ("event_timeline",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Every search resolves to an indexed `rides_ride` column (pk, id_rider,
+        id_driver) instead of a LIKE across the user joins.
+        """
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+
+        if term.isdigit():
+            return queryset.filter(pk=int(term)), False
+
+        if "@" in term:
+            id_user = User.objects.id_for_email(term)
+            if id_user is None:
+                return queryset.none(), False
+            return queryset.filter(Q(id_rider=id_user) | Q(id_driver=id_user)), False
+
+        # names and phone numbers through the users' trigram indexes
+        users = []
+        try:
+            if len(term) >= SEARCH_MIN_LENGTH:
+                users = User.objects.search(term)
+        except SearchTooBroad:
+            self.message_user(
+                request,
+                "That matches too many users, try a longer or more specific term.",
+                messages.WARNING,
+            )
+        return queryset.filter(Q(id_rider__in=users) | Q(id_driver__in=users)), False
 
 
 @admin.register(RideEvent)
-class RideEventAdmin(admin.ModelAdmin):
+class RideEventAdmin(ShardedModelAdmin):
     list_display = ("id_ride_event", "id_ride", "description", "created_at")
-    list_filter = ("created_at",)
+    list_select_related = ("id_ride",)
+    list_filter = ("description", "created_at")
     search_fields = ("description",)
+    search_help_text = "Ride id, event id or part of the description"
+    raw_id_fields = ("id_ride",)
+    # the pk index, the model's created_at ordering would sort the whole table
+    ordering = ("-id_ride_event",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+
+        if term.isdigit():
+            return queryset.filter(Q(pk=int(term)) | Q(id_ride=int(term))), False
+
+        # descriptions are a fixed set, match them here and filter on the index
+        descriptions = [
+            value
+            for value, label in RideEventType.choices
+            if term.lower() in value.lower() or term.lower() in label.lower()
+        ]
+        return queryset.filter(description__in=descriptions), False
@@ -0,0 +1,392 @@
+"""
+Offline trip metrics per driver and month, see `manage.py ride_analytics`.
+
+RideEvent and Ride rows are streamed through server-side cursors (both ordered
+by id_ride) a batch at a time. Pickup/dropoff events are paired into trips and
+folded into per (driver, month) accumulators with NumPy, so memory depends on
+the number of groups rather than the number of events.
+
+Events compacted into finished rides' `event_timeline` (see
+`manage.py compact_ride_events`) are unpacked by a third cursor in the same
+order and merged into the event stream.
+
+A trip runs from a ride's first pickup event to its last dropoff event, its
+month is the pickup event's (UTC). Percentiles come from log-spaced histograms
+and are within about 4% (half a bin).
+"""
+
+import csv
+from heapq import merge
+from itertools import batched
+
+import numpy as np
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Case, FloatField, IntegerField, Value, When
+from django.db.models.functions import Cast, Extract
+
+from .locations import EARTH_RADIUS_KM
+from .models import Ride, RideEvent, RideEventType
+
+EVENT_BATCH_SIZE = 100_000
+RIDE_BATCH_SIZE = 50_000
+
+PICKUP = 1
+DROPOFF = 2
+PERCENTILES = (50, 90, 99)
+
+# bin edges in seconds, ~8% apart from 1s to 30 days, mirrored for negative
+# pickup delays (early pickups)
+_POSITIVE_EDGES = np.geomspace(1, 30 * 86400, 200)
+HISTOGRAM_EDGES = np.concatenate([-_POSITIVE_EDGES[::-1], [0.0], _POSITIVE_EDGES])
+HISTOGRAM_BINS = len(HISTOGRAM_EDGES) + 1
+
+COLUMNS = [
+    "month",
+    "id_driver",
+    "driver",
+    "trips",
+    "trips_over_1h",
+    "duration_mean_min",
+    *(f"duration_p{p}_min" for p in PERCENTILES),
+    "pickup_delay_mean_min",
+    *(f"pickup_delay_p{p}_min" for p in PERCENTILES),
+    "distance_total_km",
+    "distance_mean_km",
+]
+# everything else is float64
+NPZ_DTYPES = {
+    "month": "U7",
+    "id_driver": np.int64,
+    "driver": np.str_,
+    "trips": np.int64,
+    "trips_over_1h": np.int64,
+}
+
+
+# (id_ride, kind, at) rows of the compacted events, like the RideEvent stream
+TIMELINE_TRIP_EVENTS = """
+SELECT ride.id_ride,
+    CASE event ->> 1 WHEN %(pickup)s THEN %(pickup_kind)s ELSE %(dropoff_kind)s END,
+    extract(epoch FROM (event ->> 2)::timestamptz)::float8 AS at
+FROM rides_ride ride, jsonb_array_elements(ride.event_timeline) event
+WHERE ride.event_timeline IS NOT NULL AND event ->> 1 IN (%(pickup)s, %(dropoff)s)
+ORDER BY ride.id_ride, at
+"""
+
+
+def _epoch(field):
+    return Cast(Extract(field, "epoch"), FloatField())
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def histogram_percentile(counts: np.ndarray, percent: float) -> float:
+    """
+    Approximate percentile (seconds) from a `HISTOGRAM_EDGES` histogram, the
+    middle of the bin it falls in.
+    """
+    total = counts.sum()
+    if not total:
+        return float("nan")
+    index = int(np.searchsorted(np.cumsum(counts), percent / 100 * total))
+    low = HISTOGRAM_EDGES[max(index - 1, 0)]
+    high = HISTOGRAM_EDGES[min(index, len(HISTOGRAM_EDGES) - 1)]
+    if low < 0 < high or low == 0 or high == 0:
+        return (low + high) / 2
+    return float(np.sign(high) * np.sqrt(low * high))
+
+
+class TripMetrics:
+    """
+    Per (driver, month) accumulators, rows are added as groups show up.
+    """
+
+    def __init__(self):
+        self.group_rows: dict[tuple[int, int], int] = {}
+        self.sums = np.zeros((0, 5))  # trips, over 1h, duration, delay, distance
+        self.durations = np.zeros((0, HISTOGRAM_BINS), dtype=np.int64)
+        self.delays = np.zeros((0, HISTOGRAM_BINS), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.group_rows)
+
+    def _rows_for(self, drivers: np.ndarray, months: np.ndarray) -> np.ndarray:
+        keys = np.stack([drivers, months], axis=1)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        rows = np.array(
+            [
+                self.group_rows.setdefault((int(d), int(m)), len(self.group_rows))
+                for d, m in unique
+            ],
+            dtype=np.int64,
+        )
+
+        if len(self.group_rows) > len(self.sums):
+            grow = max(len(self.group_rows), 2 * len(self.sums)) - len(self.sums)
+            self.sums = np.vstack([self.sums, np.zeros((grow, 5))])
+            empty = np.zeros((grow, HISTOGRAM_BINS), dtype=np.int64)
+            self.durations = np.vstack([self.durations, empty])
+            self.delays = np.vstack([self.delays, empty])
+        return rows[inverse.ravel()]
+
+    @staticmethod
+    def _add_histogram(histograms, rows, values):
+        flat = rows * HISTOGRAM_BINS + np.searchsorted(HISTOGRAM_EDGES, values)
+        cells, counts = np.unique(flat, return_counts=True)
+        histograms.reshape(-1)[cells] += counts
+
+    def add(self, drivers, pickup_at, dropoff_at, scheduled_at, distances_km):
+        if not len(drivers):
+            return
+        months = pickup_at.astype("datetime64[s]").astype("datetime64[M]")
+        rows = self._rows_for(drivers, months.astype(np.int64))
+
+        durations = dropoff_at - pickup_at
+        delays = pickup_at - scheduled_at
+        n = len(self.sums)
+        for column, weights in enumerate(
+            (None, durations > 3600, durations, delays, distances_km)
+        ):
+            self.sums[:, column] += np.bincount(rows, weights=weights, minlength=n)
+        self._add_histogram(self.durations, rows, durations)
+        self._add_histogram(self.delays, rows, delays)
+
+    def results(self, driver_names: dict[int, str]):
+        for (id_driver, month), row in sorted(
+            self.group_rows.items(), key=lambda item: (item[0][1], item[0][0])
+        ):
+            trips, over_hour, duration, delay, distance = self.sums[row]
+            yield {
+                "month": str(np.datetime64(month, "M")),
+                "id_driver": id_driver,
+                "driver": driver_names.get(id_driver, ""),
+                "trips": int(trips),
+                "trips_over_1h": int(over_hour),
+                "duration_mean_min": duration / trips / 60,
+                **{
+                    f"duration_p{p}_min": histogram_percentile(self.durations[row], p)
+                    / 60
+                    for p in PERCENTILES
+                },
+                "pickup_delay_mean_min": delay / trips / 60,
+                **{
+                    f"pickup_delay_p{p}_min": histogram_percentile(self.delays[row], p)
+                    / 60
+                    for p in PERCENTILES
+                },
+                "distance_total_km": distance,
+                "distance_mean_km": distance / trips,
+            }
+
+
+class RideBuffer:
+    """
+    Ride columns streamed in id order alongside the events, only the rides
+    not yet passed by the event stream are kept.
+    """
+
+    def __init__(self, rows):
+        self.batches = batched(rows, RIDE_BATCH_SIZE)
+        # id_ride, id_driver, pickup_time, pickup lat/lng, dropoff lat/lng
+        self.rides = np.zeros((0, 7))
+        self.exhausted = False
+
+    def lookup(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Rows for sorted `ids` (plus a mask of the ones found), rides up to
+        the last id are dropped afterwards.
+        """
+        last = ids[-1]
+        while not self.exhausted and (not len(self.rides) or self.rides[-1, 0] < last):
+            batch = next(self.batches, None)
+            if batch is None:
+                self.exhausted = True
+            else:
+                self.rides = np.vstack([self.rides, np.array(batch, dtype=np.float64)])
+
+        positions = np.searchsorted(self.rides[:, 0], ids)
+        positions = np.minimum(positions, max(len(self.rides) - 1, 0))
+        found = (
+            self.rides[positions, 0] == ids if len(self.rides) else np.zeros(0, bool)
+        )
+        rows = self.rides[positions[found]]
+        self.rides = self.rides[np.searchsorted(self.rides[:, 0], last, "right") :]
+        return rows, found
+
+
+def pair_trips(events: np.ndarray):
+    """
+    `(id_ride, kind, created_at)` rows of complete rides, ordered by ride and
+    time -> sorted ride ids with their first pickup and last dropoff times.
+    """
+    ids, kinds, times = events[:, 0], events[:, 1], events[:, 2]
+
+    pickups = kinds == PICKUP
+    pickup_ids, first = np.unique(ids[pickups], return_index=True)
+    pickup_at = times[pickups][first]
+
+    dropoffs = kinds == DROPOFF
+    dropoff_ids, last = np.unique(ids[dropoffs][::-1], return_index=True)
+    dropoff_at = times[dropoffs][::-1][last]
+
+    trip_ids, p, d = np.intersect1d(
+        pickup_ids, dropoff_ids, assume_unique=True, return_indices=True
+    )
+    start, end = pickup_at[p], dropoff_at[d]
+    valid = end > start
+    return trip_ids[valid], start[valid], end[valid]
+
+
+def compute_trip_metrics(
+    batch_size: int = EVENT_BATCH_SIZE,
+    using: str = DEFAULT_DB_ALIAS,
+    metrics: TripMetrics | None = None,
+) -> TripMetrics:
+    """
+    The trips on one database (shard), added to `metrics` if given.
+    """
+    metrics = metrics if metrics is not None else TripMetrics()
+    connection = connections[using]
+
+    # no WITH HOLD cursors (which Postgres materializes in full) inside a
+    # transaction, and a fresh one can give both cursors the same snapshot
+    fresh_transaction = not connection.in_atomic_block
+    with transaction.atomic(using=using):
+        if fresh_transaction:
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+        events = (
+            RideEvent.objects.using(using)
+            .filter(
+                description__in=[
+                    RideEventType.STATUS_PICKUP,
+                    RideEventType.STATUS_DROPOFF,
+                ]
+            )
+            .annotate(
+                kind=Case(
+                    When(description=RideEventType.STATUS_PICKUP, then=Value(PICKUP)),
+                    default=Value(DROPOFF),
+                    output_field=IntegerField(),
+                ),
+                at=_epoch("created_at"),
+            )
+            .order_by("id_ride", "created_at")
+            .values_list("id_ride", "kind", "at")
+            .iterator(chunk_size=batch_size)
+        )
+        events = merge(
+            events,
+            _timeline_events(connection, batch_size),
+            key=lambda row: (row[0], row[2]),
+        )
+        rides = RideBuffer(
+            Ride.objects.using(using)
+            .annotate(scheduled_at=_epoch("pickup_time"))
+            .order_by("id_ride")
+            .values_list(
+                "id_ride",
+                "id_driver",
+                "scheduled_at",
+                "pickup_latitude",
+                "pickup_longitude",
+                "dropoff_latitude",
+                "dropoff_longitude",
+            )
+            .iterator(chunk_size=RIDE_BATCH_SIZE)
+        )
+
+        carry = np.zeros((0, 3))
+        for batch in batched(events, batch_size):
+            rows = np.vstack([carry, np.array(batch, dtype=np.float64)])
+            # the last ride may continue in the next batch
+            split = np.searchsorted(rows[:, 0], rows[-1, 0])
+            carry, rows = rows[split:], rows[:split]
+            if len(rows):
+                _add_trips(metrics, rides, rows)
+        if len(carry):
+            _add_trips(metrics, rides, carry)
+
+    return metrics
+
+
+def _timeline_events(connection, batch_size: int):
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(
+            TIMELINE_TRIP_EVENTS,
+            {
+                "pickup": RideEventType.STATUS_PICKUP,
+                "dropoff": RideEventType.STATUS_DROPOFF,
+                "pickup_kind": PICKUP,
+                "dropoff_kind": DROPOFF,
+            },
+        )
+        while rows := cursor.fetchmany(batch_size):
+            yield from rows
+
+
+def _add_trips(metrics: TripMetrics, rides: RideBuffer, events: np.ndarray):
+    trip_ids, pickup_at, dropoff_at = pair_trips(events)
+    if not len(trip_ids):
+        return
+
+    ride_rows, found = rides.lookup(trip_ids)
+    metrics.add(
+        drivers=ride_rows[:, 1].astype(np.int64),
+        pickup_at=pickup_at[found],
+        dropoff_at=dropoff_at[found],
+        scheduled_at=ride_rows[:, 2],
+        distances_km=haversine_km(*ride_rows[:, 3:7].T),
+    )
+
+
+def write_csv(path, results):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for row in results:
+            writer.writerow(
+                {k: round(v, 3) if isinstance(v, float) else v for k, v in row.items()}
+            )
+
+
+def write_npz(path, results):
+    """
+    One compressed array per column, loadable with `numpy.load()`.
+    """
+    rows = list(results)
+    np.savez_compressed(
+        path,
+        **{
+            name: np.array(
+                [row[name] for row in rows], dtype=NPZ_DTYPES.get(name, np.float64)
+            )
+            for name in COLUMNS
+        },
+    )
+
+
+WRITERS = {"csv": write_csv, "npz": write_npz}
+
+
+def driver_names(ids) -> dict[int, str]:
+    """
+    "First L", like the README's trip duration query.
+    """
+    from users.models import User  # avoid circular import
+
+    names = {}
+    for chunk in batched(sorted(ids), 10_000):
+        for id_user, first_name, last_name in User.objects.filter(
+            id_user__in=chunk
+        ).values_list("id_user", "first_name", "last_name"):
+            names[id_user] = f"{first_name} {last_name[:1]}".strip()
+    return names
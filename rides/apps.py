@@ -2,4 +2,4 @@ from django.apps import AppConfig
 
 
 class RidesConfig(AppConfig):
-    name = 'rides'
+    name = "rides"
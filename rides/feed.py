@@ -0,0 +1,231 @@
+"""
+Wake-ups for the ride event change feed.
+
+One background thread per process and shard LISTENs on `RIDE_EVENTS_CHANNEL`
+(a trigger on `rides_rideevent` NOTIFYs the newest id after every insert) and
+tracks the shard's latest settled event id (see `RideEventQuerySet.settled()`).
+Long-polling requests wait on a condition instead of querying, so an idle client
+costs no database work and Postgres only sees one LISTEN connection per process
+and shard. While committed events are held back behind a running transaction,
+the thread alone rechecks them, rather than every waiting request. If LISTEN
+isn't available (e.g. behind a transaction pooler) the thread falls back to
+polling `max(id_ride_event)` instead.
+
+Each shard hands out its own ids (see rides.sharding), so the feed's cursor is
+the last id seen on every shard, `parse_cursor()`/`format_cursor()`.
+"""
+
+import logging
+import threading
+
+import psycopg
+from django.db import DatabaseError, close_old_connections, connections
+from django.db.models import Max
+
+from .sharding import shard_aliases
+
+logger = logging.getLogger(__name__)
+
+RIDE_EVENTS_CHANNEL = "ride_events"
+POLL_INTERVAL_SECONDS = 2.0
+# how often the notifier rechecks committed events that are held back behind a
+# transaction still running
+SETTLE_RETRY_SECONDS = 0.1
+
+
+def parse_cursor(value: str) -> dict[str, int]:
+    """
+    {shard alias: last id seen} from a feed cursor: one id per shard, in
+    `shard_aliases()` order, joined by ".". A single id applies to every shard
+    (the cursor of an unsharded setup). Raises ValueError for anything else.
+    """
+    aliases = shard_aliases()
+    ids = [int(part) for part in value.split(".")]
+    if len(ids) == 1:
+        ids *= len(aliases)
+    if len(ids) != len(aliases) or min(ids) < 0:
+        raise ValueError(f"Not a cursor for {len(aliases)} shards: {value!r}")
+    return dict(zip(aliases, ids))
+
+
+def format_cursor(cursor: dict[str, int]) -> int | str:
+    ids = [cursor[alias] for alias in shard_aliases()]
+    return ids[0] if len(ids) == 1 else ".".join(map(str, ids))
+
+
+class RideEventNotifier:
+    def __init__(self, poll_interval: float = POLL_INTERVAL_SECONDS):
+        self.poll_interval = poll_interval
+        # shard alias -> latest settled id, missing while unknown
+        self.latest_ids: dict[str, int] = {}
+        # shard alias -> latest committed id, only read by the shard's thread
+        self._committed_ids: dict[str, int] = {}
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._threads: dict[str, threading.Thread] = {}
+
+    def start(self):
+        with self._condition:
+            self._stop.clear()
+            for alias in shard_aliases():
+                thread = self._threads.get(alias)
+                if thread and thread.is_alive():
+                    continue
+                self._threads[alias] = thread = threading.Thread(
+                    target=self._run,
+                    args=(alias, dict(connections[alias].settings_dict)),
+                    name=f"ride-event-notifier-{alias}",
+                    daemon=True,
+                )
+                thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads.values():
+            thread.join()
+        self._threads = {}
+
+    def publish(self, alias: str, id_ride_event: int):
+        with self._condition:
+            latest = self.latest_ids.get(alias)
+            if latest is None or id_ride_event > latest:
+                self.latest_ids[alias] = id_ride_event
+                self._condition.notify_all()
+
+    def shards_with_events_after(self, cursor: dict[str, int]) -> list[str]:
+        """
+        The shards that may have events after their id in `cursor`: all but
+        those we know have nothing newer, unknown counts as newer.
+        """
+        return [
+            alias
+            for alias, id_ride_event in cursor.items()
+            if self.latest_ids.get(alias) is None
+            or self.latest_ids[alias] > id_ride_event
+        ]
+
+    def has_events_after(self, cursor: dict[str, int]) -> bool:
+        return bool(self.shards_with_events_after(cursor))
+
+    def settled_cursor(self, cursor: dict[str, int]) -> dict[str, int]:
+        """
+        `cursor` moved up to the latest settled ids known so far.
+        """
+        return {
+            alias: max(id_ride_event, self.latest_ids.get(alias, id_ride_event))
+            for alias, id_ride_event in cursor.items()
+        }
+
+    def wait_for_events_after(self, cursor: dict[str, int], timeout: float) -> bool:
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: any(
+                    self.latest_ids.get(alias, -1) > id_ride_event
+                    for alias, id_ride_event in cursor.items()
+                ),
+                timeout=timeout,
+            )
+
+    def _run(self, alias: str, settings_dict: dict):
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._listen(alias, settings_dict)
+                except (psycopg.Error, DatabaseError):
+                    logger.warning(
+                        "LISTEN %s on %s failed, polling instead",
+                        RIDE_EVENTS_CHANNEL,
+                        alias,
+                        exc_info=True,
+                    )
+                    self._poll(alias)
+        finally:
+            # this thread's Django connection, used by _publish_max_id()
+            connections[alias].close()
+
+    def _listen(self, alias: str, settings_dict: dict):
+        with psycopg.connect(
+            dbname=settings_dict["NAME"],
+            user=settings_dict["USER"],
+            password=settings_dict["PASSWORD"],
+            host=settings_dict["HOST"],
+            port=settings_dict["PORT"],
+            autocommit=True,
+        ) as conn:
+            conn.execute(f"LISTEN {RIDE_EVENTS_CHANNEL}")
+            # catch up on anything inserted before LISTEN took effect
+            self._publish_max_id(alias)
+
+            while not self._stop.is_set():
+                # the first notification settles right away, held back events
+                # are rechecked every SETTLE_RETRY_SECONDS
+                unsettled = self._unsettled(alias)
+                for notify in conn.notifies(
+                    timeout=SETTLE_RETRY_SECONDS if unsettled else self.poll_interval,
+                    stop_after=None if unsettled else 1,
+                ):
+                    if notify.payload:
+                        self._commit(alias, int(notify.payload))
+                if self._unsettled(alias):
+                    try:
+                        self._settle(alias)
+                    except DatabaseError:
+                        logger.exception(
+                            "Settling %s on %s failed", RIDE_EVENTS_CHANNEL, alias
+                        )
+
+    def _poll(self, alias: str):
+        while not self._stop.is_set():
+            try:
+                self._publish_max_id(alias)
+            except Exception:
+                logger.exception("Polling %s on %s failed", RIDE_EVENTS_CHANNEL, alias)
+            self._stop.wait(
+                SETTLE_RETRY_SECONDS if self._unsettled(alias) else self.poll_interval
+            )
+
+    def _commit(self, alias: str, id_ride_event: int):
+        if id_ride_event > self._committed_ids.get(alias, -1):
+            self._committed_ids[alias] = id_ride_event
+
+    def _unsettled(self, alias: str) -> bool:
+        return self._committed_ids.get(alias, -1) > self.latest_ids.get(alias, -1)
+
+    def _publish_max_id(self, alias: str):
+        from .models import RideEvent  # avoid circular import
+
+        close_old_connections()
+        latest_id = RideEvent.objects.using(alias).aggregate(
+            latest=Max("id_ride_event")
+        )["latest"]
+        if latest_id is not None:
+            self._commit(alias, latest_id)
+        if self._unsettled(alias):
+            self._settle(alias)
+
+    def _settle(self, alias: str):
+        """
+        Publish the latest settled id among the events committed since the last
+        one.
+        """
+        from .models import RideEvent  # avoid circular import
+
+        close_old_connections()
+        events = RideEvent.objects.using(alias)
+        settled_id = (
+            events.filter(id_ride_event__gt=self.latest_ids.get(alias, 0))
+            .settled()
+            .aggregate(latest=Max("id_ride_event"))["latest"]
+        )
+        if settled_id is not None:
+            self.publish(alias, settled_id)
+        latest_id = self.latest_ids.get(alias, -1)
+        if (
+            self._unsettled(alias)
+            and not events.filter(id_ride_event__gt=latest_id).exists()
+        ):
+            # the held back events are gone (e.g. compacted), nothing to wait for
+            self._committed_ids[alias] = latest_id
+
+
+ride_event_notifier = RideEventNotifier()
@@ -0,0 +1,135 @@
+"""
+Pickup density tiles (slippy map z/x/y, Web Mercator).
+
+Pickup coordinates inside a tile are streamed from a server-side cursor and
+binned with NumPy a chunk at a time. Finished tiles are cached; every cached
+tile key embeds the tile's version, which is bumped (at every zoom level) when a
+ride is created, moved or changes status inside it.
+"""
+
+import math
+import time
+from itertools import batched
+
+import numpy as np
+from django.core.cache import cache
+
+MAX_ZOOM = 18
+BINS_PER_SIDE = 64
+STREAM_CHUNK_SIZE = 10_000
+TILE_CACHE_TIMEOUT = 60 * 10
+
+# Web Mercator can't represent the poles
+MERCATOR_MAX_LATITUDE = 85.0511287798
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """
+    (south, west, north, east) of a tile, in degrees.
+    """
+    n = 2**z
+
+    def latitude(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return latitude(y + 1), x / n * 360 - 180, latitude(y), (x + 1) / n * 360 - 180
+
+
+def tile_for_point(z: int, latitude: float, longitude: float) -> tuple[int, int]:
+    n = 2**z
+    latitude = max(min(latitude, MERCATOR_MAX_LATITUDE), -MERCATOR_MAX_LATITUDE)
+    x = (longitude + 180) / 360 * n
+    y = (1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * n
+    return min(int(x), n - 1), min(int(y), n - 1)
+
+
+def bin_points(z: int, x: int, y: int, points: np.ndarray) -> np.ndarray:
+    """
+    Flat per-bin counts (row-major, BINS_PER_SIDE^2) for `(latitude, longitude)`
+    rows that fall inside the tile.
+    """
+    n = 2**z
+    latitudes = np.radians(
+        np.clip(points[:, 0], -MERCATOR_MAX_LATITUDE, MERCATOR_MAX_LATITUDE)
+    )
+    tile_x = (points[:, 1] + 180) / 360 * n - x
+    tile_y = (1 - np.arcsinh(np.tan(latitudes)) / np.pi) / 2 * n - y
+
+    bin_x = np.clip((tile_x * BINS_PER_SIDE).astype(np.int64), 0, BINS_PER_SIDE - 1)
+    bin_y = np.clip((tile_y * BINS_PER_SIDE).astype(np.int64), 0, BINS_PER_SIDE - 1)
+    return np.bincount(
+        bin_y * BINS_PER_SIDE + bin_x, minlength=BINS_PER_SIDE * BINS_PER_SIDE
+    )
+
+
+def compute_tile(querysets, z: int, x: int, y: int) -> dict:
+    """
+    Binned pickups of the rides in `querysets` (one per shard) inside the tile.
+    """
+    south, west, north, east = tile_bounds(z, x, y)
+    counts = np.zeros(BINS_PER_SIDE * BINS_PER_SIDE, dtype=np.int64)
+
+    for queryset in querysets:
+        rows = (
+            queryset.filter(
+                pickup_latitude__gte=south,
+                pickup_latitude__lt=north,
+                pickup_longitude__gte=west,
+                pickup_longitude__lt=east,
+            )
+            .order_by()
+            .values_list("pickup_latitude", "pickup_longitude")
+            .iterator(chunk_size=STREAM_CHUNK_SIZE)
+        )
+        for chunk in batched(rows, STREAM_CHUNK_SIZE):
+            counts += bin_points(z, x, y, np.array(chunk, dtype=np.float64))
+
+    (nonzero,) = np.nonzero(counts)
+    return {
+        "z": z,
+        "x": x,
+        "y": y,
+        "bins": BINS_PER_SIDE,
+        "total": int(counts.sum()),
+        # sparse [bin_x, bin_y, count], bin (0, 0) is the tile's north-west corner
+        "counts": [
+            [int(i % BINS_PER_SIDE), int(i // BINS_PER_SIDE), int(counts[i])]
+            for i in nonzero
+        ],
+    }
+
+
+def tile_version_key(z: int, x: int, y: int) -> str:
+    return f"heatmap:version:{z}:{x}:{y}"
+
+
+def get_tile(querysets, z: int, x: int, y: int, filters: dict) -> dict:
+    """
+    Cached `compute_tile()`, `filters` must describe `querysets` for the cache
+    key.
+    """
+    version = cache.get(tile_version_key(z, x, y), 0)
+    filter_key = ":".join(f"{k}={filters[k]}" for k in sorted(filters))
+    key = f"heatmap:tile:{z}:{x}:{y}:{version}:{filter_key}"
+
+    tile = cache.get(key)
+    if tile is None:
+        tile = compute_tile(querysets, z, x, y)
+        cache.set(key, tile, TILE_CACHE_TIMEOUT)
+    return tile
+
+
+def invalidate_points(points):
+    """
+    Bump the version of every tile (at every zoom) containing these
+    `(latitude, longitude)` points.
+    """
+    version = time.time_ns()
+    cache.set_many(
+        {
+            tile_version_key(z, *tile_for_point(z, latitude, longitude)): version
+            for latitude, longitude in points
+            for z in range(MAX_ZOOM + 1)
+        },
+        timeout=None,
+    )
@@ -0,0 +1,206 @@
+"""
+Buffered RideEvent ingestion for `POST /api/ride-events/batch/`.
+
+Accepted events wait in process memory and are written together: a single
+INSERT ... SELECT over the events passed as arrays (unnest) that skips
+idempotency keys already stored for the ride (ON CONFLICT DO NOTHING) and
+events of rides deleted since they were accepted. A background thread flushes the buffer every
+`FLUSH_INTERVAL_SECONDS`, or as soon as it holds `FLUSH_SIZE` events, and the
+buffer is flushed one last time at interpreter exit.
+
+Delivery: an accepted event is written unless the process dies without running
+its exit handlers (SIGKILL, OOM kill, a crash), which loses at most the events
+of the last flush interval. Clients that retry with the same idempotency key
+can't create duplicates.
+"""
+
+import atexit
+import logging
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
+
+from .ride_cache import invalidate_rides
+from .sharding import shard_for_ride_id
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = 5000
+FLUSH_INTERVAL_SECONDS = 1.0
+# new events are refused (503) past this, e.g. while the database is down
+MAX_BUFFERED_EVENTS = 100_000
+# how long exit waits for an in-progress flush
+SHUTDOWN_TIMEOUT_SECONDS = 10.0
+
+# one array per column, inserted in the order they were given
+INSERT_EVENTS = """
+INSERT INTO rides_rideevent (id_ride, description, created_at, idempotency_key)
+SELECT e.id_ride, e.description, e.created_at, e.idempotency_key
+FROM unnest(%s::integer[], %s::text[], %s::timestamptz[], %s::text[])
+    WITH ORDINALITY AS e (id_ride, description, created_at, idempotency_key, seq)
+JOIN rides_ride r ON r.id_ride = e.id_ride
+ORDER BY e.seq
+ON CONFLICT DO NOTHING
+RETURNING id_ride
+"""
+
+
+class BufferFull(Exception):
+    pass
+
+
+def write_events(events, using: str = DEFAULT_DB_ALIAS) -> list[int]:
+    """
+    Insert `(id_ride, description, created_at, idempotency_key)` rows, returns
+    the ride id of every row actually inserted.
+    """
+    # a single statement, no temporary table to create and drop per flush
+    columns = [list(column) for column in zip(*events)] or [[], [], [], []]
+    with connections[using].cursor() as cursor:
+        cursor.execute(INSERT_EVENTS, columns)
+        return [id_ride for (id_ride,) in cursor.fetchall()]
+
+
+class RideEventBuffer:
+    def __init__(
+        self,
+        flush_size: int = FLUSH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL_SECONDS,
+        max_buffered: int = MAX_BUFFERED_EVENTS,
+    ):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._lock = threading.Lock()
+        # one flush at a time, so retried rows keep their order
+        self._flush_lock = threading.Lock()
+        self._events: list[tuple] = []
+        self._keys: set[tuple[int, str]] = set()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._closed = False
+        self._atexit_registered = False
+
+    def __len__(self):
+        return len(self._events)
+
+    def start(self):
+        with self._lock:
+            if not self._atexit_registered:
+                atexit.register(self.close)
+                self._atexit_registered = True
+            if self._closed or (self._thread and self._thread.is_alive()):
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="ride-event-buffer", daemon=True
+            )
+            self._thread.start()
+
+    def add(self, events) -> tuple[int, int]:
+        """
+        Buffer `(id_ride, description, created_at, idempotency_key)` events,
+        dropping keys that are already buffered for the ride. Returns
+        (accepted, duplicates). Once closed, events are written before
+        returning instead.
+        """
+        self.start()
+        accepted = []
+        with self._lock:
+            if len(self._events) + len(events) > self.max_buffered:
+                raise BufferFull(
+                    f"{len(self._events)} ride events waiting to be written"
+                )
+            for event in events:
+                if event[3] is not None:
+                    # keys are unique per ride
+                    key = (event[0], event[3])
+                    if key in self._keys:
+                        continue
+                    self._keys.add(key)
+                accepted.append(event)
+            self._events.extend(accepted)
+            full = len(self._events) >= self.flush_size
+            closed = self._closed
+
+        if closed:
+            self.flush()
+        elif full:
+            self._wakeup.set()
+        return len(accepted), len(events) - len(accepted)
+
+    def flush(self) -> int:
+        """
+        Write everything buffered, returns how many rows were inserted. Failed
+        rows go back to the front of the buffer for the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+                self._keys = set()
+            if not events:
+                return 0
+
+            # by the ride's shard, see rides.sharding
+            pending = {}
+            for event in events:
+                pending.setdefault(shard_for_ride_id(event[0]), []).append(event)
+
+            ride_ids = []
+            try:
+                for alias in list(pending):
+                    ride_ids += write_events(pending[alias], using=alias)
+                    del pending[alias]
+            except Exception:
+                unwritten = [event for shard in pending.values() for event in shard]
+                with self._lock:
+                    self._events[:0] = unwritten
+                    self._keys |= {
+                        (event[0], event[3])
+                        for event in unwritten
+                        if event[3] is not None
+                    }
+                invalidate_rides(set(ride_ids))
+                raise
+
+        # what RideEvent.save() would do, for the rides' cached events
+        invalidate_rides(set(ride_ids))
+        return len(ride_ids)
+
+    def close(self):
+        """
+        Stop the flusher and write what's left. Runs at interpreter exit.
+        """
+        with self._lock:
+            self._closed = True
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(SHUTDOWN_TIMEOUT_SECONDS)
+            self._thread = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Lost %d buffered ride events at shutdown", len(self))
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                if not self._events:
+                    continue
+                try:
+                    close_old_connections()
+                    self.flush()
+                except Exception:
+                    logger.exception(
+                        "Writing %d ride events failed, retrying", len(self)
+                    )
+                    self._stop.wait(self.flush_interval)
+        finally:
+            connections.close_all()
+
+
+ride_event_buffer = RideEventBuffer()
@@ -0,0 +1,309 @@
+"""
+In-memory store for live driver locations.
+
+Pings only touch process memory (a dict of latest positions plus a coarse grid
+index for nearest lookups). Every `SYNC_INTERVAL_SECONDS` a background thread
+(`start()`) upserts the changed positions into `DriverLocation` and reads back
+the rows other processes flushed since, so each process sees every driver
+within a couple of intervals. What's left is flushed at interpreter exit.
+"""
+
+import atexit
+import logging
+import math
+import threading
+import time
+from datetime import UTC, datetime
+
+from django.db import close_old_connections, connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .sharding import shard_aliases
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+# ~1.1km per cell at the equator
+GRID_CELL_DEGREES = 0.01
+SYNC_INTERVAL_SECONDS = 1.0
+# pings older than this don't count as "available"
+STALE_AFTER_SECONDS = 120.0
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    # min(): rounding can push nearly antipodal points just past 1
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def grid_cell(latitude: float, longitude: float) -> tuple[int, int]:
+    return (
+        math.floor(latitude / GRID_CELL_DEGREES),
+        math.floor(longitude / GRID_CELL_DEGREES),
+    )
+
+
+class DriverLocationStore:
+    def __init__(self, sync_interval: float = SYNC_INTERVAL_SECONDS):
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        # id_driver -> (latitude, longitude, timestamp)
+        self._positions: dict[int, tuple[float, float, float]] = {}
+        self._cells: dict[tuple[int, int], set[int]] = {}
+        self._driver_cells: dict[int, tuple[int, int]] = {}
+        self._dirty: set[int] = set()
+        self._loaded = False
+        # latest (`flushed_at`, id_driver) read back from DriverLocation
+        self._synced_until: tuple[datetime, int] | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._atexit_registered = False
+
+    def __len__(self):
+        return len(self._positions)
+
+    def start(self):
+        with self._lock:
+            if not self._atexit_registered:
+                atexit.register(self.close)
+                self._atexit_registered = True
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="driver-locations", daemon=True
+            )
+            self._thread.start()
+
+    def close(self):
+        """
+        Stop syncing and flush what's left. Runs at interpreter exit.
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Lost %d driver positions at shutdown", len(self._dirty))
+
+    def ingest(self, pings) -> int:
+        """
+        Record `(id_driver, latitude, longitude, timestamp)` pings, ignoring
+        pings older than the driver's current position. Returns how many were
+        applied.
+        """
+        with self._lock:
+            return self._apply(pings, mark_dirty=True)
+
+    def _apply(self, pings, mark_dirty: bool) -> int:
+        applied = 0
+        positions = self._positions
+        cells = self._cells
+        driver_cells = self._driver_cells
+        dirty = self._dirty
+
+        for id_driver, latitude, longitude, timestamp in pings:
+            current = positions.get(id_driver)
+            if current is not None and current[2] > timestamp:
+                continue
+
+            positions[id_driver] = (latitude, longitude, timestamp)
+            cell = grid_cell(latitude, longitude)
+            previous_cell = driver_cells.get(id_driver)
+            if previous_cell != cell:
+                if previous_cell is not None:
+                    cells[previous_cell].discard(id_driver)
+                cells.setdefault(cell, set()).add(id_driver)
+                driver_cells[id_driver] = cell
+            if mark_dirty:
+                dirty.add(id_driver)
+            applied += 1
+
+        return applied
+
+    def get(self, id_driver: int) -> tuple[float, float, float] | None:
+        return self._positions.get(id_driver)
+
+    def tracks(self, id_driver: int) -> bool:
+        return id_driver in self._positions
+
+    def nearby(
+        self, latitude: float, longitude: float, radius_km: float
+    ) -> list[tuple[float, int]]:
+        """
+        (distance_km, id_driver) for fresh positions within `radius_km` of the
+        point, closest first.
+        """
+        self.ensure_loaded()
+        min_timestamp = time.time() - STALE_AFTER_SECONDS
+
+        cell_km = KM_PER_DEGREE * GRID_CELL_DEGREES
+        # cells get narrower away from the equator, size the scan by the narrowest
+        narrowest = max(math.cos(math.radians(abs(latitude) + GRID_CELL_DEGREES)), 0.01)
+        row_rings = math.ceil(radius_km / cell_km)
+        col_rings = math.ceil(radius_km / (cell_km * narrowest))
+        row, col = grid_cell(latitude, longitude)
+
+        found = []
+        with self._lock:
+            for r in range(row - row_rings, row + row_rings + 1):
+                for c in range(col - col_rings, col + col_rings + 1):
+                    for id_driver in self._cells.get((r, c), ()):
+                        lat, lng, timestamp = self._positions[id_driver]
+                        if timestamp < min_timestamp:
+                            continue
+                        distance = haversine_km(latitude, longitude, lat, lng)
+                        if distance <= radius_km:
+                            found.append((distance, id_driver))
+        found.sort()
+        return found
+
+    def nearest_available(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_km: float,
+        limit: int,
+        batch_size: int = 100,
+    ) -> list[tuple[float, int]]:
+        """
+        Closest tracked drivers without an active ride. Candidates come from the
+        grid, busy drivers are filtered out one batch at a time.
+        """
+        from .models import Ride  # avoid circular import
+
+        candidates = self.nearby(latitude, longitude, radius_km)
+
+        available = []
+        for start in range(0, len(candidates), batch_size):
+            batch = candidates[start : start + batch_size]
+            busy = {
+                id_driver
+                for alias in shard_aliases()
+                for id_driver in Ride.objects.using(alias)
+                .active()
+                .filter(id_driver__in=[id_driver for _, id_driver in batch])
+                .values_list("id_driver", flat=True)
+            }
+            available.extend(c for c in batch if c[1] not in busy)
+            if len(available) >= limit:
+                break
+        return available[:limit]
+
+    def flush(self) -> int:
+        """
+        Upsert the positions changed since the last flush into `DriverLocation`.
+        """
+        from .models import DriverLocation  # avoid circular import
+
+        flushed_at = timezone.now()
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = [
+                DriverLocation(
+                    id_driver_id=id_driver,
+                    latitude=self._positions[id_driver][0],
+                    longitude=self._positions[id_driver][1],
+                    updated_at=datetime.fromtimestamp(
+                        self._positions[id_driver][2], tz=UTC
+                    ),
+                    flushed_at=flushed_at,
+                )
+                for id_driver in dirty
+                if id_driver in self._positions
+            ]
+
+        if rows:
+            try:
+                DriverLocation.objects.bulk_create(
+                    rows,
+                    batch_size=1000,
+                    update_conflicts=True,
+                    unique_fields=["id_driver"],
+                    update_fields=["latitude", "longitude", "updated_at", "flushed_at"],
+                )
+            except Exception:
+                # keep them for the next flush
+                with self._lock:
+                    self._dirty |= dirty
+                raise
+        return len(rows)
+
+    def ensure_loaded(self):
+        """
+        Warm a fresh process from the last flushed positions.
+        """
+        if self._loaded:
+            return
+        self.refresh()
+        # not before, a failed load is retried by the next caller
+        self._loaded = True
+
+    def refresh(self) -> int:
+        """
+        Read back the fresh positions flushed since the last refresh, by this
+        process or any other. Returns how many were applied.
+        """
+        from .models import DriverLocation  # avoid circular import
+
+        cutoff = datetime.fromtimestamp(time.time() - STALE_AFTER_SECONDS, tz=UTC)
+        rows = DriverLocation.objects.filter(updated_at__gte=cutoff)
+        if self._synced_until is not None:
+            # `flushed_at` is stamped before the upsert commits, a flush still
+            # in flight past this is read back with the driver's next one
+            flushed_at, id_driver = self._synced_until
+            rows = rows.filter(
+                Q(flushed_at__gt=flushed_at)
+                | Q(flushed_at=flushed_at, id_driver__gt=id_driver)
+            )
+        rows = list(
+            rows.values_list(
+                "id_driver", "latitude", "longitude", "updated_at", "flushed_at"
+            )
+        )
+        if not rows:
+            return 0
+        pings = [(i, lat, lng, ts.timestamp()) for i, lat, lng, ts, _ in rows]
+        with self._lock:
+            # already persisted, nothing to flush
+            applied = self._apply(pings, mark_dirty=False)
+            synced_until = max((row[4], row[0]) for row in rows)
+            if self._synced_until is None or synced_until > self._synced_until:
+                self._synced_until = synced_until
+        return applied
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.sync_interval):
+                try:
+                    close_old_connections()
+                    self.flush()
+                    self.refresh()
+                except Exception:
+                    logger.exception(
+                        "Syncing driver locations failed, %d positions waiting",
+                        len(self._dirty),
+                    )
+        finally:
+            connections.close_all()
+
+    def clear(self):
+        with self._lock:
+            self._positions.clear()
+            self._cells.clear()
+            self._driver_cells.clear()
+            self._dirty.clear()
+            self._loaded = False
+            self._synced_until = None
+
+
+driver_locations = DriverLocationStore()
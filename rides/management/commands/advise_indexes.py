@@ -0,0 +1,351 @@
+import itertools
+import json
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+from django.db.migrations import Migration
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.operations import AddIndex
+from django.db.migrations.writer import MigrationWriter
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIRequestFactory
+
+from rides.models import Ride, RideEvent, RideStatus
+from rides.serializers import RideQueryParamsSerializer
+from rides.views import RideViewSet
+
+# equality filters -> the ride column they end up filtering on
+FILTER_COLUMNS = {
+    "status": "status",
+    "rider_email": "id_rider",
+}
+
+# the correlated subquery behind ordering=pickup_time
+PICKUP_EVENT_INDEX = (RideEvent, ("id_ride", "description", "created_at"))
+
+
+class Rollback(Exception):
+    pass
+
+
+@dataclass
+class PlanSummary:
+    execution_ms: float
+    seq_scans: list[str] = field(default_factory=list)
+    sorts: list[str] = field(default_factory=list)
+
+
+@dataclass
+class WorkloadQuery:
+    params: dict
+    queryset: models.QuerySet
+    plan: PlanSummary | None = None
+    candidates: list[tuple[type[models.Model], tuple[str, ...]]] = field(
+        default_factory=list
+    )
+
+    @property
+    def label(self) -> str:
+        return "&".join(f"{k}={v}" for k, v in self.params.items()) or "(no params)"
+
+
+def summarize_plan(raw: str) -> PlanSummary:
+    plan = json.loads(raw)[0]
+    summary = PlanSummary(execution_ms=plan.get("Execution Time", 0.0))
+
+    def walk(node):
+        node_type = node["Node Type"]
+        if node_type == "Seq Scan":
+            summary.seq_scans.append(node["Relation Name"])
+        elif node_type in ("Sort", "Incremental Sort"):
+            summary.sorts.append(", ".join(node.get("Sort Key", [])))
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan["Plan"])
+    return summary
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay ride list filter/ordering combinations, report sequential scans "
+        "and sorts, and propose composite indexes. With --allow-locking, each "
+        "candidate is built on the live table to time it, which blocks writes "
+        "to that table while it's built."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workload",
+            type=Path,
+            help=(
+                "File with one /api/rides/ query string per line "
+                "(e.g. status=pickup&ordering=-pickup_time). "
+                "Defaults to every status/rider_email/ordering combination."
+            ),
+        )
+        parser.add_argument(
+            "--page-size",
+            type=int,
+            default=10,
+            help="LIMIT used for the replayed page queries (default: 10)",
+        )
+        parser.add_argument(
+            "--min-gain",
+            type=float,
+            default=20.0,
+            help="Minimum %% improvement for a candidate to be kept (default: 20)",
+        )
+        parser.add_argument(
+            "--write",
+            action="store_true",
+            help="Write the kept candidates as a new rides migration "
+            "(requires --allow-locking)",
+        )
+        parser.add_argument(
+            "--allow-locking",
+            action="store_true",
+            help=(
+                "Time each candidate by building it (plain CREATE INDEX, rolled "
+                "back) on the live table. Writes to the table block until it's "
+                "built, run it against a copy of the database or off-peak. "
+                "Without it, candidates are only listed."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        self.page_size = options["page_size"]
+        if options["write"] and not options["allow_locking"]:
+            raise CommandError(
+                "--write keeps the candidates that timed well, which needs "
+                "--allow-locking"
+            )
+
+        workload = self._build_workload(options["workload"])
+        if not workload:
+            self.stdout.write(self.style.WARNING("No queries to replay"))
+            return
+
+        self.stdout.write(f"Replaying {len(workload)} queries...")
+        existing = self._existing_indexes()
+        for query in workload:
+            query.plan = self._explain(query.queryset)
+            query.candidates = [
+                candidate
+                for candidate in self._candidates_for(query)
+                if candidate[1] not in existing.get(candidate[0], set())
+            ]
+            self._report_query(query)
+
+        candidates = sorted(
+            {c for query in workload for c in query.candidates},
+            key=lambda c: (c[0]._meta.db_table, c[1]),
+        )
+        if not candidates:
+            self.stdout.write(self.style.SUCCESS("No missing indexes found"))
+            return
+
+        if not options["allow_locking"]:
+            self.stdout.write("\nCandidate indexes (not timed):")
+            for model, fields in candidates:
+                affected = [q for q in workload if (model, fields) in q.candidates]
+                self.stdout.write(
+                    f"  {model._meta.db_table}({', '.join(fields)}): "
+                    f"{len(affected)} queries"
+                )
+            self.stdout.write(
+                self.style.WARNING(
+                    "\nTiming them builds each index on the live table, blocking "
+                    "writes to it meanwhile. Re-run with --allow-locking (against "
+                    "a copy of the database, or off-peak) to time them and get a "
+                    "migration."
+                )
+            )
+            return
+
+        kept = []
+        self.stdout.write("\nCandidate indexes:")
+        for model, fields in candidates:
+            affected = [q for q in workload if (model, fields) in q.candidates]
+            before = sum(q.plan.execution_ms for q in affected)
+            after = self._time_with_index(model, fields, affected)
+            gain = (before - after) / before * 100 if before else 0.0
+
+            keep = gain >= options["min_gain"]
+            style = self.style.SUCCESS if keep else self.style.WARNING
+            self.stdout.write(
+                style(
+                    f"  {model._meta.db_table}({', '.join(fields)}): "
+                    f"{len(affected)} queries, {before:.2f}ms -> {after:.2f}ms "
+                    f"({gain:+.1f}%)"
+                )
+            )
+            if keep:
+                kept.append((model, fields))
+
+        if kept:
+            self._emit_migration(kept, write=options["write"])
+
+    def _build_workload(self, path: Path | None) -> list[WorkloadQuery]:
+        if path:
+            lines = path.read_text().splitlines()
+            combos = [dict(parse_qsl(line.strip().lstrip("?"))) for line in lines]
+            combos = [params for params in combos if params]
+        else:
+            combos = self._default_combos()
+
+        workload = []
+        for params in combos:
+            try:
+                queryset = self._viewset_queryset(params)
+            except ValidationError as e:
+                self.stderr.write(f"Skipping {params}: {e.detail}")
+                continue
+            workload.append(WorkloadQuery(params=params, queryset=queryset))
+        return workload
+
+    def _default_combos(self) -> list[dict]:
+        sample_email = (
+            Ride.objects.values_list("id_rider__email", flat=True).order_by().first()
+        )
+        sample_ride = Ride.objects.order_by().first()
+
+        statuses = [None, *RideStatus.values]
+        emails = [None, sample_email] if sample_email else [None]
+        orderings = [None] + [
+            value for value, _ in RideQueryParamsSerializer.ORDERING_CHOICES
+        ]
+
+        combos = []
+        for status, email, ordering in itertools.product(statuses, emails, orderings):
+            params = {"status": status, "rider_email": email, "ordering": ordering}
+            if ordering in ("distance", "-distance"):
+                if not sample_ride:
+                    continue
+                params["latitude"] = sample_ride.pickup_latitude
+                params["longitude"] = sample_ride.pickup_longitude
+            combos.append({k: v for k, v in params.items() if v is not None})
+        return combos
+
+    def _viewset_queryset(self, params: dict) -> models.QuerySet:
+        """
+        Build the queryset exactly as RideViewSet.list() would for these params.
+        """
+        request = APIRequestFactory().get("/api/rides/", params)
+
+        view = RideViewSet(action_map={"get": "list"}, format_kwarg=None, kwargs={})
+        view.request = view.initialize_request(request)
+        return view.get_queryset()
+
+    def _explain(self, queryset: models.QuerySet) -> PlanSummary:
+        return summarize_plan(
+            queryset[: self.page_size].explain(format="json", analyze=True)
+        )
+
+    def _candidates_for(self, query: WorkloadQuery):
+        candidates = []
+        plan = query.plan
+        ordering = query.params.get("ordering", "")
+
+        if RideEvent._meta.db_table in plan.seq_scans:
+            candidates.append(PICKUP_EVENT_INDEX)
+
+        if Ride._meta.db_table in plan.seq_scans or plan.sorts:
+            # most selective equality column first, then the order column
+            columns = [
+                FILTER_COLUMNS[param]
+                for param in ("rider_email", "status")
+                if param in query.params
+            ]
+            if not ordering:
+                columns.append("id_ride")
+            # pickup_time orders on the pickup event subquery and distance on
+            # request coordinates, no rides_ride index can serve either sort
+
+            if columns and columns != ["id_ride"]:
+                candidates.append((Ride, tuple(columns)))
+
+        return candidates
+
+    def _existing_indexes(self) -> dict[type[models.Model], set[tuple[str, ...]]]:
+        existing = {}
+        with connection.cursor() as cursor:
+            for model in (Ride, RideEvent):
+                constraints = connection.introspection.get_constraints(
+                    cursor, model._meta.db_table
+                )
+                columns_to_fields = {
+                    f.column: f.name for f in model._meta.concrete_fields
+                }
+                existing[model] = {
+                    tuple(columns_to_fields.get(c, c) for c in info["columns"])
+                    for info in constraints.values()
+                    if info["index"] or info["primary_key"]
+                }
+        return existing
+
+    def _build_index(self, model, fields: tuple[str, ...]) -> models.Index:
+        index = models.Index(fields=list(fields))
+        index.set_name_with_model(model)
+        return index
+
+    def _time_with_index(self, model, fields, queries: list[WorkloadQuery]) -> float:
+        """
+        Create the index inside a transaction, re-run the affected queries and
+        roll the index back. The CREATE INDEX holds a SHARE lock on the table
+        until the rollback, writes to it wait until then (--allow-locking).
+        """
+        total = 0.0
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    # CREATE INDEX refuses to run with deferred FK checks pending
+                    cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+                with connection.schema_editor(atomic=False) as schema_editor:
+                    schema_editor.add_index(model, self._build_index(model, fields))
+                with connection.cursor() as cursor:
+                    cursor.execute(f"ANALYZE {model._meta.db_table}")
+                for query in queries:
+                    total += self._explain(query.queryset.all()).execution_ms
+                raise Rollback
+        except Rollback:
+            pass
+        return total
+
+    def _report_query(self, query: WorkloadQuery):
+        plan = query.plan
+        self.stdout.write(f"  {query.label}: {plan.execution_ms:.2f}ms")
+        for relation, count in Counter(plan.seq_scans).items():
+            suffix = f" (x{count})" if count > 1 else ""
+            self.stdout.write(self.style.WARNING(f"    seq scan on {relation}{suffix}"))
+        for sort_key in plan.sorts:
+            self.stdout.write(self.style.WARNING(f"    sort on {sort_key}"))
+
+    def _emit_migration(self, kept, write: bool):
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        leaf = loader.graph.leaf_nodes("rides")[0]
+        number = MigrationAutodetector.parse_number(leaf[1]) + 1
+
+        migration = Migration(f"{number:04d}_advised_indexes", "rides")
+        migration.dependencies = [leaf]
+        migration.operations = [
+            AddIndex(model._meta.model_name, self._build_index(model, fields))
+            for model, fields in kept
+        ]
+
+        writer = MigrationWriter(migration)
+        if write:
+            Path(writer.path).write_text(writer.as_string())
+            self.stdout.write(self.style.SUCCESS(f"\nWrote {writer.path}"))
+            self.stdout.write(
+                "Add the same indexes to the models' Meta.indexes before running "
+                "makemigrations again."
+            )
+        else:
+            self.stdout.write(f"\nCandidate migration ({writer.filename}):\n")
+            self.stdout.write(writer.as_string())
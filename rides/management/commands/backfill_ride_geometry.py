@@ -0,0 +1,70 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from rides.sharding import shard_aliases
+
+# the next batch_size rides after the last id, touching the coordinates of
+# those without a distance fires the rides_ride_trip_geometry trigger
+BACKFILL = """
+WITH batch AS (
+    SELECT id_ride FROM rides_ride WHERE id_ride > %s ORDER BY id_ride LIMIT %s
+), backfilled AS (
+    UPDATE rides_ride SET pickup_latitude = pickup_latitude
+    FROM batch
+    WHERE rides_ride.id_ride = batch.id_ride AND distance_km IS NULL
+    RETURNING 1
+)
+SELECT (SELECT max(id_ride) FROM batch),
+       (SELECT count(*) FROM batch),
+       (SELECT count(*) FROM backfilled)
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill distance_km and the bbox columns of rides stored before they "
+        "existed. Runs in batches of consecutive rides, each its own transaction, so "
+        "only a batch's rows are locked at a time; safe to stop and re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10_000,
+            help="Rides per UPDATE (default: 10000)",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="Seconds to pause between batches (default: 0.1)",
+        )
+        parser.add_argument(
+            "--database",
+            help="Only this database alias (default: every ride shard)",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        for alias in [options["database"]] if options["database"] else shard_aliases():
+            # keyset batches, the ids are sparse on a shard
+            last_id, updated = 0, 0
+            started = time.perf_counter()
+            while True:
+                with connections[alias].cursor() as cursor:
+                    cursor.execute(BACKFILL, [last_id, batch_size])
+                    batch_last_id, batch_rows, backfilled = cursor.fetchone()
+                updated += backfilled
+                if batch_rows < batch_size:
+                    break
+                last_id = batch_last_id
+                if options["sleep"]:
+                    time.sleep(options["sleep"])
+
+            self.stdout.write(
+                f"{alias}: {updated} rides backfilled in "
+                f"{time.perf_counter() - started:.1f}s"
+            )
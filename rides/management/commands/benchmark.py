@@ -0,0 +1,472 @@
+import json
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+
+from rides.locations import DriverLocationStore
+from rides.models import Ride, RideEvent, RideEventType, RideStatus
+from rides.serializers import MAX_PINGS_PER_BATCH, LocationPingsField
+from rides.views import RideViewSet
+from users.models import User, UserRole
+
+
+class Rollback(Exception):
+    pass
+
+
+# time_ranges: rides stored in booking order, picked up at most two hours later,
+# with one event each stored in creation order
+INSERT_TIMELINE_RIDES = """
+INSERT INTO rides_ride (
+    status, id_rider, id_driver, pickup_latitude, pickup_longitude,
+    dropoff_latitude, dropoff_longitude, pickup_time
+)
+SELECT %(status)s, %(id_user)s, %(id_user)s, 40.7 + random() / 10,
+    -74.0 + random() / 10, 40.7 + random() / 10, -74.0 + random() / 10,
+    %(start)s + i * %(step)s + random() * interval '2 hours'
+FROM generate_series(1, %(rows)s) i
+"""
+INSERT_TIMELINE_EVENTS = """
+INSERT INTO rides_rideevent (id_ride, description, created_at)
+SELECT id_ride, %(description)s, pickup_time + interval '30 minutes'
+FROM rides_ride WHERE id_ride > %(after)s ORDER BY id_ride
+"""
+# ride_history: one busy user's rides, as rider of every one
+INSERT_HISTORY_RIDES = """
+INSERT INTO rides_ride (
+    status, id_rider, id_driver, pickup_latitude, pickup_longitude,
+    dropoff_latitude, dropoff_longitude, pickup_time
+)
+SELECT %(status)s, %(id_user)s, %(id_driver)s, 40.7, -74.0, 40.8, -74.1,
+    now() - random() * interval '3 years'
+FROM generate_series(1, %(rows)s)
+"""
+# what time_ranges extrapolates to
+EXTRAPOLATED_ROWS = 100_000_000
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark ride queries against synthetic data. "
+        "Everything created here is rolled back afterwards."
+    )
+
+    scenarios = {
+        "rider_email": "bench_rider_email",
+        "driver_locations": "bench_driver_locations",
+        "prepared_statements": "bench_prepared_statements",
+        "time_ranges": "bench_time_ranges",
+        "user_search": "bench_user_search",
+        "ride_history": "bench_ride_history",
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenario", choices=sorted(self.scenarios))
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=100_000,
+            help="Number of synthetic users to create (default: 100000)",
+        )
+        parser.add_argument(
+            "--rides",
+            type=int,
+            default=200_000,
+            help="Number of synthetic rides to create (default: 200000)",
+        )
+        parser.add_argument(
+            "--pings",
+            type=int,
+            default=500_000,
+            help="Number of location pings to ingest (default: 500000)",
+        )
+        parser.add_argument(
+            "--timeline-rows",
+            type=int,
+            default=1_000_000,
+            help=(
+                "Rides (and events) stored in time order for time_ranges, "
+                "best run with a small --rides (default: 1000000)"
+            ),
+        )
+        parser.add_argument(
+            "--history-rides",
+            type=int,
+            default=10_000,
+            help="Rides of the one rider ride_history pages through (default: 10000)",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=50,
+            help="Number of timed runs per variant (default: 50)",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        try:
+            with transaction.atomic():
+                self.stdout.write("Creating synthetic data...")
+                self.users, self.rides = self._create_fixtures(
+                    options["users"], options["rides"]
+                )
+                with connection.cursor() as cursor:
+                    cursor.execute("ANALYZE users_user")
+                    cursor.execute("ANALYZE rides_ride")
+
+                getattr(self, self.scenarios[options["scenario"]])()
+                raise Rollback
+        except Rollback:
+            pass
+
+    def timeit(self, label: str, fn, repeat: int | None = None) -> float:
+        repeat = repeat or self.options["repeat"]
+        fn()  # warm up
+
+        timings = []
+        cpu_start = time.process_time()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1000)
+        # this process only, i.e. without the database's share
+        cpu = (time.process_time() - cpu_start) * 1000 / repeat
+
+        median = statistics.median(timings)
+        p95 = statistics.quantiles(timings, n=20)[-1] if repeat > 1 else median
+        self.stdout.write(
+            f"  {label:<40} median {median:8.3f}ms  p95 {p95:8.3f}ms  cpu {cpu:8.3f}ms"
+        )
+        return median
+
+    def explain(self, label: str, queryset):
+        self.stdout.write(f"  {label} plan:")
+        for line in queryset.explain().splitlines():
+            self.stdout.write(f"    {line}")
+
+    def _create_fixtures(self, num_users: int, num_rides: int):
+        run_id = random.randint(0, 10**9)
+        users = User.objects.bulk_create(
+            [
+                User(
+                    username=f"bench_{run_id}_{i}",
+                    email=f"Bench.User{i}.{run_id}@Example.com",
+                    first_name="Bench",
+                    last_name=f"User{i}",
+                    role=UserRole.DRIVER if i % 10 == 0 else UserRole.RIDER,
+                    phone_number=f"+1555{i:07d}",
+                    password="!",
+                )
+                for i in range(num_users)
+            ],
+            batch_size=5000,
+        )
+
+        now = timezone.now()
+        rides = Ride.objects.bulk_create(
+            [
+                Ride(
+                    status=random.choice(RideStatus.values),
+                    id_rider=random.choice(users),
+                    id_driver=random.choice(users),
+                    pickup_latitude=random.uniform(-60, 60),
+                    pickup_longitude=random.uniform(-180, 180),
+                    dropoff_latitude=random.uniform(-60, 60),
+                    dropoff_longitude=random.uniform(-180, 180),
+                    pickup_time=now
+                    - timedelta(minutes=random.randint(0, 60 * 24 * 90)),
+                )
+                for _ in range(num_rides)
+            ],
+            batch_size=5000,
+        )
+        return users, rides
+
+    def bench_rider_email(self):
+        email = random.choice(self.users).email.upper()
+
+        legacy = Ride.objects.filter(id_rider__email__iexact=email)
+        self.explain("iexact join", legacy)
+        self.explain("resolved id_rider", Ride.objects.rider_email(email))
+
+        self.stdout.write(
+            f"rider_email ({len(self.users)} users, {len(self.rides)} rides):"
+        )
+        self.timeit("id_rider__email__iexact", lambda: list(legacy.all()))
+        self.timeit(
+            "rider_email() (cached id lookup)",
+            lambda: list(Ride.objects.rider_email(email)),
+        )
+
+    def bench_driver_locations(self):
+        drivers = [u.id_user for u in self.users if u.role == UserRole.DRIVER]
+        num_pings = self.options["pings"]
+        now = time.time()
+
+        # drivers wandering around a handful of cities
+        cities = [(37.7749, -122.4194), (34.0522, -118.2437), (40.7128, -74.0060)]
+        home = {d: random.choice(cities) for d in drivers}
+        payloads = []
+        for start in range(0, num_pings, MAX_PINGS_PER_BATCH):
+            batch = []
+            for i in range(start, min(start + MAX_PINGS_PER_BATCH, num_pings)):
+                id_driver = random.choice(drivers)
+                latitude, longitude = home[id_driver]
+                batch.append(
+                    {
+                        "id_driver": id_driver,
+                        "latitude": latitude + random.uniform(-0.1, 0.1),
+                        "longitude": longitude + random.uniform(-0.1, 0.1),
+                        "timestamp": now + i / num_pings,
+                    }
+                )
+            payloads.append(batch)
+
+        store = DriverLocationStore()
+        field = LocationPingsField()
+        start = time.perf_counter()
+        for payload in payloads:
+            store.ingest(field.to_internal_value(payload))
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f"driver_locations ({len(drivers)} drivers, {num_pings} pings):"
+        )
+        self.stdout.write(
+            f"  {'validate + ingest':<40} {num_pings / elapsed:>12,.0f} pings/s"
+        )
+
+        latitude, longitude = cities[0]
+        self.timeit(
+            "nearby() 5km, in-memory only",
+            lambda: store.nearby(latitude, longitude, radius_km=5),
+        )
+        self.timeit(
+            "nearest_available() 5km",
+            lambda: store.nearest_available(latitude, longitude, radius_km=5, limit=5),
+        )
+
+        start = time.perf_counter()
+        flushed = store.flush()
+        self.stdout.write(
+            f"  {'flush()':<40} {flushed} rows in "
+            f"{(time.perf_counter() - start) * 1000:.1f}ms"
+        )
+
+    def bench_prepared_statements(self):
+        factory = APIRequestFactory()
+        email = random.choice(self.users).email
+
+        def page(params):
+            view = RideViewSet(action_map={"get": "list"}, format_kwarg=None, kwargs={})
+            view.request = view.initialize_request(factory.get("/api/rides/", params))
+            return list(view.paginate_queryset(view.get_queryset()))
+
+        self.stdout.write(
+            f"prepared_statements ({len(self.rides)} rides, count + page + "
+            "events prefetch per request):"
+        )
+        for params in [
+            {},
+            {"status": RideStatus.EN_ROUTE},
+            {"rider_email": email},
+            {"ordering": "-pickup_time", "page": 5},
+            {"ordering": "distance", "latitude": 40.7, "longitude": -74.0},
+        ]:
+            view = RideViewSet(action_map={"get": "list"}, format_kwarg=None, kwargs={})
+            view.request = view.initialize_request(factory.get("/api/rides/", params))
+            plan = view.get_queryset()[:10].explain(summary=True)
+            planning = next(
+                line for line in plan.splitlines() if line.startswith("Planning")
+            )
+
+            self.stdout.write(f"  {params or 'no filters'} ({planning}):")
+            self.timeit("compiled per request", lambda: page(params))
+            with override_settings(RIDE_LIST_PREPARED_STATEMENTS=True):
+                self.timeit("prepared", lambda: page(params))
+
+    def bench_time_ranges(self):
+        rows = self.options["timeline_rows"]
+        span = timedelta(days=365)
+        start = timezone.now() - 2 * span
+        last_id = Ride.objects.order_by("-id_ride").values_list("id_ride", flat=True)[0]
+
+        self.stdout.write(f"Storing {rows} rides and events in time order...")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                INSERT_TIMELINE_RIDES,
+                {
+                    "status": RideStatus.DROPOFF,
+                    "id_user": self.users[0].id_user,
+                    "start": start,
+                    "step": span / rows,
+                    "rows": rows,
+                },
+            )
+            cursor.execute(
+                INSERT_TIMELINE_EVENTS,
+                {"description": RideEventType.STATUS_DROPOFF, "after": last_id},
+            )
+            # check the deferred foreign keys now, CREATE INDEX refuses to run
+            # with them pending
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            # what autosummarize leaves to autovacuum, which can't run in here
+            for index in ("ride_pickup_time_brin_idx", "rideevent_created_brin_idx"):
+                cursor.execute("SELECT brin_summarize_new_values(%s)", [index])
+            cursor.execute("ANALYZE rides_ride")
+            cursor.execute("ANALYZE rides_rideevent")
+
+        middle = start + span / 2
+        windows = [
+            ("1 hour", timedelta(hours=1)),
+            ("1 day", timedelta(days=1)),
+            ("1 week", timedelta(weeks=1)),
+            ("30 days", timedelta(days=30)),
+        ]
+        self.stdout.write(
+            f"time_ranges ({rows} rides/events over {span.days} days, 100M rows "
+            f"extrapolated at the same rate, i.e. the same rows per window):"
+        )
+        self._range_scans(
+            "pickup_time",
+            "rides_ride",
+            "ride_pickup_time_brin_idx",
+            lambda after, before: Ride.objects.pickup_between(after, before),
+            [(label, middle, middle + width) for label, width in windows],
+        )
+        self._range_scans(
+            "created_at",
+            "rides_rideevent",
+            "rideevent_created_brin_idx",
+            lambda after, before: RideEvent.objects.created_between(after, before),
+            [(label, middle, middle + width) for label, width in windows],
+        )
+
+    def _range_scans(self, column, table, brin_index, filtered, windows):
+        """
+        Scan cost of each window through the BRIN index and through a B-tree
+        built for comparison, measured and extrapolated to EXTRAPOLATED_ROWS.
+        """
+        btree_index = f"bench_{column}_btree"
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE INDEX {btree_index} ON {table} ({column})")
+            cursor.execute(
+                "SELECT reltuples, pg_relation_size(%s), pg_relation_size(%s) "
+                "FROM pg_class WHERE relname = %s",
+                [brin_index, btree_index, table],
+            )
+            table_rows, brin_size, btree_size = cursor.fetchone()
+
+        scale = EXTRAPOLATED_ROWS / table_rows
+        brin_pages = brin_size // 8192
+        self.stdout.write(
+            f"  {column}: BRIN {brin_size / 1024:,.0f} kB, B-tree "
+            f"{btree_size / 1024:,.0f} kB; at 100M rows BRIN "
+            f"{brin_size * scale / 1024**2:,.1f} MB, B-tree "
+            f"{btree_size * scale / 1024**2:,.0f} MB"
+        )
+        for label, after, before in windows:
+            queryset = filtered(after, before).values_list("pk", flat=True)
+            for name, other in [("BRIN", btree_index), ("B-tree", brin_index)]:
+                # the other index dropped for the duration of the savepoint
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.execute(f"DROP INDEX {other}")
+                    list(queryset.all())  # warm up, e.g. set hint bits
+                    plan = json.loads(
+                        queryset.explain(analyze=True, buffers=True, format="json")
+                    )[0]["Plan"]
+                    buffers = plan["Shared Hit Blocks"] + plan["Shared Read Blocks"]
+                    # a BRIN scan reads its whole index, which grows with the
+                    # table; the B-tree descent gains about a level per 100x
+                    extrapolated = (
+                        buffers + brin_pages * (scale - 1)
+                        if name == "BRIN"
+                        else buffers + 1
+                    )
+                    self.timeit(
+                        f"{label} {name:<6} {plan['Actual Rows']:>7} rows "
+                        f"{buffers:>6} buf (100M ~{extrapolated:,.0f})",
+                        lambda: list(queryset.all()),
+                        repeat=min(self.options["repeat"], 10),
+                    )
+                    transaction.set_rollback(True)
+
+    def bench_user_search(self):
+        user = random.choice(self.users)
+        terms = {
+            "name": user.last_name,
+            "misspelled name": f"{user.first_name} {user.last_name[:4]}r{user.last_name[4:]}",
+            "email fragment": user.email.split("@")[0][-12:],
+            "phone digits": user.phone_number[-7:],
+        }
+
+        self.stdout.write(f"user_search ({len(self.users)} users, first 100 matches):")
+        for label, term in terms.items():
+            # what the admin's search_fields ran
+            legacy = User.objects.filter(
+                Q(email__icontains=term)
+                | Q(first_name__icontains=term)
+                | Q(last_name__icontains=term)
+                | Q(phone_number__icontains=term)
+            ).values_list("pk", flat=True)[:100]
+
+            def search(term=term):
+                cache.clear()
+                return User.objects.search(term)
+
+            self.stdout.write(f"  {label} {term!r}: {len(search())} matches")
+            self.timeit("search_fields icontains", lambda: list(legacy.all()))
+            self.timeit("User.objects.search() (trigram)", search)
+
+    def bench_ride_history(self):
+        rider, driver = self.users[1], self.users[0]
+        num_rides = self.options["history_rides"]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                INSERT_HISTORY_RIDES,
+                {
+                    "status": RideStatus.DROPOFF,
+                    "id_user": rider.pk,
+                    "id_driver": driver.pk,
+                    "rows": num_rides,
+                },
+            )
+            cursor.execute("ANALYZE rides_ride")
+
+        history = Ride.objects.history("id_rider", rider.pk)
+        page_size = 10
+        self.stdout.write(
+            f"ride_history ({num_rides} rides of one rider among "
+            f"{len(self.rides)}, {page_size} per page):"
+        )
+        last_page = num_rides // page_size // 2
+        for page in (1, 10, last_page):
+            offset = (page - 1) * page_size
+            # what the admin proxy pages with
+            paged = history.only("id_ride", "pickup_time")[offset : offset + page_size]
+            # the cursor the previous page handed out
+            before = (
+                history.values_list("pickup_time", "id_ride")[offset - 1]
+                if offset
+                else None
+            )
+            keyset = Ride.objects.history("id_rider", rider.pk, before).only(
+                "id_ride", "pickup_time"
+            )[: page_size + 1]
+            if page == last_page:
+                self.explain("OFFSET", paged)
+                self.explain("keyset", keyset)
+
+            self.stdout.write(f"  page {page}:")
+            self.timeit("OFFSET paging", lambda paged=paged: list(paged.all()))
+            self.timeit("keyset cursor", lambda keyset=keyset: list(keyset.all()))
@@ -0,0 +1,126 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from rides.models import RideStatus
+from rides.sharding import shard_aliases
+
+# of the next batch_size rides after the last id, finished ones whose events
+# are all older than `before` have them moved into event_timeline (appended to
+# what an earlier run folded), oldest first
+COMPACT = """
+WITH batch AS (
+    SELECT id_ride FROM rides_ride
+    WHERE id_ride > %(after)s ORDER BY id_ride LIMIT %(limit)s
+), finished AS (
+    SELECT id_ride FROM rides_ride ride
+    WHERE id_ride IN (SELECT id_ride FROM batch) AND status = %(status)s
+        AND EXISTS (
+            SELECT 1 FROM rides_rideevent event WHERE event.id_ride = ride.id_ride
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM rides_rideevent event
+            WHERE event.id_ride = ride.id_ride AND event.created_at >= %(before)s
+        )
+    FOR UPDATE
+), deleted AS (
+    DELETE FROM rides_rideevent event USING finished
+    WHERE event.id_ride = finished.id_ride
+    RETURNING event.id_ride, event.id_ride_event, event.description, event.created_at
+), folded AS (
+    SELECT id_ride, jsonb_agg(
+        jsonb_build_array(id_ride_event, description, created_at)
+        ORDER BY created_at, id_ride_event
+    ) AS events
+    FROM deleted GROUP BY id_ride
+), compacted AS (
+    UPDATE rides_ride ride SET event_timeline = (
+        SELECT jsonb_agg(event ORDER BY (event ->> 2)::timestamptz, (event ->> 0)::int)
+        FROM jsonb_array_elements(
+            coalesce(ride.event_timeline, '[]'::jsonb) || folded.events
+        ) event
+    )
+    FROM folded WHERE ride.id_ride = folded.id_ride
+    RETURNING jsonb_array_length(folded.events) AS events
+)
+SELECT (SELECT max(id_ride) FROM batch),
+       (SELECT count(*) FROM batch),
+       (SELECT count(*) FROM compacted),
+       (SELECT coalesce(sum(events), 0) FROM compacted)
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold the events of finished (dropoff) rides into the ride's "
+        "event_timeline column and delete their RideEvent rows, once none of a "
+        "ride's events is newer than --older-than. Runs in batches of "
+        "consecutive rides, each its own transaction; safe to stop and re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=float,
+            default=24 * 7,
+            help=(
+                "Hours since a ride's newest event, leaves time for retried "
+                "batches and feed consumers to catch up (default: 168)"
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10_000,
+            help="Rides per batch (default: 10000)",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="Seconds to pause between batches (default: 0.1)",
+        )
+        parser.add_argument(
+            "--database",
+            help="Only this database alias (default: every ride shard)",
+        )
+
+    def handle(self, *args, **options):
+        if options["older_than"] < 0:
+            raise CommandError("--older-than can't be negative")
+
+        batch_size = options["batch_size"]
+        before = timezone.now() - timedelta(hours=options["older_than"])
+        for alias in [options["database"]] if options["database"] else shard_aliases():
+            # keyset batches, the ids are sparse on a shard
+            last_id = rides = events = 0
+            started = time.perf_counter()
+            while True:
+                with connections[alias].cursor() as cursor:
+                    cursor.execute(
+                        COMPACT,
+                        {
+                            "after": last_id,
+                            "limit": batch_size,
+                            "status": RideStatus.DROPOFF,
+                            "before": before,
+                        },
+                    )
+                    batch_last_id, batch_rows, batch_rides, batch_events = (
+                        cursor.fetchone()
+                    )
+                rides += batch_rides
+                events += batch_events
+                if batch_rows < batch_size:
+                    break
+                last_id = batch_last_id
+                if options["sleep"]:
+                    time.sleep(options["sleep"])
+
+            self.stdout.write(
+                f"{alias}: {events} events of {rides} rides compacted in "
+                f"{time.perf_counter() - started:.1f}s"
+            )
@@ -0,0 +1,381 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import urlencode, urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from rides.models import RideStatus
+from users.models import User, UserRole
+
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+TOKEN_PATH = "/api/token/"
+TOKEN_REFRESH_PATH = "/api/token/refresh/"
+RIDES_PATH = "/api/rides/"
+# well inside the 5 minute production access token lifetime
+TOKEN_REFRESH_INTERVAL_SECONDS = 240
+
+
+def _status(rng):
+    return {"status": rng.choice(RideStatus.values)}
+
+
+def _ordering(rng):
+    return {"ordering": rng.choice(["pickup_time", "-pickup_time"])}
+
+
+def _distance(rng):
+    return {
+        "ordering": rng.choice(["distance", "-distance"]),
+        "latitude": round(rng.uniform(40.5, 40.9), 4),
+        "longitude": round(rng.uniform(-74.2, -73.7), 4),
+    }
+
+
+def _page(rng):
+    # stays within the seed command's default 50 rides
+    return {"page_size": 10, "page": rng.randint(1, 5)}
+
+
+def _sparse(rng):
+    return {"fields": "id_ride,status,pickup_time", "page_size": rng.choice([50, 100])}
+
+
+def _rider_email(rng):
+    # seeded riders plus a miss
+    name = rng.choice(["alice", "bob", "carol", "nobody"])
+    return {"rider_email": f"{name}.rider@example.com"}
+
+
+# name -> (weight, query params)
+SCENARIOS = {
+    "list": (30, lambda rng: {}),
+    "status": (20, _status),
+    "pickup_time": (15, _ordering),
+    "distance": (10, _distance),
+    "pages": (10, _page),
+    "sparse_fields": (10, _sparse),
+    "rider_email": (5, _rider_email),
+}
+
+
+class HTTPConnection:
+    """
+    Minimal keep-alive HTTP/1.1 client, enough for JSON requests to a local
+    server without pulling in an async HTTP library.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(
+        self, method: str, path: str, headers: dict, body: bytes = b""
+    ) -> tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+
+        host = f"[{self.host}]" if ":" in self.host else self.host
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {host}:{self.port}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        if body:
+            lines.append(f"Content-Length: {len(body)}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by server")
+        status = int(status_line.split()[1])
+
+        response_headers = {}
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if "content-length" in response_headers:
+            data = await self.reader.readexactly(
+                int(response_headers["content-length"])
+            )
+        elif response_headers.get("transfer-encoding") == "chunked":
+            data = await self._read_chunked()
+        else:
+            data = await self.reader.read()
+            response_headers["connection"] = "close"
+
+        if response_headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, data
+
+    async def _read_chunked(self) -> bytes:
+        chunks = []
+        while size := int((await self.reader.readline()).split(b";")[0], 16):
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+        await self.reader.readline()
+        return b"".join(chunks)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        self.reader = self.writer = None
+
+
+def percentile(sorted_values: list[float], percent: float) -> float | None:
+    if not sorted_values:
+        return None
+    index = max(
+        0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1)
+    )
+    return sorted_values[index]
+
+
+def summarize(results: list[tuple[float, int | None]], elapsed: float) -> dict:
+    """
+    `results` are (latency, status) pairs, status None for connection errors.
+    """
+    latencies = sorted(latency for latency, _ in results)
+    statuses = Counter(str(status or "connection_error") for _, status in results)
+    errors = sum(1 for _, status in results if not status or status >= 400)
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "status_codes": dict(sorted(statuses.items())),
+        "error_rate": round(errors / len(results), 4) if results else 0.0,
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            name: round(value * 1000, 2) if value is not None else None
+            for name, value in (
+                ("p50", percentile(latencies, 50)),
+                ("p95", percentile(latencies, 95)),
+                ("p99", percentile(latencies, 99)),
+            )
+        },
+    }
+
+
+class LoadTest:
+    def __init__(self, host, port, credentials, rate, duration, concurrency, rng):
+        self.host = host
+        self.port = port
+        self.credentials = credentials
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.rng = rng
+        self.tokens: list[dict] = []
+        self.results: dict[str, list[tuple[float, int | None]]] = {}
+
+    async def run(self) -> dict:
+        self.connections = asyncio.Queue()
+        for _ in range(self.concurrency):
+            self.connections.put_nowait(HTTPConnection(self.host, self.port))
+
+        await self._login()
+        if not self.tokens:
+            raise CommandError("No user could log in, check --password")
+
+        refresher = asyncio.create_task(self._refresh_tokens())
+        started = time.perf_counter()
+        try:
+            await self._generate(started)
+        finally:
+            refresher.cancel()
+            while not self.connections.empty():
+                await self.connections.get_nowait().close()
+        elapsed = time.perf_counter() - started
+
+        report = {
+            "target_rps": self.rate,
+            "duration_s": round(elapsed, 2),
+            "concurrency": self.concurrency,
+            "total": summarize(
+                [r for name, rs in self.results.items() if name != "login" for r in rs],
+                elapsed,
+            ),
+            "scenarios": {
+                name: summarize(results, elapsed)
+                for name, results in sorted(self.results.items())
+            },
+        }
+        return report
+
+    async def _generate(self, started: float):
+        """
+        Open loop: requests are started on schedule whether or not earlier ones
+        finished, and latency is measured from the scheduled time, so a slow
+        server shows up as latency instead of silently lowering the rate.
+        """
+        names = list(SCENARIOS)
+        weights = [SCENARIOS[name][0] for name in names]
+        total = int(self.rate * self.duration)
+
+        tasks = []
+        for i in range(total):
+            scheduled = started + i / self.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            name = self.rng.choices(names, weights)[0]
+            params = SCENARIOS[name][1](self.rng)
+            path = f"{RIDES_PATH}?{urlencode(params)}" if params else RIDES_PATH
+            token = self.rng.choice(self.tokens)
+            tasks.append(
+                asyncio.create_task(
+                    self._timed(
+                        name,
+                        scheduled,
+                        "GET",
+                        path,
+                        {"Authorization": f"Bearer {token['access']}"},
+                    )
+                )
+            )
+        await asyncio.gather(*tasks)
+
+    async def _timed(self, name, scheduled, method, path, headers, body=b""):
+        connection = await self.connections.get()
+        try:
+            status, data = await connection.request(
+                method, path, {"Accept": "application/json", **headers}, body
+            )
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            await connection.close()
+            status, data = None, b""
+        finally:
+            self.connections.put_nowait(connection)
+
+        self.results.setdefault(name, []).append(
+            (time.perf_counter() - scheduled, status)
+        )
+        return status, data
+
+    async def _login(self):
+        async def login(username, password):
+            body = json.dumps({"username": username, "password": password}).encode()
+            status, data = await self._timed(
+                "login",
+                time.perf_counter(),
+                "POST",
+                TOKEN_PATH,
+                {"Content-Type": "application/json"},
+                body,
+            )
+            if status == 200:
+                self.tokens.append(json.loads(data))
+
+        await asyncio.gather(*(login(*c) for c in self.credentials))
+
+    async def _refresh_tokens(self):
+        while True:
+            await asyncio.sleep(TOKEN_REFRESH_INTERVAL_SECONDS)
+            for token in self.tokens:
+                body = json.dumps({"refresh": token["refresh"]}).encode()
+                status, data = await self._timed(
+                    "token_refresh",
+                    time.perf_counter(),
+                    "POST",
+                    TOKEN_REFRESH_PATH,
+                    {"Content-Type": "application/json"},
+                    body,
+                )
+                if status == 200:
+                    token.update(json.loads(data))
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test a running server on localhost: log in seeded admin users "
+        "through the JWT token endpoint, then send a weighted mix of ride list "
+        "requests at a target rate. Prints a JSON report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            default="http://127.0.0.1:8000",
+            help="Server to test, must be local (default: http://127.0.0.1:8000)",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=50,
+            help="Target requests per second (default: 50)",
+        )
+        parser.add_argument(
+            "--duration",
+            type=float,
+            default=30,
+            help="Seconds to generate load for (default: 30)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=20,
+            help="Number of keep-alive connections (default: 20)",
+        )
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=5,
+            help="Max number of admin users to log in as (default: 5)",
+        )
+        parser.add_argument(
+            "--password",
+            default="password123",
+            help="Password of the admin users (default: the seed command's)",
+        )
+        parser.add_argument("--seed", type=int, help="Random seed for the request mix")
+        parser.add_argument("--output", help="Write the report here instead of stdout")
+
+    def handle(self, *args, **options):
+        url = urlsplit(options["url"])
+        if url.scheme != "http" or url.hostname not in LOCAL_HOSTS:
+            raise CommandError(
+                f"Only http://localhost servers can be load tested: {options['url']}"
+            )
+        if (
+            options["rate"] <= 0
+            or options["duration"] <= 0
+            or options["concurrency"] < 1
+        ):
+            raise CommandError("--rate, --duration and --concurrency must be positive")
+
+        usernames = list(
+            User.objects.filter(
+                Q(role=UserRole.ADMIN) | Q(is_staff=True), is_active=True
+            )
+            .order_by("id_user")
+            .values_list("username", flat=True)[: options["users"]]
+        )
+        if not usernames:
+            raise CommandError("No admin users, run the seed command first")
+
+        load_test = LoadTest(
+            host=url.hostname,
+            port=url.port or 80,
+            credentials=[(username, options["password"]) for username in usernames],
+            rate=options["rate"],
+            duration=options["duration"],
+            concurrency=options["concurrency"],
+            rng=random.Random(options["seed"]),
+        )
+        report = json.dumps(asyncio.run(load_test.run()), indent=2)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report + "\n")
+        else:
+            self.stdout.write(report)
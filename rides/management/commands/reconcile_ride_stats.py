@@ -0,0 +1,108 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncDate
+
+from rides.models import Ride, RideStatsCounter, RideStatsDimension
+from rides.sharding import shard_aliases
+
+CORRECTIONS_BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute RideStatsCounter from rides_ride, fixing drift from writes "
+        "that bypass Ride.save() (bulk_create, queryset update/delete). Reads "
+        "one snapshot per shard and applies the differences, so writes can go "
+        "on meanwhile."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the differences",
+        )
+        parser.add_argument(
+            "--database",
+            help="Only this database alias (default: every ride shard)",
+        )
+
+    def handle(self, *args, **options):
+        # each shard counts its own rides
+        for alias in [options["database"]] if options["database"] else shard_aliases():
+            self._reconcile(alias, dry_run=options["dry_run"])
+
+    def _reconcile(self, alias: str, dry_run: bool):
+        expected, current = self._snapshot_totals(alias)
+
+        drift = {
+            counter: expected.get(counter, 0) - current.get(counter, 0)
+            for counter in expected.keys() | current.keys()
+            if expected.get(counter, 0) != current.get(counter, 0)
+        }
+        for (dimension, key), delta in sorted(drift.items()):
+            self.stdout.write(
+                f"  {dimension}:{key} {current.get((dimension, key), 0)} "
+                f"-> {expected.get((dimension, key), 0)} ({delta:+d})"
+            )
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS(f"{alias}: Counters are in sync"))
+            return
+        if dry_run:
+            self.stdout.write(f"{alias}: {len(drift)} counters drifted (dry run)")
+            return
+
+        # corrections rather than totals: whatever writers added since the
+        # snapshot moved both sides alike and stays on top
+        corrections = [(*counter, delta) for counter, delta in sorted(drift.items())]
+        with transaction.atomic(using=alias):
+            for start in range(0, len(corrections), CORRECTIONS_BATCH_SIZE):
+                RideStatsCounter.objects.using(alias).increment(
+                    corrections[start : start + CORRECTIONS_BATCH_SIZE]
+                )
+        self.stdout.write(self.style.SUCCESS(f"{alias}: Fixed {len(drift)} counters"))
+
+    def _snapshot_totals(self, alias: str):
+        """
+        (expected, current) totals of `alias` as of one snapshot, read without
+        locking out the writers.
+        """
+        connection = connections[alias]
+        outermost = not connection.in_atomic_block
+        with transaction.atomic(using=alias):
+            if outermost:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY"
+                    )
+            expected = self._expected_totals(alias)
+            counters = RideStatsCounter.objects.using(alias)
+            current = {
+                (dimension, key): total
+                for dimension in RideStatsDimension.values
+                for key, total in counters.totals(dimension).items()
+            }
+        return expected, current
+
+    def _expected_totals(self, alias: str) -> dict[tuple[str, str], int]:
+        groupings = {
+            RideStatsDimension.STATUS: F("status"),
+            RideStatsDimension.DRIVER: F("id_driver"),
+            RideStatsDimension.DAY: TruncDate("pickup_time"),
+        }
+
+        expected = {}
+        for dimension, expression in groupings.items():
+            rows = (
+                Ride.objects.using(alias)
+                .order_by()
+                .values(key=expression)
+                .annotate(total=Count("pk"))
+                .values_list("key", "total")
+            )
+            for key, total in rows:
+                # same string forms as Ride.stats_keys()
+                expected[(dimension, str(key))] = total
+        return expected
@@ -2,9 +2,11 @@ import random
 from datetime import timedelta
 
 from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
 from django.utils import timezone
 
 from rides.models import Ride, RideEvent, RideEventType, RideStatus
+from rides.sharding import shard_aliases
 from users.models import User, UserRole
 
 
@@ -27,9 +29,11 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         if options["clear"]:
             self.stdout.write("Clearing existing data...")
-            RideEvent.objects.all().delete()
-            Ride.objects.all().delete()
-            User.objects.filter(is_superuser=False).delete()
+            # shards hold copies of the users their rides reference
+            for alias in sorted({DEFAULT_DB_ALIAS, *shard_aliases()}):
+                RideEvent.objects.using(alias).all().delete()
+                Ride.objects.using(alias).all().delete()
+                User.objects.using(alias).filter(is_superuser=False).delete()
             self.stdout.write(self.style.SUCCESS("Cleared existing data"))
 
         self.stdout.write("Seeding database...")
@@ -231,4 +235,4 @@ class Command(BaseCommand):
                 )
 
         # Bulk create events
-        RideEvent.objects.bulk_create(events_to_create)
+        RideEvent.objects.using(ride._state.db).bulk_create(events_to_create)
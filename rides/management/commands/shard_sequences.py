@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from rides.sharding import configure_sequences, shard_aliases
+
+
+class Command(BaseCommand):
+    help = (
+        "Interleave the Ride and RideEvent id sequences across the ride shards "
+        "(settings.RIDE_SHARDS), so a ride's shard follows from its id. Run "
+        "once after migrating every shard, before rides are written to them."
+    )
+
+    def handle(self, *args, **options):
+        aliases = shard_aliases()
+        for alias in aliases:
+            configure_sequences(alias)
+            self.stdout.write(
+                f"{alias}: ids = {aliases.index(alias)} (mod {len(aliases)})"
+            )
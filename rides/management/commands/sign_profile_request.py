@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.profiling import PROFILE_SIGNATURE_MAX_AGE, sign_request
+
+
+class Command(BaseCommand):
+    help = (
+        "Print an X-Profile-Request header value that profiles the given path "
+        "and query string, exactly as the client sends them, for "
+        f"{PROFILE_SIGNATURE_MAX_AGE // 60} minutes. Signed with SECRET_KEY, so "
+        "run it with the server's settings."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help='e.g. "/api/rides/?status=pickup"')
+
+    def handle(self, *args, **options):
+        if not options["path"].startswith("/"):
+            raise CommandError("The path has to start with /, without the host")
+        self.stdout.write(f"X-Profile-Request: {sign_request(options['path'])}")
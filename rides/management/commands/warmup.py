@@ -0,0 +1,15 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the worker warm-up (imports, URLs, ride querysets, caches) and "
+        "print how long each step took, in ms, as JSON."
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(warm_up(), indent=2))
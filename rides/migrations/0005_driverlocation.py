@@ -0,0 +1,26 @@
+# Generated by Django 6.1.2 on 2026-10-19 07:37
+
+import django.core.validators
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0004_alter_ride_options'),
+        ('users', '0002_user_email_lower_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DriverLocation',
+            fields=[
+                ('id_driver', models.OneToOneField(db_column='id_driver', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='location', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('latitude', models.FloatField(validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)])),
+                ('longitude', models.FloatField(validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)])),
+                ('updated_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
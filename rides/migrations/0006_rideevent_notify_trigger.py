@@ -0,0 +1,38 @@
+from django.db import migrations
+
+# channel name must match rides.feed.RIDE_EVENTS_CHANNEL
+CREATE_TRIGGER = """
+CREATE OR REPLACE FUNCTION rides_rideevent_notify() RETURNS trigger AS $$
+DECLARE
+    latest_id integer;
+BEGIN
+    SELECT max(id_ride_event) INTO latest_id FROM inserted;
+    IF latest_id IS NOT NULL THEN
+        PERFORM pg_notify('ride_events', latest_id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER rides_rideevent_notify
+    AFTER INSERT ON rides_rideevent
+    REFERENCING NEW TABLE AS inserted
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION rides_rideevent_notify();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS rides_rideevent_notify ON rides_rideevent;
+DROP FUNCTION IF EXISTS rides_rideevent_notify();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0005_driverlocation'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 6.1.2 on 2026-10-19 07:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0006_rideevent_notify_trigger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RideStatsCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('status', 'Rides per status'), ('driver', 'Rides per driver'), ('day', 'Rides per pickup day')], max_length=20)),
+                ('key', models.CharField(max_length=50)),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'key', 'shard'), name='ridestatscounter_unique_shard')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.1.2 on 2026-10-19 07:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0007_ridestatscounter'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['pickup_latitude', 'pickup_longitude'], name='ride_pickup_coords_idx'),
+        ),
+    ]
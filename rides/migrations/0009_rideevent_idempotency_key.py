@@ -0,0 +1,22 @@
+# Generated by Django 6.1.2 on 2026-10-19 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0008_ride_pickup_coords_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rideevent',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='rideevent',
+            constraint=models.UniqueConstraint(condition=models.Q(('idempotency_key__isnull', False)), fields=('idempotency_key',), name='rideevent_idempotency_key_uniq'),
+        ),
+    ]
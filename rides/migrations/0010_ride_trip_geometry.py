@@ -0,0 +1,75 @@
+# Generated by Django 6.1.2 on 2026-10-19 09:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Nullable columns kept by a trigger rather than GENERATED ... STORED, which
+# would rewrite the table under an exclusive lock. Existing rows are filled by
+# the backfill_ride_geometry command, the indexes built concurrently in 0011.
+# Must match Ride.set_trip_geometry() and rides.locations.EARTH_RADIUS_KM.
+CREATE_TRIGGER = """
+CREATE OR REPLACE FUNCTION rides_ride_trip_geometry() RETURNS trigger AS $$
+BEGIN
+    NEW.distance_km := 2 * 6371.0088 * asin(least(1.0, sqrt(
+        sin(radians(NEW.dropoff_latitude - NEW.pickup_latitude) / 2) ^ 2
+        + cos(radians(NEW.pickup_latitude)) * cos(radians(NEW.dropoff_latitude))
+        * sin(radians(NEW.dropoff_longitude - NEW.pickup_longitude) / 2) ^ 2
+    )));
+    NEW.bbox_south := least(NEW.pickup_latitude, NEW.dropoff_latitude);
+    NEW.bbox_west := least(NEW.pickup_longitude, NEW.dropoff_longitude);
+    NEW.bbox_north := greatest(NEW.pickup_latitude, NEW.dropoff_latitude);
+    NEW.bbox_east := greatest(NEW.pickup_longitude, NEW.dropoff_longitude);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER rides_ride_trip_geometry
+    BEFORE INSERT OR UPDATE OF
+        pickup_latitude, pickup_longitude, dropoff_latitude, dropoff_longitude
+    ON rides_ride
+    FOR EACH ROW
+    EXECUTE FUNCTION rides_ride_trip_geometry();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS rides_ride_trip_geometry ON rides_ride;
+DROP FUNCTION IF EXISTS rides_ride_trip_geometry();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0009_rideevent_idempotency_key'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='bbox_east',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='bbox_north',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='bbox_south',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='bbox_west',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='distance_km',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
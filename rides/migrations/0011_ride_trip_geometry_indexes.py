@@ -0,0 +1,25 @@
+# Generated by Django 6.1.2 on 2026-10-19 09:13
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('rides', '0010_ride_trip_geometry'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='ride',
+            index=models.Index(fields=['distance_km'], name='ride_distance_km_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ride',
+            index=django.contrib.postgres.indexes.GistIndex(models.Func(models.Func(models.F('bbox_west'), models.F('bbox_south'), function='point'), models.Func(models.F('bbox_east'), models.F('bbox_north'), function='point'), function='box'), name='ride_bbox_gist_idx'),
+        ),
+    ]
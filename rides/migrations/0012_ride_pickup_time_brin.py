@@ -0,0 +1,42 @@
+# Generated by Django 6.1.2 on 2026-10-19 09:22
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE/DROP INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('rides', '0011_ride_trip_geometry_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='ride',
+            index=django.contrib.postgres.indexes.BrinIndex(autosummarize=True, fields=['pickup_time'], name='ride_pickup_time_brin_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='rideevent',
+            index=django.contrib.postgres.indexes.BrinIndex(autosummarize=True, fields=['created_at'], name='rideevent_created_brin_idx'),
+        ),
+        # the BRIN index replaces the pickup_time B-tree, dropped only once it
+        # exists and without blocking writes
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='ride',
+                    name='pickup_time',
+                    field=models.DateTimeField(),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    'DROP INDEX CONCURRENTLY IF EXISTS rides_ride_pickup_time_cda49154',
+                    reverse_sql='CREATE INDEX CONCURRENTLY IF NOT EXISTS rides_ride_pickup_time_cda49154 ON rides_ride (pickup_time)',
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 6.1.2 on 2026-10-19 10:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE/DROP INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('rides', '0012_ride_pickup_time_brin'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='ride',
+            index=models.Index(fields=['id_rider', 'pickup_time'], name='ride_rider_pickup_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ride',
+            index=models.Index(fields=['id_driver', 'pickup_time'], name='ride_driver_pickup_idx'),
+        ),
+        # the composite indexes lead with the foreign keys, their own indexes
+        # are dropped once those exist
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='ride',
+                    name='id_driver',
+                    field=models.ForeignKey(db_column='id_driver', db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='rides_as_driver', to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AlterField(
+                    model_name='ride',
+                    name='id_rider',
+                    field=models.ForeignKey(db_column='id_rider', db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='rides_as_rider', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    'DROP INDEX CONCURRENTLY IF EXISTS rides_ride_id_driver_fe8fbf93',
+                    reverse_sql='CREATE INDEX CONCURRENTLY IF NOT EXISTS rides_ride_id_driver_fe8fbf93 ON rides_ride (id_driver)',
+                ),
+                migrations.RunSQL(
+                    'DROP INDEX CONCURRENTLY IF EXISTS rides_ride_id_rider_0b2dacdc',
+                    reverse_sql='CREATE INDEX CONCURRENTLY IF NOT EXISTS rides_ride_id_rider_0b2dacdc ON rides_ride (id_rider)',
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.1.2 on 2026-10-19 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0013_ride_user_pickup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='event_timeline',
+            field=models.JSONField(editable=False, null=True),
+        ),
+    ]
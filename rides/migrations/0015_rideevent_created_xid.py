@@ -0,0 +1,24 @@
+from django.db import migrations
+
+# Not a model field: only the ride event feed reads it, in raw SQL (see
+# RideEventQuerySet.settled()). Added without a default and given one after,
+# so existing rows stay NULL instead of the table being rewritten.
+ADD_COLUMN = """
+ALTER TABLE rides_rideevent ADD COLUMN created_xid xid8;
+ALTER TABLE rides_rideevent ALTER COLUMN created_xid SET DEFAULT pg_current_xact_id();
+"""
+
+DROP_COLUMN = """
+ALTER TABLE rides_rideevent DROP COLUMN created_xid;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0014_ride_event_timeline'),
+    ]
+
+    operations = [
+        migrations.RunSQL(ADD_COLUMN, DROP_COLUMN),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.1.2 on 2026-10-19 11:58
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0015_rideevent_created_xid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driverlocation',
+            name='flushed_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE/DROP INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('rides', '0016_driverlocation_flushed_at'),
+    ]
+
+    # idempotency keys are unique per ride, not across all rides; the partial
+    # unique index is built before the old one goes, so retries stay
+    # deduplicated throughout. A CONCURRENTLY build that failed leaves an
+    # invalid index behind under its name, so that's dropped before each build
+    # rather than skipped over with IF NOT EXISTS.
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='rideevent',
+                    constraint=models.UniqueConstraint(condition=models.Q(('idempotency_key__isnull', False)), fields=('id_ride', 'idempotency_key'), name='rideevent_ride_idempotency_key_uniq'),
+                ),
+                migrations.RemoveConstraint(
+                    model_name='rideevent',
+                    name='rideevent_idempotency_key_uniq',
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    [
+                        'DROP INDEX CONCURRENTLY IF EXISTS rideevent_ride_idempotency_key_uniq',
+                        'CREATE UNIQUE INDEX CONCURRENTLY rideevent_ride_idempotency_key_uniq '
+                        'ON rides_rideevent (id_ride, idempotency_key) WHERE idempotency_key IS NOT NULL',
+                    ],
+                    reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS rideevent_ride_idempotency_key_uniq',
+                ),
+                migrations.RunSQL(
+                    'DROP INDEX CONCURRENTLY IF EXISTS rideevent_idempotency_key_uniq',
+                    reverse_sql=[
+                        'DROP INDEX CONCURRENTLY IF EXISTS rideevent_idempotency_key_uniq',
+                        'CREATE UNIQUE INDEX CONCURRENTLY rideevent_idempotency_key_uniq '
+                        'ON rides_rideevent (idempotency_key) WHERE idempotency_key IS NOT NULL',
+                    ],
+                ),
+            ],
+        ),
+    ]
@@ -1,8 +1,26 @@
+from datetime import datetime
+from functools import partial
+
 from django.conf import settings
+from django.contrib.postgres.indexes import BrinIndex, GistIndex
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import models, router, transaction
+from django.utils import timezone
 
-from .queryset import RideEventQuerySet, RideQuerySet
+from .heatmap import invalidate_points
+from .locations import haversine_km
+from .queryset import (
+    RideEventQuerySet,
+    RideQuerySet,
+    RideStatsCounterQuerySet,
+    box,
+)
+from .ride_cache import (
+    RECENT_EVENTS_WINDOW,
+    invalidate_ride_history,
+    invalidate_rides,
+)
+from .sharding import check_ride_id, replicate_users
 
 LATITUDE_MIN = -90
 LATITUDE_MAX = 90
@@ -41,12 +59,16 @@ class Ride(models.Model):
         on_delete=models.CASCADE,
         related_name="rides_as_rider",
         db_column="id_rider",
+        # covered by ride_rider_pickup_idx
+        db_index=False,
     )
     id_driver = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
         related_name="rides_as_driver",
         db_column="id_driver",
+        # covered by ride_driver_pickup_idx
+        db_index=False,
     )
 
     pickup_latitude = models.FloatField(validators=LATITUDE_VALIDATORS)
@@ -56,12 +78,58 @@ class Ride(models.Model):
     dropoff_longitude = models.FloatField(validators=LONGITUDE_VALIDATORS)
 
     # unsure if this is estimated pickup time or actual pickup time (if so, this should be nullable)
-    pickup_time = models.DateTimeField(db_index=True)
+    pickup_time = models.DateTimeField()
+
+    # derived from the coordinates by the rides_ride_trip_geometry trigger (see
+    # migration 0010), NULL for rides older than it until backfill_ride_geometry
+    distance_km = models.FloatField(null=True, editable=False)
+    # the box spanning pickup and dropoff
+    bbox_south = models.FloatField(null=True, editable=False)
+    bbox_west = models.FloatField(null=True, editable=False)
+    bbox_north = models.FloatField(null=True, editable=False)
+    bbox_east = models.FloatField(null=True, editable=False)
+
+    # events of a finished ride folded into `[id_ride_event, description,
+    # created_at]` entries by compact_ride_events, oldest first; its RideEvent
+    # rows are deleted then
+    event_timeline = models.JSONField(null=True, editable=False)
 
     objects = RideManager()
 
     class Meta:
         ordering = ["id_ride"]
+        indexes = [
+            # heatmap tiles scan a lat/lng box
+            models.Index(
+                fields=["pickup_latitude", "pickup_longitude"],
+                name="ride_pickup_coords_idx",
+            ),
+            models.Index(fields=["distance_km"], name="ride_distance_km_idx"),
+            # a user's own rides, newest pickup first, see RideQuerySet.history()
+            models.Index(
+                fields=["id_rider", "pickup_time"], name="ride_rider_pickup_idx"
+            ),
+            models.Index(
+                fields=["id_driver", "pickup_time"], name="ride_driver_pickup_idx"
+            ),
+            # pickup_after/pickup_before ranges, rides are stored roughly in
+            # pickup order so block ranges summarize tightly
+            BrinIndex(
+                fields=["pickup_time"],
+                name="ride_pickup_time_brin_idx",
+                autosummarize=True,
+            ),
+            # `&&` overlap of the trip's box, see RideQuerySet.trip_overlaps()
+            GistIndex(
+                box(
+                    models.F("bbox_west"),
+                    models.F("bbox_south"),
+                    models.F("bbox_east"),
+                    models.F("bbox_north"),
+                ),
+                name="ride_bbox_gist_idx",
+            ),
+        ]
         constraints = [
             models.CheckConstraint(
                 condition=models.Q(
@@ -95,6 +163,209 @@ class Ride(models.Model):
     def __str__(self):
         return f"Ride {self.id_ride}: {self.status}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_stats_keys = instance.stats_keys()
+        instance._loaded_pickup = instance.pickup_point()
+        instance._loaded_users = instance.user_ids()
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        Keep `RideStatsCounter` in step with the ride, in the same transaction,
+        and expire its cached representation and the heatmap tiles it shows up
+        in once that commits.
+        """
+        adding = self._state.adding
+        previous = None if adding else getattr(self, "_loaded_stats_keys", None)
+        previous_pickup = None if adding else getattr(self, "_loaded_pickup", None)
+        previous_users = set() if adding else getattr(self, "_loaded_users", set())
+        # the ride's shard, see rides.sharding
+        using = kwargs["using"] = kwargs.get("using") or router.db_for_write(
+            Ride, instance=self
+        )
+
+        # what the trigger stores, for this instance
+        self.set_trip_geometry()
+
+        with transaction.atomic(using=using):
+            if adding:
+                replicate_users(using, [self.id_rider_id, self.id_driver_id])
+            super().save(*args, **kwargs)
+            if adding:
+                check_ride_id(self.pk, using)
+
+            current = self.stats_keys()
+            if previous != current:
+                deltas = [(*key, 1) for key in current]
+                if previous is not None:
+                    deltas += [(*key, -1) for key in previous]
+                RideStatsCounter.objects.using(self._state.db).increment(deltas)
+
+            transaction.on_commit(
+                partial(invalidate_rides, [self.pk]), using=self._state.db
+            )
+            # new rides, pickup_time and rider/driver changes reorder histories
+            current_users = self.user_ids()
+            transaction.on_commit(
+                partial(invalidate_ride_history, previous_users | current_users),
+                using=self._state.db,
+            )
+
+            current_pickup = self.pickup_point()
+            if previous != current or previous_pickup != current_pickup:
+                points = {previous_pickup, current_pickup} - {None}
+                transaction.on_commit(
+                    partial(invalidate_points, points), using=self._state.db
+                )
+        self._loaded_stats_keys = current
+        self._loaded_pickup = current_pickup
+        self._loaded_users = current_users
+
+    def delete(self, *args, **kwargs):
+        """
+        Take the ride out of `RideStatsCounter` in the same transaction, and
+        expire its cached representation, its users' histories and the heatmap
+        tiles it showed up in once that commits.
+        """
+        using = kwargs.get("using") or self._state.db
+        # cleared by the delete
+        pk = self.pk
+        with transaction.atomic(using=using):
+            # the counters count the row as stored, not this instance
+            stored = Ride.objects.using(using).select_for_update().filter(pk=pk).first()
+            result = super().delete(*args, **kwargs)
+
+            if stored is not None:
+                RideStatsCounter.objects.using(using).increment(
+                    [(*key, -1) for key in stored.stats_keys()]
+                )
+                transaction.on_commit(
+                    partial(invalidate_points, [stored.pickup_point()]), using=using
+                )
+            transaction.on_commit(partial(invalidate_rides, [pk]), using=using)
+            transaction.on_commit(
+                partial(
+                    invalidate_ride_history,
+                    self.user_ids() | (stored.user_ids() if stored else set()),
+                ),
+                using=using,
+            )
+        return result
+
+    def stats_keys(self) -> list[tuple[str, str]] | None:
+        """
+        The (dimension, key) counters this ride counts towards.
+        """
+        fields = self.__dict__
+        if not all(f in fields for f in ("status", "id_driver_id", "pickup_time")):
+            # deferred fields, e.g. loaded through .only()
+            return None
+        return [
+            (RideStatsDimension.STATUS, self.status),
+            (RideStatsDimension.DRIVER, str(self.id_driver_id)),
+            (
+                RideStatsDimension.DAY,
+                timezone.localdate(self.pickup_time).isoformat(),
+            ),
+        ]
+
+    def set_trip_geometry(self):
+        fields = self.__dict__
+        coordinates = (
+            "pickup_latitude",
+            "pickup_longitude",
+            "dropoff_latitude",
+            "dropoff_longitude",
+        )
+        if not all(fields.get(name) is not None for name in coordinates):
+            return
+        self.distance_km = haversine_km(
+            self.pickup_latitude,
+            self.pickup_longitude,
+            self.dropoff_latitude,
+            self.dropoff_longitude,
+        )
+        self.bbox_south = min(self.pickup_latitude, self.dropoff_latitude)
+        self.bbox_west = min(self.pickup_longitude, self.dropoff_longitude)
+        self.bbox_north = max(self.pickup_latitude, self.dropoff_latitude)
+        self.bbox_east = max(self.pickup_longitude, self.dropoff_longitude)
+
+    def timeline_events(self, since=None) -> list["RideEvent"]:
+        """
+        The events folded into `event_timeline` (created at or after `since`),
+        as unsaved RideEvent instances, oldest first.
+        """
+        events = []
+        for id_ride_event, description, created_at in self.event_timeline or ():
+            created_at = datetime.fromisoformat(created_at)
+            if since is None or created_at >= since:
+                events.append(
+                    RideEvent(
+                        id_ride_event=id_ride_event,
+                        id_ride_id=self.pk,
+                        description=description,
+                        created_at=created_at,
+                    )
+                )
+        return events
+
+    @property
+    def todays_ride_events(self) -> list["RideEvent"]:
+        """
+        The last 24 hours' events, latest first: the rows prefetched by
+        `RideQuerySet.with_todays_ride_events()`, and those in `event_timeline`
+        when it's loaded. Not there without the prefetch, like a `to_attr`.
+        """
+        try:
+            events = self._todays_ride_event_rows
+        except AttributeError:
+            raise AttributeError("todays_ride_events needs to be prefetched") from None
+        if self.__dict__.get("event_timeline"):
+            since = timezone.now() - RECENT_EVENTS_WINDOW
+            events = sorted(
+                [*events, *self.timeline_events(since)],
+                key=lambda event: (event.created_at, event.id_ride_event),
+                reverse=True,
+            )
+        return events
+
+    def user_ids(self) -> set[int]:
+        """
+        The rider's and driver's id_user, those that are loaded.
+        """
+        fields = self.__dict__
+        return {
+            fields[name]
+            for name in ("id_rider_id", "id_driver_id")
+            if fields.get(name) is not None
+        }
+
+    def pickup_point(self) -> tuple[float, float] | None:
+        fields = self.__dict__
+        if "pickup_latitude" not in fields or "pickup_longitude" not in fields:
+            return None
+        return self.pickup_latitude, self.pickup_longitude
+
+    def transition_to(self, status: str) -> int | None:
+        """
+        See `RideQuerySet.transition()`, also updates this instance on success.
+        """
+        id_ride_event = Ride.objects.using(self._state.db).transition(self.pk, status)
+        if id_ride_event is not None:
+            self.status = status
+            # the statement moved the status counters, a later save() mustn't
+            if loaded := getattr(self, "_loaded_stats_keys", None):
+                self._loaded_stats_keys = [
+                    (
+                        dimension,
+                        status if dimension == RideStatsDimension.STATUS else key,
+                    )
+                    for dimension, key in loaded
+                ]
+        return id_ride_event
+
 
 class RideEventType(models.TextChoices):
     STATUS_EN_ROUTE = "Status changed to en-route"
@@ -106,6 +377,23 @@ class RideEventType(models.TextChoices):
     # RIDER_CANCELLED = "Rider cancelled Ride"
 
 
+# status -> the status a ride has to be in to move to it
+RIDE_STATUS_TRANSITIONS = {
+    RideStatus.PICKUP: RideStatus.EN_ROUTE,
+    RideStatus.DROPOFF: RideStatus.PICKUP,
+}
+
+RIDE_STATUS_EVENTS = {
+    RideStatus.EN_ROUTE: RideEventType.STATUS_EN_ROUTE,
+    RideStatus.PICKUP: RideEventType.STATUS_PICKUP,
+    RideStatus.DROPOFF: RideEventType.STATUS_DROPOFF,
+}
+
+
+class RideStatsCounterManager(models.Manager.from_queryset(RideStatsCounterQuerySet)):
+    pass
+
+
 class RideEventManager(models.Manager.from_queryset(RideEventQuerySet)):
     pass
 
@@ -126,6 +414,8 @@ class RideEvent(models.Model):
         db_index=True,
     )
     created_at = models.DateTimeField(auto_now_add=True)
+    # client supplied, makes batch ingestion retries safe
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True)
 
     objects = RideEventManager()
 
@@ -135,7 +425,89 @@ class RideEvent(models.Model):
             models.Index(
                 fields=["id_ride", "created_at"], name="rideevent_ride_created_idx"
             ),
+            # created_after/created_before on the feed, events are append-only
+            BrinIndex(
+                fields=["created_at"],
+                name="rideevent_created_brin_idx",
+                autosummarize=True,
+            ),
+        ]
+        constraints = [
+            # idempotency keys are chosen by clients, per ride
+            models.UniqueConstraint(
+                fields=["id_ride", "idempotency_key"],
+                condition=models.Q(idempotency_key__isnull=False),
+                name="rideevent_ride_idempotency_key_uniq",
+            ),
         ]
 
     def __str__(self):
         return f"RideEvent {self.id_ride_event}: {self.description}"
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # the ride's cached todays_ride_events
+        transaction.on_commit(
+            partial(invalidate_rides, [self.id_ride_id]), using=self._state.db
+        )
+
+    def delete(self, *args, **kwargs):
+        transaction.on_commit(
+            partial(invalidate_rides, [self.id_ride_id]),
+            using=kwargs.get("using") or self._state.db,
+        )
+        return super().delete(*args, **kwargs)
+
+
+class DriverLocation(models.Model):
+    """
+    Last flushed position per driver, see `rides.locations`.
+    """
+
+    id_driver = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="location",
+        db_column="id_driver",
+    )
+    latitude = models.FloatField(validators=LATITUDE_VALIDATORS)
+    longitude = models.FloatField(validators=LONGITUDE_VALIDATORS)
+    updated_at = models.DateTimeField(db_index=True)
+    # when the position was last written, processes read back the rows other
+    # processes flushed since their last look
+    flushed_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"DriverLocation {self.id_driver_id}: {self.latitude}, {self.longitude}"
+
+
+class RideStatsDimension(models.TextChoices):
+    STATUS = "status", "Rides per status"
+    DRIVER = "driver", "Rides per driver"
+    DAY = "day", "Rides per pickup day"
+
+
+class RideStatsCounter(models.Model):
+    """
+    Incrementally maintained ride counts, split over `STATS_COUNTER_SHARDS`
+    rows per key to avoid hot-row contention. Totals are the sum over shards.
+    """
+
+    dimension = models.CharField(max_length=20, choices=RideStatsDimension.choices)
+    key = models.CharField(max_length=50)
+    shard = models.PositiveSmallIntegerField()
+    count = models.BigIntegerField(default=0)
+
+    objects = RideStatsCounterManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["dimension", "key", "shard"],
+                name="ridestatscounter_unique_shard",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.dimension}:{self.key}[{self.shard}] = {self.count}"
@@ -1,7 +1,65 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
 from rest_framework.pagination import PageNumberPagination
 
+# below this many (estimated) rows an exact COUNT is cheap enough
+ESTIMATED_COUNT_THRESHOLD = 10_000
+
 
 class RidePagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = "page_size"
     max_page_size = 100
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Django paginator that takes the planner's row estimate instead of running
+    COUNT(*) on large results, used by the admin changelists. A
+    `ScatteredQuerySet` adds up its shards' counts.
+    """
+
+    @cached_property
+    def count(self):
+        querysets = getattr(self.object_list, "querysets", [self.object_list])
+        return sum(map(self._count, querysets))
+
+    @staticmethod
+    def _count(queryset) -> int:
+        estimate = estimated_count(queryset)
+        if estimate < ESTIMATED_COUNT_THRESHOLD:
+            return queryset.count()
+        return estimate
+
+
+def estimated_count(queryset) -> int:
+    plan = json.loads(queryset.order_by().select_related(None).explain(format="json"))[
+        0
+    ]
+    return int(plan["Plan"]["Plan Rows"])
+
+
+def encode_history_cursor(pickup_time: datetime, id_ride: int) -> str:
+    """
+    Opaque keyset cursor for `/api/rides/mine/`, see `RideQuerySet.history()`.
+    """
+    return urlsafe_b64encode(f"{pickup_time.isoformat()}|{id_ride}".encode()).decode()
+
+
+def decode_history_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    `(pickup_time, id_ride)`, raises ValueError for anything not made by
+    `encode_history_cursor()`.
+    """
+    try:
+        pickup_time, id_ride = urlsafe_b64decode(cursor).decode().split("|")
+        pickup_time, id_ride = datetime.fromisoformat(pickup_time), int(id_ride)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    if pickup_time.tzinfo is None:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return pickup_time, id_ride
@@ -0,0 +1,316 @@
+"""
+Prepared statements for the ride list (`settings.RIDE_LIST_PREPARED_STATEMENTS`).
+
+The list only sends a handful of SQL shapes, the `RideQueryParamsSerializer`
+filter/ordering combinations, each with different values. With the setting on,
+a shape's page and count SQL is compiled once, from a stand-in queryset holding
+`PLACEHOLDERS` instead of the request's values, and later requests of the same
+shape fill their values into that SQL instead of compiling their queryset.
+Both statements are sent with server-side binding and `prepare=True`, so each
+database connection parses them once and Postgres can switch to a generic plan
+after five executions instead of planning every request.
+
+Prepared statements belong to a server connection, which transaction-mode
+poolers hand out per transaction. A pooler that doesn't track them (PgBouncer
+before 1.21, or with `max_prepared_statements = 0`) fails statements that
+landed on the wrong server connection; that turns preparing off for the client
+connection and the query is retried unprepared (inside a transaction the error
+is raised, as the transaction is aborted anyway).
+"""
+
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from datetime import UTC, datetime
+
+from django.db import DatabaseError, connections
+from django.db.backends.postgresql.base import ServerBindingCursor
+from django.db.models.sql import Query
+from django.db.models.sql.compiler import SQLCompiler, cursor_iter
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE, MULTI, SINGLE
+from psycopg import errors
+
+from users.models import User
+
+logger = logging.getLogger(__name__)
+
+# request values bound as parameters, by `apply_query_params()` key; everything
+# else in the query params (ordering, region, fields) is part of the shape
+PLACEHOLDERS = {
+    "status": "\x00status\x00",
+    "id_rider": -2_017_338_241,
+    "latitude": -91_734.5125,
+    "longitude": -181_734.5125,
+    "min_distance_km": -1_734.5125,
+    "max_distance_km": -2_734.5125,
+    "bbox_west": -3_734.5125,
+    "bbox_south": -4_734.5125,
+    "bbox_east": -5_734.5125,
+    "bbox_north": -6_734.5125,
+    "pickup_after": datetime(1, 2, 3, 4, 5, 6, 734_512, tzinfo=UTC),
+    "pickup_before": datetime(1, 3, 4, 5, 6, 7, 734_512, tzinfo=UTC),
+}
+# compiled shapes kept per process, least recently used dropped first
+MAX_TEMPLATES = 256
+# psycopg only prepares on request when the connection has a threshold, the
+# ORM's own (client-side binding) cursors never prepare either way
+PREPARE_THRESHOLD = 5
+
+_templates: OrderedDict = OrderedDict()
+_templates_lock = threading.Lock()
+# psycopg connections whose prepared statements went missing
+_unpreparable = weakref.WeakSet()
+
+
+class PreparingCursor(ServerBindingCursor):
+    def execute(self, query, params=None, *, prepare=None, binary=None):
+        return super().execute(query, params, prepare=True, binary=binary)
+
+
+def execute(connection, sql: str, params: list):
+    """
+    Run `sql` on the Django `connection` as a prepared statement, returns the
+    (Django wrapped) cursor.
+    """
+    connection.ensure_connection()
+    pg_connection = connection.connection
+    if pg_connection not in _unpreparable:
+        if pg_connection.prepare_threshold is None:
+            pg_connection.prepare_threshold = PREPARE_THRESHOLD
+        cursor = connection._prepare_cursor(PreparingCursor(pg_connection))
+        try:
+            cursor.execute(sql, params)
+            return cursor
+        except DatabaseError as e:
+            cursor.close()
+            if not isinstance(
+                e.__cause__,
+                (errors.InvalidSqlStatementName, errors.DuplicatePreparedStatement),
+            ):
+                raise
+            _unpreparable.add(pg_connection)
+            logger.warning(
+                "Prepared statement went missing (connection pooler?), "
+                "not preparing on this connection anymore: %s",
+                e,
+            )
+            if connection.in_atomic_block:
+                raise
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor
+
+
+def _sources(params, names) -> list[tuple[str | None, object]]:
+    """
+    (placeholder name, None) or (None, constant) per compiled parameter.
+    """
+    sources = []
+    for param in params:
+        name = next(
+            (
+                name
+                for name in names
+                if type(param) is type(PLACEHOLDERS[name])
+                and param == PLACEHOLDERS[name]
+            ),
+            None,
+        )
+        sources.append((name, None) if name else (None, param))
+    return sources
+
+
+class Template:
+    """
+    The page and count SQL of one list shape, and the compiler state needed to
+    turn page rows into rides.
+    """
+
+    def __init__(self, queryset, names):
+        compiler = queryset.query.get_compiler(queryset.db)
+        sql, params = compiler.as_sql(with_limits=False)
+        self.sql, self.sources = sql, _sources(params, names)
+        self.state = (
+            compiler.select,
+            compiler.klass_info,
+            compiler.annotation_col_map,
+            compiler.col_count,
+            compiler.has_extra_select,
+        )
+
+        count_query = queryset.order_by().values("pk").query
+        sql, params = count_query.get_compiler(queryset.db).as_sql(with_limits=False)
+        self.count_sql = f"SELECT COUNT(*) FROM ({sql}) subquery"
+        self.count_sources = _sources(params, names)
+
+        bound = {name for name, _ in self.sources + self.count_sources if name}
+        if bound != set(names):
+            raise ValueError(f"Values not bound as parameters: {set(names) - bound}")
+
+    @staticmethod
+    def bind(sources, values: dict) -> list:
+        return [values[name] if name else value for name, value in sources]
+
+
+def _template(key, names, build) -> Template | None:
+    with _templates_lock:
+        if key in _templates:
+            _templates.move_to_end(key)
+            return _templates[key]
+
+    try:
+        template = Template(build({name: PLACEHOLDERS[name] for name in names}), names)
+    except ValueError as e:
+        # e.g. a value the ORM transforms before binding it, compiled as usual
+        logger.info("Can't prepare ride list shape %s: %s", key, e)
+        template = None
+    except Exception:
+        logger.exception("Can't prepare ride list shape %s", key)
+        template = None
+
+    with _templates_lock:
+        _templates[key] = template
+        while len(_templates) > MAX_TEMPLATES:
+            _templates.popitem(last=False)
+    return template
+
+
+def _signature(query) -> tuple:
+    """
+    What a template depends on: a query changed after `prepare_ride_list()`
+    (ordering added, `.values()`, `.exists()`, ...) is compiled as usual.
+    """
+    return (
+        query.order_by,
+        query.standard_ordering,
+        query.default_ordering,
+        tuple(query.annotations),
+        query.annotation_select_mask,
+        len(query.where.children),
+        query.select_related,
+        query.deferred_loading,
+        query.select,
+        query.values_select,
+        query.extra,
+        query.distinct,
+        query.combinator,
+        query.select_for_update,
+        query.group_by,
+    )
+
+
+class PreparedQuery(Query):
+    prepared = None
+
+    def _template(self) -> Template | None:
+        if self.prepared is None:
+            return None
+        template, _, signature = self.prepared
+        return template if _signature(self) == signature else None
+
+    def get_compiler(self, using=None, connection=None, elide_empty=True):
+        if self._template() is None:
+            return super().get_compiler(using, connection, elide_empty)
+        if using:
+            connection = connections[using]
+        return PreparedCompiler(self, connection, using, elide_empty)
+
+    def get_count(self, using):
+        template = self._template()
+        if template is None:
+            return super().get_count(using)
+        params = template.bind(template.count_sources, self.prepared[1])
+        with execute(connections[using], template.count_sql, params) as cursor:
+            return cursor.fetchone()[0]
+
+
+class PreparedCompiler(SQLCompiler):
+    def as_sql(self, with_limits=True, with_col_aliases=False):
+        if with_col_aliases:
+            return super().as_sql(with_limits, with_col_aliases)
+
+        template, values, _ = self.query.prepared
+        (
+            self.select,
+            self.klass_info,
+            self.annotation_col_map,
+            self.col_count,
+            self.has_extra_select,
+        ) = template.state
+        sql, params = template.sql, template.bind(template.sources, values)
+        if with_limits:
+            low, high = self.query.low_mark, self.query.high_mark
+            # as parameters, so every page shares one statement
+            if high is not None:
+                sql, params = f"{sql} LIMIT %s", [*params, high - low]
+            if low:
+                sql, params = f"{sql} OFFSET %s", [*params, low]
+        return sql, params
+
+    def execute_sql(
+        self, result_type=MULTI, chunked_fetch=False, chunk_size=GET_ITERATOR_CHUNK_SIZE
+    ):
+        if result_type not in (MULTI, SINGLE):
+            return super().execute_sql(result_type, chunked_fetch, chunk_size)
+
+        sql, params = self.as_sql()
+        cursor = execute(self.connection, sql, params)
+        if result_type == SINGLE:
+            with cursor:
+                row = cursor.fetchone()
+                return row[: self.col_count] if row else row
+        return list(
+            cursor_iter(
+                cursor,
+                self.connection.features.empty_fetchmany_value,
+                self.col_count if self.has_extra_select else None,
+                chunk_size,
+            )
+        )
+
+
+def prepare_ride_list(queryset, params: dict, build, key=()):
+    """
+    `queryset`, built by `build(params)` from validated `RideQueryParamsSerializer`
+    data, compiled from its shape's cached template instead and run prepared.
+    `key` tells apart shapes `params` doesn't (e.g. the renderer).
+    """
+    if "q" in params:
+        # resolves to a different number of user ids per search
+        return queryset
+
+    if params.get("ordering") not in ("distance", "-distance"):
+        # only used to order by distance, ignored otherwise
+        params = {
+            name: value
+            for name, value in params.items()
+            if name not in ("latitude", "longitude")
+        }
+    values = {name: params[name] for name in PLACEHOLDERS if name in params}
+    shape = {name: value for name, value in params.items() if name not in values}
+    if email := shape.pop("rider_email", None):
+        # cached from building `queryset`
+        values["id_rider"] = User.objects.id_for_email(email)
+        if values["id_rider"] is None:
+            return queryset
+
+    key = (
+        *key,
+        *sorted(values),
+        *sorted(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in shape.items()
+        ),
+    )
+    template = _template(
+        key, list(values), lambda placeholders: build({**shape, **placeholders})
+    )
+    if template is None:
+        return queryset
+
+    queryset = queryset._chain()
+    queryset.query = queryset.query.chain(PreparedQuery)
+    queryset.query.prepared = (template, values, _signature(queryset.query))
+    return queryset
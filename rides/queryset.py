@@ -1,17 +1,174 @@
+import random
 from datetime import timedelta
+from functools import partial
 
-from django.db import models
-from django.db.models import OuterRef, Prefetch, Subquery
-from django.db.models.functions import Power, Sqrt
+from django.db import connections, models, router, transaction
+from django.db.models import BooleanField, OuterRef, Prefetch, Q, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Greatest, Least, Power, Sqrt
 from django.utils import timezone
 
+from users.models import User, search_rank
+from users.serializers import BaseUserSerializer
 
-class RideEventQuerySet(models.QuerySet):
+from .heatmap import invalidate_points
+from .ride_cache import invalidate_rides
+from .sharding import REGIONS
+
+# serialized relation -> the FK it is loaded through
+RELATED_FIELDS = {
+    "rider": "id_rider",
+    "driver": "id_driver",
+}
+
+
+class ShardRoutedQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        if self._db is None:
+            # route by the new row (pickup point or ride), see rides.sharding
+            instance = self.model(**kwargs)
+            alias = router.db_for_write(self.model, instance=instance)
+            return super(ShardRoutedQuerySet, self.using(alias)).create(**kwargs)
+        return super().create(**kwargs)
+
+
+class RideEventQuerySet(ShardRoutedQuerySet):
     def recent(self, hours: int = 24):
         return self.filter(created_at__gte=timezone.now() - timedelta(hours=hours))
 
+    def created_between(self, after=None, before=None):
+        """
+        Events created at or after `after` and before `before`, either bound
+        optional (`rideevent_created_brin_idx`).
+        """
+        queryset = self
+        if after is not None:
+            queryset = queryset.filter(created_at__gte=after)
+        if before is not None:
+            queryset = queryset.filter(created_at__lt=before)
+        return queryset
+
+    def settled(self):
+        """
+        Events no lower id can still be committed after: inserted by a
+        transaction older than every one still running. Ids are drawn when a
+        row is inserted, not when it commits, so a slow transaction can commit
+        an event below ids already visible.
+
+        `created_xid` is the inserting transaction (column default, migration
+        0015), NULL for events stored before it existed. The requesting
+        transaction's own events count too (tests run inside one).
+        """
+        return self.filter(
+            RawSQL(
+                "rides_rideevent.created_xid IS NULL"
+                " OR rides_rideevent.created_xid"
+                " < pg_snapshot_xmin(pg_current_snapshot())"
+                " OR rides_rideevent.created_xid = pg_current_xact_id_if_assigned()",
+                [],
+                output_field=BooleanField(),
+            )
+        )
+
+
+# validated `bbox` query param, see RideQueryParamsSerializer
+BBOX_PARAMS = ("bbox_west", "bbox_south", "bbox_east", "bbox_north")
+
+
+def box(west, south, east, north) -> models.Func:
+    """
+    Postgres `box` from its corners, e.g. `box(F("bbox_west"), ...)` as used by
+    the `ride_bbox_gist_idx` index.
+    """
+    return models.Func(
+        models.Func(west, south, function="point"),
+        models.Func(east, north, function="point"),
+        function="box",
+    )
+
+
+class Overlaps(models.Func):
+    arg_joiner = " && "
+    template = "(%(expressions)s)"
+    output_field = models.BooleanField()
+
+
+class TimelineEventTime(models.Func):
+    """
+    The latest `created_at` of the `description` events in a ride's
+    `event_timeline`, NULL without any.
+    """
+
+    output_field = models.DateTimeField()
+
+    def __init__(self, timeline, description: str):
+        super().__init__(timeline, models.Value(description))
+
+    def as_sql(self, compiler, connection, **extra_context):
+        timeline, description = self.source_expressions
+        timeline_sql, timeline_params = compiler.compile(timeline)
+        description_sql, description_params = compiler.compile(description)
+        return (
+            f"(SELECT max((event ->> 2)::timestamptz) "
+            f"FROM jsonb_array_elements({timeline_sql}) event "
+            f"WHERE event ->> 1 = {description_sql})",
+            [*timeline_params, *description_params],
+        )
+
+
+STATS_COUNTER_SHARDS = 8
+
+
+class RideStatsCounterQuerySet(models.QuerySet):
+    def upsert_sql(self) -> str:
+        """
+        `INSERT ... ON CONFLICT` adding `count` onto the existing shard row,
+        without the VALUES/SELECT part.
+        """
+        quote = connections[self.db].ops.quote_name
+        table = quote(self.model._meta.db_table)
+        return f"""
+            INSERT INTO {table} (dimension, key, shard, count) {{rows}}
+            ON CONFLICT (dimension, key, shard) DO UPDATE
+            SET count = {table}.count + EXCLUDED.count
+        """
+
+    def increment(self, deltas: list[tuple[str, str, int]]):
+        """
+        Add `(dimension, key, delta)` onto a random shard of each counter, so
+        concurrent writers to a hot key (e.g. a status) rarely share a row.
+        """
+        merged = {}
+        for dimension, key, delta in deltas:
+            merged[(dimension, key)] = merged.get((dimension, key), 0) + delta
+        # ON CONFLICT can't touch the same row twice in one statement
+        deltas = [(*counter, delta) for counter, delta in merged.items() if delta]
+        if not deltas:
+            return
+
+        shard = random.randrange(STATS_COUNTER_SHARDS)
+        rows = "VALUES " + ", ".join(["(%s, %s, %s, %s)"] * len(deltas))
+        params = [
+            value
+            for dimension, key, delta in deltas
+            for value in (dimension, key, shard, delta)
+        ]
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(self.upsert_sql().format(rows=rows), params)
+
+    def totals(self, dimension: str, key: str | None = None) -> dict[str, int]:
+        queryset = self.filter(dimension=dimension)
+        if key is not None:
+            queryset = queryset.filter(key=key)
+        return dict(
+            queryset.values("key")
+            .annotate(total=models.Sum("count"))
+            .order_by("key")
+            .values_list("key", "total")
+        )
 
-class RideQuerySet(models.QuerySet):
+
+class RideQuerySet(ShardRoutedQuerySet):
     def with_rider_and_driver(self):
         return self.select_related("id_rider", "id_driver")
 
@@ -23,8 +180,15 @@ class RideQuerySet(models.QuerySet):
             description=RideEventType.STATUS_PICKUP,
         ).order_by("-created_at")
 
+        # compacted rides keep their events in event_timeline, Greatest()
+        # skips whichever is NULL
         return self.annotate(
-            pickup_event_time=Subquery(pickup_event.values("created_at")[:1])
+            pickup_event_time=Greatest(
+                Subquery(pickup_event.values("created_at")[:1]),
+                TimelineEventTime(
+                    models.F("event_timeline"), RideEventType.STATUS_PICKUP
+                ),
+            )
         )
 
     def with_todays_ride_events(self):
@@ -34,15 +198,261 @@ class RideQuerySet(models.QuerySet):
             Prefetch(
                 "ride_events",
                 queryset=RideEvent.objects.recent(),
-                to_attr="todays_ride_events",
+                # merged with event_timeline by Ride.todays_ride_events
+                to_attr="_todays_ride_event_rows",
             )
         )
 
+    def for_fields(self, fields: list[str], join_users: bool = True):
+        """
+        Load only what the given serializer fields need: the user joins and the
+        events prefetch only when requested, `.only()` on the ride columns.
+        Without `join_users` rider/driver only load their id.
+        """
+        queryset = self
+        columns = ["id_ride"]
+
+        for name in fields:
+            if name in RELATED_FIELDS:
+                relation = RELATED_FIELDS[name]
+                columns.append(relation)
+                if not join_users:
+                    continue
+                queryset = queryset.select_related(relation)
+                columns.extend(
+                    f"{relation}__{user_field}"
+                    for user_field in BaseUserSerializer.Meta.fields
+                )
+            elif name == "todays_ride_events":
+                queryset = queryset.with_todays_ride_events()
+                columns.append("event_timeline")
+            else:
+                columns.append(name)
+
+        return queryset.only(*columns)
+
     def status(self, status: str):
         return self.filter(status=status)
 
+    def active(self):
+        from .models import RideStatus  # avoid circular import
+
+        return self.filter(status__in=[RideStatus.EN_ROUTE, RideStatus.PICKUP])
+
+    def region(self, region: str):
+        west, east = REGIONS[region]
+        queryset = self.filter(pickup_longitude__gte=west)
+        # the easternmost region includes 180 itself
+        if region != list(REGIONS)[-1]:
+            queryset = queryset.filter(pickup_longitude__lt=east)
+        return queryset
+
+    def pickup_between(self, after=None, before=None):
+        """
+        Rides picked up at or after `after` and before `before`, either bound
+        optional (`ride_pickup_time_brin_idx`).
+        """
+        queryset = self
+        if after is not None:
+            queryset = queryset.filter(pickup_time__gte=after)
+        if before is not None:
+            queryset = queryset.filter(pickup_time__lt=before)
+        return queryset
+
+    def history(self, relation: str, id_user: int, before=None):
+        """
+        The user's rides as rider or driver (`relation` "id_rider" or
+        "id_driver"), latest pickup first. `before` is the keyset cursor, the
+        `(pickup_time, id_ride)` of the previous page's last ride: one range
+        scan of `ride_rider_pickup_idx`/`ride_driver_pickup_idx` however deep
+        the page.
+        """
+        queryset = self.filter(**{relation: id_user})
+        if before is not None:
+            pickup_time, id_ride = before
+            queryset = queryset.filter(pickup_time__lte=pickup_time).exclude(
+                pickup_time=pickup_time, id_ride__gte=id_ride
+            )
+        return queryset.order_by("-pickup_time", "-id_ride")
+
+    def trip_distance(self, min_km: float | None = None, max_km: float | None = None):
+        """
+        Rides whose pickup to dropoff distance (`distance_km`) is in the range.
+        """
+        queryset = self
+        if min_km is not None:
+            queryset = queryset.filter(distance_km__gte=min_km)
+        if max_km is not None:
+            queryset = queryset.filter(distance_km__lte=max_km)
+        return queryset
+
+    def trip_overlaps(self, west: float, south: float, east: float, north: float):
+        """
+        Rides whose pickup/dropoff bounding box overlaps the given one.
+        """
+        trip = box(
+            models.F("bbox_west"),
+            models.F("bbox_south"),
+            models.F("bbox_east"),
+            models.F("bbox_north"),
+        )
+        area = box(*(models.Value(float(v)) for v in (west, south, east, north)))
+        return self.filter(Overlaps(trip, area))
+
     def rider_email(self, email: str):
-        return self.filter(id_rider__email__iexact=email)
+        """
+        Resolve the email to an id_user first (cached, via the `lower(email)` index)
+        so the ride filter is a plain indexed `id_rider = ?` instead of an
+        `UPPER(email) = UPPER(...)` across the join.
+        """
+        id_rider = User.objects.id_for_email(email)
+        if id_rider is None:
+            return self.none()
+        return self.filter(id_rider=id_rider)
+
+    def search(self, term: str):
+        """
+        Rides whose rider or driver matches `term` (see `User.objects.search()`,
+        may raise SearchTooBroad), annotated with `search_rank`: the position of
+        the better matching of the two among the matches, 1 being the best.
+        """
+        ids = User.objects.search(term)
+        return self.filter(Q(id_rider__in=ids) | Q(id_driver__in=ids)).annotate(
+            search_rank=Least(
+                search_rank(ids, "id_rider"), search_rank(ids, "id_driver")
+            )
+        )
+
+    def transition(self, id_ride: int, status: str) -> int | None:
+        """
+        Move a ride to `status`, record the matching RideEvent and move the
+        status counters in one statement, guarded on the ride still being in the
+        previous status.
+
+        Returns the new id_ride_event, or None when the ride isn't in the
+        expected status (e.g. a concurrent dispatcher moved it first) or doesn't
+        exist. Concurrent callers never both succeed: the loser re-checks the
+        status after the winner's row lock is released and updates nothing.
+        """
+        from .models import (  # avoid circular import
+            RIDE_STATUS_EVENTS,
+            RIDE_STATUS_TRANSITIONS,
+            Ride,
+            RideEvent,
+            RideStatsCounter,
+            RideStatsDimension,
+        )
+
+        if status not in RIDE_STATUS_TRANSITIONS:
+            raise ValueError(f"Rides can't transition to {status!r}")
+
+        previous_status = RIDE_STATUS_TRANSITIONS[status]
+        count_status = (
+            RideStatsCounter.objects.using(self.db)
+            .upsert_sql()
+            .format(
+                rows="""
+                SELECT %s, deltas.key, %s, deltas.delta
+                FROM updated, (VALUES (%s, 1), (%s, -1)) AS deltas (key, delta)
+            """
+            )
+        )
+
+        quote = connections[self.db].ops.quote_name
+        sql = f"""
+            WITH updated AS (
+                UPDATE {quote(Ride._meta.db_table)}
+                SET status = %s
+                WHERE id_ride = %s AND status = %s
+                RETURNING id_ride, pickup_latitude, pickup_longitude
+            ), counted AS ({count_status}
+            ), inserted AS (
+                INSERT INTO {quote(RideEvent._meta.db_table)}
+                    (id_ride, description, created_at)
+                SELECT id_ride, %s, %s FROM updated
+                RETURNING id_ride_event
+            )
+            SELECT inserted.id_ride_event, updated.pickup_latitude,
+                updated.pickup_longitude
+            FROM inserted, updated
+        """
+        params = [
+            status,
+            id_ride,
+            previous_status,
+            RideStatsDimension.STATUS,
+            random.randrange(STATS_COUNTER_SHARDS),
+            status,
+            previous_status,
+            RIDE_STATUS_EVENTS[status],
+            timezone.now(),
+        ]
+
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is None:
+            return None
+
+        # the status filter on heatmap tiles changed for this pickup point
+        id_ride_event, latitude, longitude = row
+        transaction.on_commit(
+            partial(invalidate_points, [(latitude, longitude)]), using=self.db
+        )
+        transaction.on_commit(partial(invalidate_rides, [id_ride]), using=self.db)
+        return id_ride_event
+
+    def apply_query_params(self, params: dict):
+        """
+        Apply validated `RideQueryParamsSerializer` data (filters + ordering).
+        """
+        queryset = self
+
+        if status := params.get("status"):
+            queryset = queryset.status(status)
+
+        if region := params.get("region"):
+            queryset = queryset.region(region)
+
+        if rider_email := params.get("rider_email"):
+            queryset = queryset.rider_email(rider_email)
+        elif "id_rider" in params:
+            # rider_email already resolved, see rides.prepared
+            queryset = queryset.filter(id_rider=params["id_rider"])
+
+        if term := params.get("q"):
+            queryset = queryset.search(term)
+
+        if "pickup_after" in params or "pickup_before" in params:
+            queryset = queryset.pickup_between(
+                params.get("pickup_after"), params.get("pickup_before")
+            )
+
+        if "min_distance_km" in params or "max_distance_km" in params:
+            queryset = queryset.trip_distance(
+                params.get("min_distance_km"), params.get("max_distance_km")
+            )
+
+        if BBOX_PARAMS[0] in params:
+            queryset = queryset.trip_overlaps(*(params[name] for name in BBOX_PARAMS))
+
+        if ordering := params.get("ordering"):
+            if ordering in ("pickup_time", "-pickup_time"):
+                order_field = ordering.replace("pickup_time", "pickup_event_time")
+                queryset = queryset.with_pickup_event_time().order_by(order_field)
+            elif ordering in ("distance", "-distance"):
+                latitude = params.get("latitude")
+                longitude = params.get("longitude")
+
+                if latitude is not None and longitude is not None:
+                    queryset = queryset.distance_from(latitude, longitude).order_by(
+                        ordering
+                    )
+        elif "q" in params:
+            # best matches first
+            queryset = queryset.order_by("search_rank", "id_ride")
+
+        return queryset
 
     def distance_from(self, latitude: float, longitude: float):
         """
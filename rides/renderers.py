@@ -0,0 +1,28 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class SideloadedJSONRenderer(JSONRenderer):
+    """
+    Ride pages that reference users by id, with each distinct user included
+    once under "users". Selected by `?format=sideloaded` or the media type.
+    """
+
+    media_type = "application/vnd.wingz.sideloaded+json"
+    format = "sideloaded"
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """
+    Like `SideloadedJSONRenderer`, with "results" and "users" laid out as one
+    array per field instead of one object per row.
+    """
+
+    media_type = "application/vnd.wingz.columnar+json"
+    format = "columnar"
+
+
+SIDELOADED_FORMATS = {SideloadedJSONRenderer.format, ColumnarJSONRenderer.format}
+
+
+def to_columns(rows: list[dict], fields: list[str]) -> dict[str, list]:
+    return {field: [row[field] for row in rows] for field in fields}
@@ -0,0 +1,91 @@
+"""
+Serialized rides by id, for `GET|POST /api/rides/batch/` and `/api/rides/mine/`.
+
+Entries are the default `RideSerializer` representation, or for
+`/api/rides/mine/` the `OwnRideSerializer` one of each role. `Ride.save()`,
+`Ride.delete()`, `RideEvent.save()`/`delete()` and status transitions drop a
+ride's entry once their transaction commits. Writes that bypass those
+(`bulk_create`, queryset `update()`/`delete()`) and changes to a rider or driver
+are only picked up when the entry expires.
+
+The first page of `/api/rides/mine/` is cached per user as the ids (and pickup
+times) of their newest rides, `Ride.save()`/`delete()` drop the rider's and
+driver's entries. Transitions and events don't change which rides are on it.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+RIDE_CACHE_TIMEOUT = 60 * 5
+RIDE_HISTORY_CACHE_TIMEOUT = 60 * 5
+# same window as `RideEventQuerySet.recent()` for todays_ride_events
+RECENT_EVENTS_WINDOW = timedelta(hours=24)
+
+
+# "" for RideSerializer, the roles for OwnRideSerializer
+RIDE_CACHE_VARIANTS = ("", "rider", "driver")
+
+
+def ride_cache_key(id_ride: int, variant: str = "") -> str:
+    if variant:
+        return f"rides:ride:{variant}:{id_ride}"
+    return f"rides:ride:{id_ride}"
+
+
+def ride_history_cache_key(role: str, id_user: int) -> str:
+    return f"rides:history:{role}:{id_user}"
+
+
+def get_cached_rides(ids, variant: str = "") -> dict[int, dict]:
+    cached = cache.get_many([ride_cache_key(id_ride, variant) for id_ride in ids])
+    return {
+        id_ride: cached[key]
+        for id_ride in ids
+        if (key := ride_cache_key(id_ride, variant)) in cached
+    }
+
+
+def cache_rides(rides, serialized, variant: str = ""):
+    """
+    Cache `serialized` (the representations of the `rides` instances). An entry
+    expires early when one of its events is about to drop out of
+    todays_ride_events.
+    """
+    now = timezone.now()
+    by_timeout = defaultdict(dict)
+
+    for ride, data in zip(rides, serialized, strict=True):
+        timeout = RIDE_CACHE_TIMEOUT
+        for event in getattr(ride, "todays_ride_events", ()):
+            leaves_window = event.created_at + RECENT_EVENTS_WINDOW - now
+            timeout = min(timeout, max(1, int(leaves_window.total_seconds())))
+        by_timeout[timeout][ride_cache_key(ride.pk, variant)] = data
+
+    for timeout, entries in by_timeout.items():
+        cache.set_many(entries, timeout)
+
+
+def invalidate_rides(ids):
+    cache.delete_many(
+        [
+            ride_cache_key(id_ride, variant)
+            for id_ride in ids
+            for variant in RIDE_CACHE_VARIANTS
+        ]
+    )
+
+
+def invalidate_ride_history(user_ids):
+    """
+    Drop the cached newest rides of these users, as rider and as driver.
+    """
+    cache.delete_many(
+        [
+            ride_history_cache_key(role, id_user)
+            for id_user in user_ids
+            for role in ("rider", "driver")
+        ]
+    )
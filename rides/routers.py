@@ -0,0 +1,38 @@
+from django.db import DEFAULT_DB_ALIAS
+
+from .sharding import is_sharded, shard_for_point, shard_for_ride_id
+
+
+class RideShardRouter:
+    """
+    Rides, their events and status counters go to the ride's shard (see
+    `rides.sharding`), every other model to "default". Without an instance to
+    go by, queries on sharded models need an explicit `.using()`.
+    """
+
+    def _route(self, model, instance=None, **hints):
+        if not is_sharded(model):
+            return DEFAULT_DB_ALIAS
+        if instance is None or not is_sharded(type(instance)):
+            return None
+        if instance._state.db and not instance._state.adding:
+            return instance._state.db
+
+        fields = instance.__dict__
+        if "pickup_latitude" in fields and "pickup_longitude" in fields:
+            return shard_for_point(instance.pickup_latitude, instance.pickup_longitude)
+        if fields.get("id_ride_id") is not None:
+            return shard_for_ride_id(instance.id_ride_id)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # users are copied into every shard that references them
+        if not (is_sharded(type(obj1)) and is_sharded(type(obj2))):
+            return True
+        return obj1._state.db == obj2._state.db
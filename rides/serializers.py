@@ -1,9 +1,42 @@
+import math
+import time
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import serializers
+from rest_framework.exceptions import APIException
+from rest_framework.status import HTTP_409_CONFLICT
+
+from users.models import SEARCH_MIN_LENGTH, User
+from users.serializers import BaseUserSerializer, UserNameSerializer
+
+from .feed import parse_cursor
+from .heatmap import MAX_ZOOM
+from .models import (
+    LATITUDE_MAX,
+    LATITUDE_MIN,
+    LONGITUDE_MAX,
+    LONGITUDE_MIN,
+    RIDE_STATUS_TRANSITIONS,
+    Ride,
+    RideEvent,
+    RideEventType,
+    RideStatsDimension,
+    RideStatus,
+)
+from .pagination import RidePagination, decode_history_cursor
+from .queryset import BBOX_PARAMS, RELATED_FIELDS
+from .sharding import REGIONS
+
+MAX_PINGS_PER_BATCH = 5000
+MAX_BATCH_IDS = 100
+MAX_EVENTS_PER_BATCH = 1000
 
-from users.models import User
-from users.serializers import BaseUserSerializer
 
-from .models import Ride, RideEvent, RideStatus
+class RideStatusConflict(APIException):
+    status_code = HTTP_409_CONFLICT
+    default_code = "conflict"
 
 
 class RideQueryParamsSerializer(serializers.Serializer):
@@ -14,6 +47,45 @@ class RideQueryParamsSerializer(serializers.Serializer):
     rider_email = serializers.EmailField(
         required=False,
     )
+    q = serializers.CharField(
+        required=False,
+        min_length=SEARCH_MIN_LENGTH,
+        max_length=100,
+        help_text=(
+            "Rides whose rider or driver name, email or phone number matches "
+            "this (fuzzy), best matches first unless ordered otherwise"
+        ),
+    )
+    region = serializers.ChoiceField(
+        choices=list(REGIONS),
+        required=False,
+        help_text="Only rides picked up in this region (queries just its shard)",
+    )
+    pickup_after = serializers.DateTimeField(
+        required=False,
+        help_text="Only rides with a pickup_time at or after this",
+    )
+    pickup_before = serializers.DateTimeField(
+        required=False,
+        help_text="Only rides with a pickup_time before this",
+    )
+    min_distance_km = serializers.FloatField(
+        required=False,
+        min_value=0,
+        help_text="Only rides whose pickup to dropoff distance is at least this",
+    )
+    max_distance_km = serializers.FloatField(
+        required=False,
+        min_value=0,
+        help_text="Only rides whose pickup to dropoff distance is at most this",
+    )
+    bbox = serializers.CharField(
+        required=False,
+        help_text=(
+            "west,south,east,north: only rides whose pickup/dropoff bounding box "
+            "overlaps this one"
+        ),
+    )
 
     ORDERING_CHOICES = [
         ("pickup_time", "Ascending by pickup time"),
@@ -27,6 +99,11 @@ class RideQueryParamsSerializer(serializers.Serializer):
         help_text="Sort rides by pickup_time or distance",
     )
 
+    fields = serializers.CharField(
+        required=False,
+        help_text="Comma separated list of ride fields to return",
+    )
+
     latitude = serializers.FloatField(
         required=False,
         min_value=-90,
@@ -38,7 +115,49 @@ class RideQueryParamsSerializer(serializers.Serializer):
         max_value=180,
     )
 
+    def validate_fields(self, value):
+        fields = [name.strip() for name in value.split(",") if name.strip()]
+        allowed = RideSerializer.readable_field_names()
+
+        if unknown := [name for name in fields if name not in allowed]:
+            raise serializers.ValidationError(
+                f"Unknown fields: {', '.join(unknown)}. "
+                f"Choose from: {', '.join(allowed)}"
+            )
+        if not fields:
+            raise serializers.ValidationError("At least one field is required")
+        return fields
+
+    def validate_bbox(self, value):
+        try:
+            west, south, east, north = (float(v) for v in value.split(","))
+        except ValueError:
+            raise serializers.ValidationError(
+                "Expected four comma separated numbers: west,south,east,north"
+            ) from None
+        if not (LONGITUDE_MIN <= west <= east <= LONGITUDE_MAX):
+            raise serializers.ValidationError(
+                f"Expected {LONGITUDE_MIN} <= west <= east <= {LONGITUDE_MAX}"
+            )
+        if not (LATITUDE_MIN <= south <= north <= LATITUDE_MAX):
+            raise serializers.ValidationError(
+                f"Expected {LATITUDE_MIN} <= south <= north <= {LATITUDE_MAX}"
+            )
+        return [west, south, east, north]
+
     def validate(self, attrs):
+        if "pickup_after" in attrs and "pickup_before" in attrs:
+            if attrs["pickup_after"] >= attrs["pickup_before"]:
+                raise serializers.ValidationError(
+                    "pickup_after must be earlier than pickup_before"
+                )
+        if attrs.get("min_distance_km", 0) > attrs.get("max_distance_km", math.inf):
+            raise serializers.ValidationError(
+                "min_distance_km can't be greater than max_distance_km"
+            )
+        if bbox := attrs.pop("bbox", None):
+            attrs.update(zip(BBOX_PARAMS, bbox))
+
         ordering = attrs.get("ordering")
         if ordering in ("distance", "-distance"):
             if "latitude" not in attrs or "longitude" not in attrs:
@@ -48,12 +167,82 @@ class RideQueryParamsSerializer(serializers.Serializer):
         return attrs
 
 
+class RideHistoryQueryParamsSerializer(serializers.Serializer):
+    cursor = serializers.CharField(
+        required=False,
+        help_text="The previous page's cursor, omitted for the latest rides",
+    )
+    page_size = serializers.IntegerField(
+        required=False,
+        default=RidePagination.page_size,
+        min_value=1,
+        max_value=RidePagination.max_page_size,
+    )
+
+    def validate_cursor(self, value):
+        try:
+            return decode_history_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError("Invalid cursor.") from None
+
+
 class RideEventSerializer(serializers.ModelSerializer):
     class Meta:
         model = RideEvent
         fields = ["id_ride_event", "description", "created_at"]
 
 
+class RideEventFeedSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RideEvent
+        fields = ["id_ride_event", "id_ride", "description", "created_at"]
+
+
+class RideEventFeedQueryParamsSerializer(serializers.Serializer):
+    after = serializers.CharField(
+        required=False,
+        default="0",
+        help_text=(
+            "Cursor from the previous response, only events after it are "
+            "returned; an id_ride_event applies to every shard"
+        ),
+    )
+    limit = serializers.IntegerField(
+        required=False, default=100, min_value=1, max_value=500
+    )
+    wait = serializers.FloatField(
+        required=False,
+        default=0,
+        min_value=0,
+        max_value=30,
+        help_text="Seconds to wait for new events when there are none yet",
+    )
+    created_after = serializers.DateTimeField(
+        required=False,
+        help_text="Only events created at or after this",
+    )
+    created_before = serializers.DateTimeField(
+        required=False,
+        help_text="Only events created before this",
+    )
+
+    def validate_after(self, value) -> dict[str, int]:
+        try:
+            return parse_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError(
+                "Not a cursor of this feed, start over from 0."
+            ) from None
+
+    def validate(self, attrs):
+        if "created_after" in attrs and "created_before" in attrs:
+            if attrs["created_after"] >= attrs["created_before"]:
+                raise serializers.ValidationError(
+                    "created_after must be earlier than created_before"
+                )
+        return attrs
+
+
 class RideSerializer(serializers.ModelSerializer):
     rider = BaseUserSerializer(source="id_rider", read_only=True)
     driver = BaseUserSerializer(source="id_driver", read_only=True)
@@ -67,6 +256,55 @@ class RideSerializer(serializers.ModelSerializer):
 
     todays_ride_events = RideEventSerializer(many=True, read_only=True)
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # sparse fieldsets (?fields=), write-only fields are left alone
+        if fields := self.context.get("fields"):
+            for name in self.readable_field_names():
+                if name not in fields:
+                    self.fields.pop(name)
+
+        # side-loaded users are referenced by id
+        if self.context.get("sideload"):
+            for name, relation in RELATED_FIELDS.items():
+                if name in self.fields:
+                    self.fields[name] = serializers.IntegerField(
+                        source=f"{relation}_id", read_only=True
+                    )
+
+    def validate_status(self, value):
+        if (
+            self.instance is not None
+            and value != self.instance.status
+            and value not in RIDE_STATUS_TRANSITIONS
+        ):
+            raise serializers.ValidationError(f"Rides can't transition to {value!r}.")
+        return value
+
+    def update(self, instance, validated_data):
+        """
+        A status change goes through `Ride.transition_to()`, like
+        `POST /api/rides/{id}/transition/`: guarded on the previous status, it
+        records the RideEvent and moves the status counters.
+        """
+        new_status = validated_data.pop("status", instance.status)
+        with transaction.atomic(using=instance._state.db):
+            if new_status != instance.status:
+                if instance.transition_to(new_status) is None:
+                    raise RideStatusConflict(
+                        f"Ride {instance.pk} is not "
+                        f"{RIDE_STATUS_TRANSITIONS[new_status]}."
+                    )
+            return super().update(instance, validated_data)
+
+    @classmethod
+    def readable_field_names(cls) -> list[str]:
+        write_only = {
+            name for name, field in cls._declared_fields.items() if field.write_only
+        }
+        return [name for name in cls.Meta.fields if name not in write_only]
+
     class Meta:
         model = Ride
         fields = [
@@ -83,3 +321,211 @@ class RideSerializer(serializers.ModelSerializer):
             "pickup_time",
             "todays_ride_events",
         ]
+
+
+class OwnRideSerializer(RideSerializer):
+    """
+    A rider's or driver's own ride (`/api/rides/mine/`), the other party
+    without their email and phone number. `context["role"]` is the requesting
+    user's.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name, relation in RELATED_FIELDS.items():
+            if name != self.context["role"]:
+                self.fields[name] = UserNameSerializer(source=relation, read_only=True)
+
+
+class RideIdsField(serializers.ListField):
+    """
+    Ride ids as a JSON list, repeated `?ids=` or comma separated `?ids=1,2,3`.
+    """
+
+    child = serializers.IntegerField(min_value=1)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = [data]
+        if isinstance(data, list):
+            data = [
+                part
+                for item in data
+                for part in (item.split(",") if isinstance(item, str) else [item])
+                if part != ""
+            ]
+        # drop repeats, keep the requested order
+        return list(dict.fromkeys(super().to_internal_value(data)))
+
+
+class RideBatchSerializer(serializers.Serializer):
+    ids = RideIdsField(allow_empty=False, max_length=MAX_BATCH_IDS)
+
+
+class RideStatsQueryParamsSerializer(serializers.Serializer):
+    dimension = serializers.ChoiceField(
+        choices=RideStatsDimension.choices,
+        required=False,
+        default=RideStatsDimension.STATUS,
+    )
+    key = serializers.CharField(required=False, max_length=50)
+
+
+class HeatmapTileParamsSerializer(serializers.Serializer):
+    z = serializers.IntegerField(min_value=0, max_value=MAX_ZOOM)
+    x = serializers.IntegerField(min_value=0)
+    y = serializers.IntegerField(min_value=0)
+    status = serializers.ChoiceField(choices=RideStatus.choices, required=False)
+    pickup_after = serializers.DateTimeField(required=False)
+    pickup_before = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        size = 2 ** attrs["z"]
+        if attrs["x"] >= size or attrs["y"] >= size:
+            raise serializers.ValidationError(
+                f"x and y must be below {size} at zoom {attrs['z']}"
+            )
+        return attrs
+
+
+class RideTransitionSerializer(serializers.Serializer):
+    status = serializers.ChoiceField(choices=list(RIDE_STATUS_TRANSITIONS))
+
+
+class LocationPingsField(serializers.Field):
+    """
+    `[{"id_driver", "latitude", "longitude", "timestamp"?}, ...]`
+
+    Validated in a plain loop into `(id_driver, latitude, longitude, timestamp)`
+    tuples, a nested serializer per ping is too slow for ingestion rates.
+    """
+
+    default_error_messages = {
+        "not_a_list": "Expected a list of pings.",
+        "empty": "At least one ping is required.",
+        "max_length": f"At most {MAX_PINGS_PER_BATCH} pings per batch.",
+    }
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            self.fail("not_a_list")
+        if not data:
+            self.fail("empty")
+        if len(data) > MAX_PINGS_PER_BATCH:
+            self.fail("max_length")
+
+        now = time.time()
+        pings = []
+        for i, ping in enumerate(data):
+            try:
+                id_driver = ping["id_driver"]
+                latitude = float(ping["latitude"])
+                longitude = float(ping["longitude"])
+                # future timestamps (clock skew) are clamped to now
+                timestamp = min(float(ping.get("timestamp", now)), now)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                raise serializers.ValidationError(
+                    {i: "id_driver, latitude and longitude are required numbers."}
+                )
+
+            if type(id_driver) is not int:
+                raise serializers.ValidationError({i: "id_driver must be an integer."})
+            if not (
+                LATITUDE_MIN <= latitude <= LATITUDE_MAX
+                and LONGITUDE_MIN <= longitude <= LONGITUDE_MAX
+            ):
+                raise serializers.ValidationError({i: "Coordinates out of range."})
+
+            pings.append((id_driver, latitude, longitude, timestamp))
+        return pings
+
+
+class DriverLocationBatchSerializer(serializers.Serializer):
+    pings = LocationPingsField()
+
+
+class NearestDriversQueryParamsSerializer(serializers.Serializer):
+    latitude = serializers.FloatField(min_value=-90, max_value=90)
+    longitude = serializers.FloatField(min_value=-180, max_value=180)
+    radius_km = serializers.FloatField(
+        required=False, default=5.0, min_value=0.1, max_value=50
+    )
+    limit = serializers.IntegerField(
+        required=False, default=5, min_value=1, max_value=50
+    )
+
+
+class RideEventsField(serializers.Field):
+    """
+    `[{"id_ride", "description", "created_at"?, "idempotency_key"?}, ...]`
+
+    Validated in plain loops (descriptions as one set) into `(id_ride,
+    description, created_at, idempotency_key)` tuples, like `LocationPingsField`.
+    """
+
+    default_error_messages = {
+        "not_a_list": "Expected a list of events.",
+        "empty": "At least one event is required.",
+        "max_length": f"At most {MAX_EVENTS_PER_BATCH} events per batch.",
+    }
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            self.fail("not_a_list")
+        if not data:
+            self.fail("empty")
+        if len(data) > MAX_EVENTS_PER_BATCH:
+            self.fail("max_length")
+
+        try:
+            descriptions = [event["description"] for event in data]
+        except (KeyError, TypeError):
+            raise serializers.ValidationError("Every event needs a description.")
+        if not all(isinstance(description, str) for description in descriptions):
+            raise serializers.ValidationError("Descriptions must be strings.")
+        invalid = set(descriptions) - set(RideEventType.values)
+        if invalid:
+            raise serializers.ValidationError(
+                {
+                    i: f"Invalid description: {description!r}."
+                    for i, description in enumerate(descriptions)
+                    if description in invalid
+                }
+            )
+
+        now = timezone.now()
+        events = []
+        for i, (event, description) in enumerate(zip(data, descriptions)):
+            id_ride = event.get("id_ride")
+            if type(id_ride) is not int:
+                raise serializers.ValidationError({i: "id_ride must be an integer."})
+
+            created_at = event.get("created_at")
+            if created_at is None:
+                created_at = now
+            else:
+                try:
+                    created_at = parse_datetime(created_at)
+                except (TypeError, ValueError):
+                    created_at = None
+                if created_at is None:
+                    raise serializers.ValidationError(
+                        {i: "created_at must be an ISO 8601 datetime."}
+                    )
+                if timezone.is_naive(created_at):
+                    created_at = timezone.make_aware(created_at)
+                # future timestamps (clock skew) are clamped to now
+                created_at = min(created_at, now)
+
+            key = event.get("idempotency_key")
+            if key is not None and not (isinstance(key, str) and 0 < len(key) <= 64):
+                raise serializers.ValidationError(
+                    {i: "idempotency_key must be a string of 1 to 64 characters."}
+                )
+
+            events.append((id_ride, description, created_at, key))
+        return events
+
+
+class RideEventBatchSerializer(serializers.Serializer):
+    events = RideEventsField()
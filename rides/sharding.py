@@ -0,0 +1,196 @@
+"""
+Rides and their events sharded by region across databases.
+
+A ride's region comes from its pickup longitude (`REGIONS`), and
+`settings.RIDE_SHARDS` maps regions to database aliases; unmapped regions, and
+everything while it's empty, stay in "default". A ride's events and status
+counters live on its shard, users stay in "default" and are copied into a shard
+when a ride there references them (the shards' foreign keys need the rows).
+
+Ride and RideEvent ids are interleaved across the shards (each shard's
+sequences step by the number of shards, offset by its position in
+`shard_aliases()`, see `configure_sequences()`), so a ride's shard follows from
+its id alone. `Ride.save()` refuses ids that route elsewhere, i.e. when
+`manage.py shard_sequences` hasn't run since the shards last changed.
+"""
+
+from copy import copy
+from functools import cmp_to_key
+from heapq import merge
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# region -> (west, east) pickup longitude bounds, covering the globe
+REGIONS = {
+    "us_west": (-180.0, -105.0),
+    "us_central": (-105.0, -85.0),
+    "us_east": (-85.0, 180.0),
+}
+
+# the models that live on a ride's shard, by `_meta.label_lower`
+SHARDED_MODELS = {"rides.ride", "rides.rideevent", "rides.ridestatscounter"}
+
+
+def region_for_point(latitude: float, longitude: float) -> str:
+    for region, (_, east) in REGIONS.items():
+        if longitude < east:
+            return region
+    return region
+
+
+def shard_for_region(region: str) -> str:
+    return settings.RIDE_SHARDS.get(region, DEFAULT_DB_ALIAS)
+
+
+def shard_for_point(latitude: float, longitude: float) -> str:
+    return shard_for_region(region_for_point(latitude, longitude))
+
+
+def shard_aliases() -> list[str]:
+    """
+    Every database holding rides, in id interleaving order.
+    """
+    return sorted({shard_for_region(region) for region in REGIONS})
+
+
+def shard_for_ride_id(id_ride: int) -> str:
+    aliases = shard_aliases()
+    return aliases[id_ride % len(aliases)]
+
+
+def check_ride_id(id_ride: int, alias: str):
+    """
+    Raise ImproperlyConfigured if the ride id `alias` handed out routes to
+    another shard.
+    """
+    if (expected := shard_for_ride_id(id_ride)) != alias:
+        raise ImproperlyConfigured(
+            f"Ride {id_ride} was stored on {alias!r} but its id routes to "
+            f"{expected!r}, run `manage.py shard_sequences`"
+        )
+
+
+def group_by_shard(ids) -> dict[str, list[int]]:
+    shards = {}
+    for id_ride in ids:
+        shards.setdefault(shard_for_ride_id(id_ride), []).append(id_ride)
+    return shards
+
+
+def is_sharded(model) -> bool:
+    return model._meta.label_lower in SHARDED_MODELS
+
+
+def configure_sequences(alias: str):
+    """
+    Make `alias` hand out the Ride and RideEvent ids congruent to its position
+    in `shard_aliases()`, above every id it already has.
+    """
+    from .models import Ride, RideEvent  # avoid circular import
+
+    aliases = shard_aliases()
+    count, index = len(aliases), aliases.index(alias)
+
+    with connections[alias].cursor() as cursor:
+        for model in (Ride, RideEvent):
+            table, column = model._meta.db_table, model._meta.pk.column
+            cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [table, column])
+            (sequence,) = cursor.fetchone()
+            cursor.execute(f"ALTER SEQUENCE {sequence} INCREMENT BY {count}")
+
+            quote = connections[alias].ops.quote_name
+            cursor.execute(
+                f"SELECT coalesce(max({quote(column)}), 0) FROM {quote(table)}"
+            )
+            (current,) = cursor.fetchone()
+            next_id = current + 1 + (index - current - 1) % count
+            cursor.execute("SELECT setval(%s, %s, false)", [sequence, next_id])
+
+
+def replicate_users(alias: str, user_ids):
+    """
+    Upsert the users' rows from "default" into the shard `alias`.
+    """
+    from users.models import User  # avoid circular import
+
+    if alias == DEFAULT_DB_ALIAS:
+        return
+    users = list(User.objects.using(DEFAULT_DB_ALIAS).filter(id_user__in=user_ids))
+    User.objects.using(alias).bulk_create(
+        users,
+        update_conflicts=True,
+        unique_fields=["id_user"],
+        update_fields=[
+            field.name for field in User._meta.concrete_fields if not field.primary_key
+        ],
+    )
+
+
+class ScatteredQuerySet:
+    """
+    A queryset run on several shards, presented to the paginator (and the admin
+    changelist) as one ordered sequence: `count()` adds up the shards' counts
+    and a slice takes the first `stop` rows of every shard and k-way merges them
+    on the ordering.
+
+    The ordering is plain fields (foreign keys compare by id) or annotations,
+    the primary key is added as the tie-breaker so each shard's rows come back
+    in merge order. NULLs sort last ascending and first descending, like
+    Postgres.
+    """
+
+    def __init__(self, queryset, aliases: list[str]):
+        opts = queryset.model._meta
+        order_by = list(queryset.query.order_by or opts.ordering)
+        if not {"pk", opts.pk.name} & {field.lstrip("-") for field in order_by}:
+            descending = bool(order_by) and order_by[0].startswith("-")
+            order_by.append(f"-{opts.pk.name}" if descending else opts.pk.name)
+
+        # (attribute, descending) per ordering field
+        self.order = []
+        for field in order_by:
+            name = opts.pk.name if field.lstrip("-") == "pk" else field.lstrip("-")
+            try:
+                name = opts.get_field(name).attname
+            except FieldDoesNotExist:
+                pass  # an annotation
+            self.order.append((name, field.startswith("-")))
+        self.querysets = [
+            queryset.using(alias).order_by(*order_by) for alias in aliases
+        ]
+        self.ordered = True
+
+    def _compare(self, a, b) -> int:
+        for name, descending in self.order:
+            x, y = getattr(a, name), getattr(b, name)
+            x, y = (x is None, x), (y is None, y)
+            if x != y:
+                return (1 if x > y else -1) * (-1 if descending else 1)
+        return 0
+
+    def count(self) -> int:
+        return sum(queryset.count() for queryset in self.querysets)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def _clone(self):
+        # the changelist's whole result list, when it fits on one page
+        return copy(self)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index : index + 1][0]
+
+        start, stop = index.start or 0, index.stop
+        rows = merge(
+            *(queryset[:stop] for queryset in self.querysets),
+            key=cmp_to_key(self._compare),
+        )
+        return list(islice(rows, start, stop))
@@ -1,10 +1,60 @@
-from datetime import timedelta
+import csv
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
+from io import StringIO
+from operator import attrgetter
+from pathlib import Path
+from unittest import mock, skipIf
 
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    DatabaseError,
+    IntegrityError,
+    connection,
+    connections,
+    transaction,
+)
+from django.db.models.sql.compiler import SQLCompiler
+from django.test import LiveServerTestCase, TransactionTestCase, override_settings
 from django.utils import timezone
 from rest_framework import status
+from rest_framework.test import APIClient, APIRequestFactory
 
 from api.tests.base import BaseAPITestCase
-from rides.models import Ride, RideEvent, RideEventType, RideStatus
+from rides import prepared
+from rides.analytics import haversine_km
+from rides.feed import RideEventNotifier, ride_event_notifier
+from rides.heatmap import tile_bounds, tile_for_point
+from rides.ingest import RideEventBuffer
+from rides.locations import STALE_AFTER_SECONDS, DriverLocationStore, driver_locations
+from rides.management.commands.loadtest import SCENARIOS
+from rides.models import (
+    DriverLocation,
+    Ride,
+    RideEvent,
+    RideEventType,
+    RideStatsCounter,
+    RideStatsDimension,
+    RideStatus,
+)
+from rides.ride_cache import ride_cache_key
+from rides.sharding import configure_sequences, shard_aliases, shard_for_ride_id
+from rides.views import RideViewSet
+from users.models import SearchTooBroad, User, UserRole
 
 RIDES_LIST_PATH = "/api/rides/"
 
@@ -81,6 +131,36 @@ class RideListFilteringTests(BaseAPITestCase):
         # Should return 2 rides (en-route and pickup belong to rider@example.com)
         self.assertEqual(response.data["count"], 2)
 
+    def test_filter_by_rider_email_case_insensitive(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.get(f"{RIDES_LIST_PATH}?rider_email=RIDER@Example.com")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 2)
+
+    def test_filter_by_unknown_rider_email(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.get(f"{RIDES_LIST_PATH}?rider_email=nobody@example.com")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 0)
+
+    def test_rider_email_lookup_is_cached(self):
+        Ride.objects.rider_email("rider@example.com").count()
+
+        # only the ride count, the email -> id_user lookup is served from cache
+        with self.assertNumQueries(1):
+            Ride.objects.rider_email("Rider@Example.com").count()
+
+    def test_rider_email_cache_follows_email_change(self):
+        self.assertEqual(Ride.objects.rider_email("jane@example.com").count(), 1)
+
+        self.rider_user_2.email = "jane.doe@example.com"
+        self.rider_user_2.save()
+
+        self.assertEqual(Ride.objects.rider_email("jane@example.com").count(), 0)
+        self.assertEqual(Ride.objects.rider_email("jane.doe@example.com").count(), 1)
+
     def test_combined_filters(self):
         """status and rider_email filters"""
         self._authenticate_as(self.admin_user)
@@ -300,3 +380,3018 @@ class RideListResponseStructureTests(BaseAPITestCase):
         self.assertIn("todays_ride_events", ride)
         self.assertIsInstance(ride["todays_ride_events"], list)
         self.assertEqual(len(ride["todays_ride_events"]), 1)
+
+
+class RideIndexAdvisorTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Ride.objects.create(
+            status=RideStatus.PICKUP,
+            id_rider=cls.rider_user,
+            id_driver=cls.driver_user,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+
+    def test_replays_every_param_combination(self):
+        out = StringIO()
+        call_command(
+            "advise_indexes", "--min-gain", "100", "--allow-locking", stdout=out
+        )
+
+        output = out.getvalue()
+        # 4 statuses (incl. none) x 2 rider emails x 5 orderings
+        self.assertIn("Replaying 40 queries", output)
+        self.assertIn("status=pickup&rider_email=rider@example.com", output)
+        self.assertIn("ms -> ", output)
+
+    def test_candidates_not_built_without_allow_locking(self):
+        out = StringIO()
+        with mock.patch(
+            "rides.management.commands.advise_indexes.Command._time_with_index"
+        ) as time_with_index:
+            call_command("advise_indexes", stdout=out)
+
+        time_with_index.assert_not_called()
+        self.assertIn("Candidate indexes (not timed):", out.getvalue())
+        self.assertIn("--allow-locking", out.getvalue())
+
+        with self.assertRaisesMessage(CommandError, "--allow-locking"):
+            call_command("advise_indexes", "--write", stdout=StringIO())
+
+    def test_workload_file(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as workload:
+            workload.write("?status=pickup&ordering=-pickup_time\nstatus=bogus\n")
+            workload.flush()
+
+            out, err = StringIO(), StringIO()
+            call_command(
+                "advise_indexes", "--workload", workload.name, stdout=out, stderr=err
+            )
+
+        self.assertIn("Replaying 1 queries", out.getvalue())
+        self.assertIn("Skipping {'status': 'bogus'}", err.getvalue())
+
+
+class RideListSparseFieldsTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(3):
+            ride = Ride.objects.create(
+                status=RideStatus.PICKUP,
+                id_rider=cls.rider_user,
+                id_driver=cls.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=timezone.now() + timedelta(hours=i),
+            )
+            RideEvent.objects.create(
+                id_ride=ride,
+                description=RideEventType.STATUS_PICKUP,
+            )
+
+    def test_only_requested_fields_returned(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.get(
+            f"{RIDES_LIST_PATH}?fields=id_ride,status,pickup_latitude,pickup_longitude"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for ride in response.data["results"]:
+            self.assertEqual(
+                set(ride),
+                {"id_ride", "status", "pickup_latitude", "pickup_longitude"},
+            )
+
+    def test_unrequested_relations_are_not_loaded(self):
+        """
+        Expected queries:
+        1. Auth user lookup
+        2. Pagination count
+        3. Rides, no user join and no events prefetch
+        """
+        self._authenticate_as(self.admin_user)
+
+        with self.assertNumQueries(3) as ctx:
+            response = self.client.get(f"{RIDES_LIST_PATH}?fields=id_ride,status")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        rides_sql = ctx.captured_queries[-1]["sql"]
+        self.assertNotIn("JOIN", rides_sql)
+        self.assertNotIn("dropoff_latitude", rides_sql)
+
+    def test_requested_relations_are_loaded_without_n_plus_one(self):
+        self._authenticate_as(self.admin_user)
+
+        with self.assertNumQueries(4):
+            response = self.client.get(
+                f"{RIDES_LIST_PATH}?fields=id_ride,driver,todays_ride_events"
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        ride = response.data["results"][0]
+        self.assertEqual(set(ride), {"id_ride", "driver", "todays_ride_events"})
+        self.assertEqual(ride["driver"]["email"], "driver@example.com")
+        self.assertEqual(len(ride["todays_ride_events"]), 1)
+
+    def test_sparse_fields_with_pickup_time_ordering(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.get(
+            f"{RIDES_LIST_PATH}?fields=id_ride&ordering=-pickup_time"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 3)
+
+    def test_unknown_field_rejected(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.get(f"{RIDES_LIST_PATH}?fields=id_ride,rider_id")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("fields", response.data)
+
+
+class RideListSideloadedFormatTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(4):
+            ride = Ride.objects.create(
+                status=RideStatus.PICKUP,
+                id_rider=cls.rider_user if i % 2 else cls.rider_user_2,
+                id_driver=cls.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=timezone.now() + timedelta(hours=i),
+            )
+            RideEvent.objects.create(
+                id_ride=ride,
+                description=RideEventType.STATUS_PICKUP,
+            )
+
+    def setUp(self):
+        self._authenticate_as(self.admin_user)
+
+    def test_sideloaded_users(self):
+        """
+        Expected queries:
+        1. Auth user lookup
+        2. Pagination count
+        3. Rides, no user join
+        4. Today's RideEvents
+        5. The page's distinct users
+        """
+        with self.assertNumQueries(5) as ctx:
+            response = self.client.get(RIDES_LIST_PATH, {"format": "sideloaded"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response["Content-Type"], "application/vnd.wingz.sideloaded+json"
+        )
+        self.assertNotIn("JOIN", ctx.captured_queries[2]["sql"])
+
+        data = response.json()
+        self.assertEqual(data["count"], 4)
+        ride = data["results"][0]
+        self.assertEqual(ride["rider"], self.rider_user_2.id_user)
+        self.assertEqual(ride["driver"], self.driver_user.id_user)
+        self.assertEqual(len(ride["todays_ride_events"]), 1)
+        self.assertEqual(
+            [user["id_user"] for user in data["users"]],
+            sorted(
+                [
+                    self.rider_user.id_user,
+                    self.rider_user_2.id_user,
+                    self.driver_user.id_user,
+                ]
+            ),
+        )
+
+    def test_accept_header(self):
+        response = self.client.get(
+            RIDES_LIST_PATH, HTTP_ACCEPT="application/vnd.wingz.sideloaded+json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("users", response.json())
+
+    def test_columnar(self):
+        response = self.client.get(
+            RIDES_LIST_PATH,
+            {"format": "columnar", "fields": "id_ride,status,driver"},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(set(data["results"]), {"id_ride", "status", "driver"})
+        self.assertEqual(data["results"]["status"], [RideStatus.PICKUP] * 4)
+        self.assertEqual(data["results"]["driver"], [self.driver_user.id_user] * 4)
+        self.assertEqual(data["users"]["id_user"], [self.driver_user.id_user])
+        self.assertEqual(data["users"]["email"], [self.driver_user.email])
+
+    def test_no_users_without_user_fields(self):
+        # the users query is skipped, nothing references them
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                RIDES_LIST_PATH, {"format": "sideloaded", "fields": "id_ride"}
+            )
+
+        self.assertEqual(response.json()["users"], [])
+
+    def test_default_format_unchanged(self):
+        response = self.client.get(RIDES_LIST_PATH)
+
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertNotIn("users", response.data)
+        self.assertEqual(
+            response.data["results"][0]["rider"]["email"], "jane@example.com"
+        )
+
+    def test_only_on_the_list(self):
+        ride = Ride.objects.first()
+        response = self.client.get(
+            f"{RIDES_LIST_PATH}{ride.id_ride}/", {"format": "sideloaded"}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RideListMemoryProfileTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(3):
+            Ride.objects.create(
+                id_rider=cls.rider_user,
+                id_driver=cls.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=timezone.now() + timedelta(hours=i),
+            )
+
+    def setUp(self):
+        cache.clear()
+        self._authenticate_as(self.admin_user)
+
+    def test_profiled_list(self):
+        for params in ({}, {"format": "sideloaded"}):
+            response = self.client.get(RIDES_LIST_PATH, {**params, "memory_profile": 1})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.data["results"]), 3)
+
+            response = self.client.get(
+                f"/api/memory-profiles/{response['X-Memory-Profile']}/"
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                [phase["name"] for phase in response.data["phases"]],
+                ["queryset", "serialization", "rendering"],
+            )
+            self.assertGreater(response.data["response_kib"], 0)
+            self.assertFalse(tracemalloc.is_tracing())
+
+        response = self.client.get("/api/memory-profiles/")
+        self.assertEqual(len(response.data), 2)
+        self.assertIn("format=sideloaded", response.data[0]["path"])
+
+    def test_unprofiled_list(self):
+        response = self.client.get(RIDES_LIST_PATH)
+
+        self.assertNotIn("X-Memory-Profile", response)
+        self.assertEqual(self.client.get("/api/memory-profiles/").data, [])
+
+    def test_failed_list_stops_profiling(self):
+        response = self.client.get(
+            RIDES_LIST_PATH, {"status": "nope", "memory_profile": 1}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn("X-Memory-Profile", response)
+        self.assertFalse(tracemalloc.is_tracing())
+        # the next request can be profiled
+        response = self.client.get(RIDES_LIST_PATH, {"memory_profile": 1})
+        self.assertIn("X-Memory-Profile", response)
+
+    def test_failed_rendering_stops_profiling(self):
+        with (
+            mock.patch(
+                "rest_framework.renderers.JSONRenderer.render",
+                side_effect=RuntimeError("can't render"),
+            ),
+            self.assertRaises(RuntimeError),
+        ):
+            self.client.get(RIDES_LIST_PATH, {"memory_profile": 1})
+
+        self.assertFalse(tracemalloc.is_tracing())
+        response = self.client.get(RIDES_LIST_PATH, {"memory_profile": 1})
+        self.assertIn("X-Memory-Profile", response)
+
+    def test_admin_only(self):
+        self._authenticate_as(self.rider_user)
+
+        response = self.client.get("/api/memory-profiles/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(f"/api/memory-profiles/{'0' * 32}/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_unknown_report(self):
+        response = self.client.get(f"/api/memory-profiles/{'0' * 32}/")
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RideBatchTests(BaseAPITestCase):
+    BATCH_PATH = f"{RIDES_LIST_PATH}batch/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.rides = []
+        for i in range(3):
+            ride = Ride.objects.create(
+                status=RideStatus.EN_ROUTE,
+                id_rider=cls.rider_user,
+                id_driver=cls.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=timezone.now() + timedelta(hours=i),
+            )
+            RideEvent.objects.create(
+                id_ride=ride, description=RideEventType.STATUS_EN_ROUTE
+            )
+            cls.rides.append(ride)
+
+    def setUp(self):
+        cache.clear()
+        self._authenticate_as(self.admin_user)
+
+    def _ids(self, *rides):
+        return ",".join(str(ride.id_ride) for ride in rides)
+
+    def test_requested_order_and_missing(self):
+        """
+        Expected queries:
+        1. Auth user lookup
+        2. Rides with select_related for rider + driver
+        3. Today's RideEvents via prefetch_related
+        """
+        first, second, third = self.rides
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                self.BATCH_PATH, {"ids": f"{self._ids(third, first)},999999"}
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [ride["id_ride"] for ride in response.data["results"]],
+            [third.id_ride, first.id_ride],
+        )
+        self.assertEqual(response.data["missing"], [999999])
+        self.assertEqual(
+            response.data["results"][0]["rider"]["email"], "rider@example.com"
+        )
+        self.assertEqual(len(response.data["results"][0]["todays_ride_events"]), 1)
+
+    def test_post_body(self):
+        response = self.client.post(
+            self.BATCH_PATH,
+            {"ids": [ride.id_ride for ride in self.rides]},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 3)
+
+    def test_cached_rides_skip_the_database(self):
+        self.client.get(self.BATCH_PATH, {"ids": self._ids(self.rides[0])})
+
+        # auth user only
+        with self.assertNumQueries(1):
+            self.client.get(self.BATCH_PATH, {"ids": self._ids(self.rides[0])})
+
+        # only the uncached ride is loaded
+        with self.assertNumQueries(3) as ctx:
+            response = self.client.get(self.BATCH_PATH, {"ids": self._ids(*self.rides)})
+        self.assertEqual(len(response.data["results"]), 3)
+        self.assertIn(
+            f"IN ({self.rides[1].id_ride}, {self.rides[2].id_ride})",
+            ctx.captured_queries[1]["sql"],
+        )
+
+    def test_writes_invalidate(self):
+        ride = self.rides[0]
+        params = {"ids": self._ids(ride)}
+        self.client.get(self.BATCH_PATH, params)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ride = Ride.objects.get(pk=ride.pk)
+            ride.dropoff_latitude = 41.0
+            ride.save()
+        result = self.client.get(self.BATCH_PATH, params).data["results"][0]
+        self.assertEqual(result["dropoff_latitude"], 41.0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            RideEvent.objects.create(
+                id_ride=ride, description=RideEventType.STATUS_PICKUP
+            )
+        result = self.client.get(self.BATCH_PATH, params).data["results"][0]
+        self.assertEqual(len(result["todays_ride_events"]), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Ride.objects.transition(ride.id_ride, RideStatus.PICKUP)
+        result = self.client.get(self.BATCH_PATH, params).data["results"][0]
+        self.assertEqual(result["status"], RideStatus.PICKUP)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ride.delete()
+        response = self.client.get(self.BATCH_PATH, params)
+        self.assertEqual(response.data["missing"], [int(params["ids"])])
+
+    def test_invalid_ids(self):
+        for ids in ("", "1,abc", ",".join(str(i) for i in range(1, 102))):
+            response = self.client.get(self.BATCH_PATH, {"ids": ids})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, ids)
+
+
+@skipIf(
+    settings.CACHES["default"]["BACKEND"].endswith("LocMemCache"),
+    "needs a cache shared between processes (REDIS_URL or MEMCACHED_LOCATION)",
+)
+class RideCacheSharingTests(TransactionTestCase):
+    """
+    Another worker process writes a ride this one has cached.
+    """
+
+    def setUp(self):
+        admin = User.objects.create_user(
+            username="cache_admin", email="cache.admin@example.com", role=UserRole.ADMIN
+        )
+        self.ride = Ride.objects.create(
+            id_rider=admin,
+            id_driver=admin,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(admin)
+
+    def _dropoff_latitude(self):
+        response = self.client.get(
+            f"{RIDES_LIST_PATH}batch/", {"ids": self.ride.id_ride}
+        )
+        return response.data["results"][0]["dropoff_latitude"]
+
+    def test_write_in_another_process_invalidates(self):
+        self.assertEqual(self._dropoff_latitude(), 40.7580)
+        self.assertIsNotNone(cache.get(ride_cache_key(self.ride.id_ride)))
+
+        script = (
+            "import sys, django\n"
+            "django.setup()\n"
+            "from rides.models import Ride\n"
+            "ride = Ride.objects.get(pk=int(sys.argv[1]))\n"
+            "ride.dropoff_latitude = 41.0\n"
+            "ride.save()\n"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", script, str(self.ride.id_ride)],
+            cwd=settings.BASE_DIR,
+            env={
+                **os.environ,
+                "DJANGO_SETTINGS_MODULE": "api.settings",
+                "DB_NAME": connection.settings_dict["NAME"],
+            },
+            capture_output=True,
+            timeout=60,
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIsNone(cache.get(ride_cache_key(self.ride.id_ride)))
+        self.assertEqual(self._dropoff_latitude(), 41.0)
+
+
+class RideHistoryTests(BaseAPITestCase):
+    MINE_PATH = f"{RIDES_LIST_PATH}mine/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        start = timezone.now() - timedelta(days=10)
+
+        def ride(rider, pickup_time):
+            return Ride.objects.create(
+                id_rider=rider,
+                id_driver=cls.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=pickup_time,
+            )
+
+        # two rides share a pickup_time, the cursor has to tell them apart
+        cls.rides = [ride(cls.rider_user, start + timedelta(days=i)) for i in range(4)]
+        cls.rides.append(ride(cls.rider_user, cls.rides[2].pickup_time))
+        cls.other = ride(cls.rider_user_2, start)
+
+    def setUp(self):
+        cache.clear()
+        self._authenticate_as(self.rider_user)
+
+    def _ids(self, response):
+        return [ride["id_ride"] for ride in response.data["results"]]
+
+    def _latest_first(self, rides):
+        return [
+            ride.pk
+            for ride in sorted(rides, key=lambda r: (r.pickup_time, r.pk), reverse=True)
+        ]
+
+    def test_pages_through_own_rides(self):
+        ids, cursor = [], None
+        while True:
+            params = {"page_size": 2, **({"cursor": cursor} if cursor else {})}
+            response = self.client.get(self.MINE_PATH, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += self._ids(response)
+            cursor = response.data["cursor"]
+            if cursor is None:
+                break
+
+        self.assertEqual(ids, self._latest_first(self.rides))
+        self.assertEqual(
+            response.data["results"][-1]["rider"]["email"], "rider@example.com"
+        )
+
+    def test_drivers_see_the_rides_they_drive(self):
+        self._authenticate_as(self.driver_user)
+        response = self.client.get(self.MINE_PATH, {"page_size": 100})
+
+        self.assertEqual(
+            self._ids(response), self._latest_first([*self.rides, self.other])
+        )
+        self.assertIsNone(response.data["cursor"])
+
+    def test_other_partys_contact_details_are_left_out(self):
+        for user, own, other in (
+            (self.rider_user, "rider", "driver"),
+            (self.driver_user, "driver", "rider"),
+        ):
+            # the batch endpoint caches the admin representation of the ride
+            self._authenticate_as(self.admin_user)
+            self.client.get(f"{RIDES_LIST_PATH}batch/", {"ids": self.rides[0].pk})
+            self._authenticate_as(user)
+
+            ride = self.client.get(self.MINE_PATH).data["results"][-1]
+
+            self.assertEqual(ride[own]["email"], user.email)
+            self.assertEqual(
+                set(ride[other]), {"id_user", "first_name", "last_name"}, user
+            )
+
+    def test_admins_and_anonymous_users_are_rejected(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.get(self.MINE_PATH)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.credentials()
+        response = self.client.get(self.MINE_PATH)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_latest_page_is_cached(self):
+        self.client.get(self.MINE_PATH)
+
+        # auth user only, for any page size
+        with self.assertNumQueries(1):
+            response = self.client.get(self.MINE_PATH, {"page_size": 3})
+        self.assertEqual(self._ids(response), self._latest_first(self.rides)[:3])
+
+        # a new ride shows up once its transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            ride = Ride.objects.create(
+                id_rider=self.rider_user,
+                id_driver=self.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=timezone.now(),
+            )
+        response = self.client.get(self.MINE_PATH)
+        self.assertEqual(self._ids(response)[0], ride.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ride.delete()
+        response = self.client.get(self.MINE_PATH)
+        self.assertNotIn(ride.pk, self._ids(response))
+
+    def test_later_pages_are_one_range_scan(self):
+        first = self.client.get(self.MINE_PATH, {"page_size": 2})
+
+        # auth user, the keyset page, the rides not cached yet with their events
+        with self.assertNumQueries(4) as ctx:
+            self.client.get(
+                self.MINE_PATH, {"page_size": 2, "cursor": first.data["cursor"]}
+            )
+        self.assertIn('"pickup_time" <=', ctx.captured_queries[1]["sql"])
+        self.assertIn("LIMIT 3", ctx.captured_queries[1]["sql"])
+
+    def test_rider_index_serves_the_page(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        queryset = Ride.objects.history("id_rider", self.rider_user.pk)[:10]
+        self.assertIn("ride_rider_pickup_idx", queryset.explain())
+
+    def test_invalid_params(self):
+        for params in ({"cursor": "abc"}, {"cursor": "MjAyNnwx"}, {"page_size": 101}):
+            response = self.client.get(self.MINE_PATH, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+
+class DriverLocationTests(BaseAPITestCase):
+    LOCATIONS_PATH = "/api/drivers/locations/"
+    NEAREST_PATH = "/api/drivers/nearest/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.busy_driver = User.objects.create_user(
+            username="busy_driver",
+            email="busy.driver@example.com",
+            first_name="Busy",
+            last_name="Driver",
+            role=UserRole.DRIVER,
+            password="testpass123",
+        )
+        Ride.objects.create(
+            status=RideStatus.PICKUP,
+            id_rider=cls.rider_user,
+            id_driver=cls.busy_driver,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+
+    def setUp(self):
+        driver_locations.clear()
+        self.addCleanup(driver_locations.clear)
+        # no sync thread here, it wouldn't see the test transaction
+        patcher = mock.patch.object(driver_locations, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _ping(self, user, latitude, longitude, **extra):
+        return {
+            "id_driver": user.id_user,
+            "latitude": latitude,
+            "longitude": longitude,
+            **extra,
+        }
+
+    def test_driver_reports_own_location(self):
+        self._authenticate_as(self.driver_user)
+        response = self.client.post(
+            self.LOCATIONS_PATH,
+            {"pings": [self._ping(self.driver_user, 40.7128, -74.0060)]},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data["accepted"], 1)
+        self.assertEqual(
+            driver_locations.get(self.driver_user.id_user)[:2], (40.7128, -74.0060)
+        )
+
+    def test_driver_cannot_report_other_drivers(self):
+        self._authenticate_as(self.driver_user)
+        response = self.client.post(
+            self.LOCATIONS_PATH,
+            {"pings": [self._ping(self.busy_driver, 40.7128, -74.0060)]},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_rider_cannot_report_locations(self):
+        self._authenticate_as(self.rider_user)
+        response = self.client.post(
+            self.LOCATIONS_PATH,
+            {"pings": [self._ping(self.rider_user, 40.7128, -74.0060)]},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_admin_batch_rejects_non_drivers(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.post(
+            self.LOCATIONS_PATH,
+            {
+                "pings": [
+                    self._ping(self.driver_user, 40.7128, -74.0060),
+                    self._ping(self.rider_user, 40.7128, -74.0060),
+                ]
+            },
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(driver_locations), 0)
+
+    def test_invalid_ping_rejected(self):
+        self._authenticate_as(self.driver_user)
+        response = self.client.post(
+            self.LOCATIONS_PATH,
+            {"pings": [self._ping(self.driver_user, 95, -74.0060)]},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_out_of_order_pings_ignored(self):
+        now = time.time()
+        driver_locations.ingest([(self.driver_user.id_user, 1.0, 1.0, now)])
+        applied = driver_locations.ingest(
+            [(self.driver_user.id_user, 2.0, 2.0, now - 10)]
+        )
+
+        self.assertEqual(applied, 0)
+        self.assertEqual(driver_locations.get(self.driver_user.id_user)[:2], (1.0, 1.0))
+
+    def test_nearest_excludes_busy_and_far_drivers(self):
+        now = time.time()
+        driver_locations.ingest(
+            [
+                (self.driver_user.id_user, 40.7130, -74.0060, now),
+                (self.busy_driver.id_user, 40.7128, -74.0060, now),
+            ]
+        )
+
+        self._authenticate_as(self.admin_user)
+        response = self.client.get(
+            f"{self.NEAREST_PATH}?latitude=40.7128&longitude=-74.0060"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [r["id_driver"] for r in response.data["results"]],
+            [self.driver_user.id_user],
+        )
+
+        # 40.80 is ~10km north, outside the default 5km radius
+        response = self.client.get(
+            f"{self.NEAREST_PATH}?latitude=40.80&longitude=-74.0060"
+        )
+        self.assertEqual(response.data["results"], [])
+
+    def test_stale_positions_are_not_available(self):
+        stale = time.time() - STALE_AFTER_SECONDS - 1
+        driver_locations.ingest([(self.driver_user.id_user, 40.7128, -74.0060, stale)])
+
+        self.assertEqual(driver_locations.nearby(40.7128, -74.0060, radius_km=5), [])
+
+    def test_flush_upserts_and_warms_new_process(self):
+        now = time.time()
+        driver_locations.ingest([(self.driver_user.id_user, 40.7128, -74.0060, now)])
+        self.assertEqual(driver_locations.flush(), 1)
+
+        driver_locations.ingest(
+            [(self.driver_user.id_user, 40.7200, -74.0000, now + 1)]
+        )
+        self.assertEqual(driver_locations.flush(), 1)
+        # nothing changed since
+        self.assertEqual(driver_locations.flush(), 0)
+
+        location = DriverLocation.objects.get(id_driver=self.driver_user)
+        self.assertEqual((location.latitude, location.longitude), (40.72, -74.0))
+
+        fresh_store = DriverLocationStore()
+        self.assertEqual(
+            [d for _, d in fresh_store.nearby(40.72, -74.0, radius_km=1)],
+            [self.driver_user.id_user],
+        )
+
+    def test_refresh_reads_back_other_processes_flushes(self):
+        now = time.time()
+        other_process = DriverLocationStore()
+        other_process.ingest([(self.driver_user.id_user, 40.7128, -74.0060, now)])
+        other_process.flush()
+        store = DriverLocationStore()
+        store.ensure_loaded()
+        # read back already, an earlier flush
+        DriverLocation.objects.update(flushed_at=timezone.now() - timedelta(hours=1))
+
+        other_process.ingest([(self.busy_driver.id_user, 40.7130, -74.0060, now)])
+        other_process.flush()
+
+        self.assertEqual(store.refresh(), 1)
+        self.assertEqual(
+            sorted(d for _, d in store.nearby(40.7128, -74.0060, radius_km=1)),
+            sorted([self.driver_user.id_user, self.busy_driver.id_user]),
+        )
+        # nothing flushed since
+        with self.assertNumQueries(1):
+            self.assertEqual(store.refresh(), 0)
+
+    def test_failed_load_is_retried(self):
+        driver_locations.ingest(
+            [(self.driver_user.id_user, 40.7128, -74.0060, time.time())]
+        )
+        driver_locations.flush()
+        store = DriverLocationStore()
+
+        with (
+            mock.patch.object(store, "refresh", side_effect=DatabaseError),
+            self.assertRaises(DatabaseError),
+        ):
+            store.ensure_loaded()
+        store.ensure_loaded()
+
+        self.assertEqual(len(store), 1)
+
+
+class DriverLocationSyncTests(TransactionTestCase):
+    def test_flushes_in_background_and_at_close(self):
+        driver = User.objects.create_user(
+            username="sync_driver",
+            email="sync.driver@example.com",
+            role=UserRole.DRIVER,
+        )
+        store = DriverLocationStore(sync_interval=0.05)
+        store.start()
+        self.addCleanup(store.close)
+        now = time.time()
+
+        store.ingest([(driver.id_user, 40.7128, -74.0060, now)])
+        deadline = time.monotonic() + 5
+        while not DriverLocation.objects.filter(id_driver=driver).exists():
+            self.assertLess(time.monotonic(), deadline, "never flushed")
+            time.sleep(0.05)
+
+        store.ingest([(driver.id_user, 40.7200, -74.0000, now + 1)])
+        store.close()
+
+        location = DriverLocation.objects.get(id_driver=driver)
+        self.assertEqual((location.latitude, location.longitude), (40.72, -74.0))
+
+
+class RideEventFeedTests(BaseAPITestCase):
+    FEED_PATH = "/api/ride-events/feed/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ride = Ride.objects.create(
+            status=RideStatus.EN_ROUTE,
+            id_rider=cls.rider_user,
+            id_driver=cls.driver_user,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+        cls.events = [
+            RideEvent.objects.create(id_ride=cls.ride, description=description)
+            for description in RideEventType.values
+        ]
+
+    def setUp(self):
+        # no LISTEN thread here, the test transaction never commits anyway
+        patcher = mock.patch.object(ride_event_notifier, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ride_event_notifier.latest_ids = {}
+        self._authenticate_as(self.admin_user)
+
+    def test_pages_through_events_with_cursor(self):
+        response = self.client.get(f"{self.FEED_PATH}?limit=2")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [e["id_ride_event"] for e in response.data["results"]],
+            [e.id_ride_event for e in self.events[:2]],
+        )
+        self.assertEqual(response.data["results"][0]["id_ride"], self.ride.id_ride)
+
+        response = self.client.get(
+            f"{self.FEED_PATH}?limit=2&after={response.data['cursor']}"
+        )
+        self.assertEqual(
+            [e["id_ride_event"] for e in response.data["results"]],
+            [self.events[2].id_ride_event],
+        )
+
+        cursor = response.data["cursor"]
+        response = self.client.get(f"{self.FEED_PATH}?after={cursor}")
+        self.assertEqual(response.data["results"], [])
+        self.assertEqual(response.data["cursor"], cursor)
+
+    def test_caught_up_clients_do_not_query(self):
+        latest = self.events[-1].id_ride_event
+        ride_event_notifier.publish(DEFAULT_DB_ALIAS, latest)
+
+        # only the auth user lookup
+        with self.assertNumQueries(1):
+            response = self.client.get(f"{self.FEED_PATH}?after={latest}&wait=0.05")
+
+        self.assertEqual(response.data["results"], [])
+
+    def test_long_poll_wakes_on_notify(self):
+        latest = self.events[-1].id_ride_event
+        ride_event_notifier.publish(DEFAULT_DB_ALIAS, latest)
+        new_event = RideEvent.objects.create(
+            id_ride=self.ride, description=RideEventType.STATUS_DROPOFF
+        )
+
+        timer = threading.Timer(
+            0.1,
+            ride_event_notifier.publish,
+            args=(DEFAULT_DB_ALIAS, new_event.id_ride_event),
+        )
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        response = self.client.get(f"{self.FEED_PATH}?after={latest}&wait=10")
+
+        self.assertEqual(
+            [e["id_ride_event"] for e in response.data["results"]],
+            [new_event.id_ride_event],
+        )
+
+    def test_non_admin_forbidden(self):
+        self._authenticate_as(self.driver_user)
+        response = self.client.get(self.FEED_PATH)
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class RideEventNotifierTests(TransactionTestCase):
+    def setUp(self):
+        rider = User.objects.create_user(
+            username="notify_rider", email="notify.rider@example.com"
+        )
+        driver = User.objects.create_user(
+            username="notify_driver",
+            email="notify.driver@example.com",
+            role=UserRole.DRIVER,
+        )
+        self.ride = Ride.objects.create(
+            status=RideStatus.EN_ROUTE,
+            id_rider=rider,
+            id_driver=driver,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+
+    def test_insert_trigger_notifies_listener(self):
+        notifier = RideEventNotifier(poll_interval=0.1)
+        notifier.start()
+        self.addCleanup(notifier.stop)
+
+        events = RideEvent.objects.bulk_create(
+            [
+                RideEvent(id_ride=self.ride, description=RideEventType.STATUS_EN_ROUTE),
+                RideEvent(id_ride=self.ride, description=RideEventType.STATUS_PICKUP),
+            ]
+        )
+
+        self.assertTrue(
+            notifier.wait_for_events_after(
+                {DEFAULT_DB_ALIAS: events[0].id_ride_event}, timeout=5
+            )
+        )
+        self.assertEqual(
+            notifier.latest_ids, {DEFAULT_DB_ALIAS: events[1].id_ride_event}
+        )
+
+    def test_rechecks_events_held_back_by_a_running_transaction(self):
+        # longer than the test waits, the notifier has to settle on its own
+        notifier = RideEventNotifier(poll_interval=5)
+        notifier.start()
+        self.addCleanup(notifier.stop)
+
+        # a transaction that took its id before the event's, and inserts nothing
+        slow = connections.create_connection(DEFAULT_DB_ALIAS)
+        self.addCleanup(slow.close)
+        slow.set_autocommit(False)
+        with slow.cursor() as cursor:
+            cursor.execute("SELECT pg_current_xact_id()")
+        event = RideEvent.objects.create(
+            id_ride=self.ride, description=RideEventType.STATUS_PICKUP
+        )
+
+        cursor = {DEFAULT_DB_ALIAS: 0}
+        self.assertFalse(notifier.wait_for_events_after(cursor, timeout=0.5))
+
+        slow.commit()
+
+        self.assertTrue(notifier.wait_for_events_after(cursor, timeout=2))
+        self.assertEqual(notifier.latest_ids, {DEFAULT_DB_ALIAS: event.id_ride_event})
+
+
+class RideEventFeedSettlingTests(TransactionTestCase):
+    """
+    An event committed by a slow transaction below an id already handed out.
+    """
+
+    def setUp(self):
+        admin = User.objects.create_user(
+            username="feed_admin", email="feed.admin@example.com", role=UserRole.ADMIN
+        )
+        self.ride = Ride.objects.create(
+            status=RideStatus.EN_ROUTE,
+            id_rider=admin,
+            id_driver=admin,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+        patcher = mock.patch.object(ride_event_notifier, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ride_event_notifier.latest_ids = {}
+        self.client = APIClient()
+        self.client.force_authenticate(admin)
+
+        self.slow = connections.create_connection("default")
+        self.addCleanup(self.slow.close)
+        self.slow.set_autocommit(False)
+
+    def _feed(self, after=0):
+        response = self.client.get("/api/ride-events/feed/", {"after": after})
+        return (
+            [e["id_ride_event"] for e in response.data["results"]],
+            response.data["cursor"],
+        )
+
+    def test_holds_back_events_until_earlier_transactions_commit(self):
+        with self.slow.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO rides_rideevent (id_ride, description, created_at)"
+                " VALUES (%s, %s, now()) RETURNING id_ride_event",
+                [self.ride.id_ride, RideEventType.STATUS_PICKUP],
+            )
+            [(slow_id,)] = cursor.fetchall()
+        fast = RideEvent.objects.create(
+            id_ride=self.ride, description=RideEventType.STATUS_DROPOFF
+        )
+        self.assertGreater(fast.id_ride_event, slow_id)
+
+        # committed, but the slow transaction may still commit a lower id
+        self.assertEqual(self._feed(), ([], 0))
+
+        self.slow.commit()
+
+        self.assertEqual(
+            self._feed(), ([slow_id, fast.id_ride_event], fast.id_ride_event)
+        )
+
+
+class RideEventBatchTests(BaseAPITestCase):
+    BATCH_PATH = "/api/ride-events/batch/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ride = Ride.objects.create(
+            status=RideStatus.EN_ROUTE,
+            id_rider=cls.rider_user,
+            id_driver=cls.driver_user,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+        cls.other_ride = Ride.objects.create(
+            status=RideStatus.EN_ROUTE,
+            id_rider=cls.rider_user,
+            id_driver=cls.admin_user,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+
+    def setUp(self):
+        # flushed by hand, a flusher thread wouldn't see the test transaction
+        self.buffer = RideEventBuffer()
+        for patcher in (
+            mock.patch("rides.views.ride_event_buffer", self.buffer),
+            mock.patch.object(self.buffer, "start"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self._authenticate_as(self.admin_user)
+
+    def _post(self, events):
+        return self.client.post(self.BATCH_PATH, {"events": events}, format="json")
+
+    def test_buffers_until_flushed(self):
+        response = self._post(
+            [
+                {
+                    "id_ride": self.ride.id_ride,
+                    "description": RideEventType.STATUS_PICKUP,
+                    "created_at": "2024-01-10T10:05:00Z",
+                    "idempotency_key": "a",
+                },
+                {
+                    "id_ride": self.ride.id_ride,
+                    "description": RideEventType.STATUS_DROPOFF,
+                },
+            ]
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data, {"received": 2, "accepted": 2, "duplicates": 0})
+        self.assertFalse(RideEvent.objects.exists())
+
+        self.assertEqual(self.buffer.flush(), 2)
+        pickup, dropoff = RideEvent.objects.order_by("id_ride_event")
+        self.assertEqual(pickup.created_at, datetime(2024, 1, 10, 10, 5, tzinfo=UTC))
+        self.assertEqual(pickup.idempotency_key, "a")
+        self.assertEqual(dropoff.description, RideEventType.STATUS_DROPOFF)
+        self.assertIsNone(dropoff.idempotency_key)
+
+    def test_retries_are_deduplicated(self):
+        event = {
+            "id_ride": self.ride.id_ride,
+            "description": RideEventType.STATUS_PICKUP,
+            "idempotency_key": "retry-1",
+        }
+        self._post([event])
+
+        # still buffered
+        response = self._post([event, event])
+        self.assertEqual(response.data, {"received": 2, "accepted": 0, "duplicates": 2})
+
+        # already written
+        self.buffer.flush()
+        self._post([event])
+        self.assertEqual(self.buffer.flush(), 0)
+
+        self.assertEqual(RideEvent.objects.count(), 1)
+
+    def test_keys_are_unique_per_ride(self):
+        events = [
+            {
+                "id_ride": ride.id_ride,
+                "description": RideEventType.STATUS_PICKUP,
+                "idempotency_key": "pickup",
+            }
+            for ride in (self.ride, self.other_ride)
+        ]
+        response = self._post(events)
+        self.assertEqual(response.data, {"received": 2, "accepted": 2, "duplicates": 0})
+        self.assertEqual(self.buffer.flush(), 2)
+
+        # already written for the first ride
+        RideEvent.objects.filter(id_ride=self.other_ride).delete()
+        self._post(events)
+        self.assertEqual(self.buffer.flush(), 1)
+
+        self.assertEqual(
+            sorted(RideEvent.objects.values_list("id_ride", flat=True)),
+            [self.ride.id_ride, self.other_ride.id_ride],
+        )
+
+    def test_invalid_descriptions_rejected(self):
+        response = self._post(
+            [
+                {"id_ride": self.ride.id_ride, "description": "Took a detour"},
+                {
+                    "id_ride": self.ride.id_ride,
+                    "description": RideEventType.STATUS_PICKUP,
+                },
+                {"id_ride": self.ride.id_ride, "description": "Nope"},
+            ]
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data["events"]), {0, 2})
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_unknown_rides_rejected(self):
+        response = self._post(
+            [{"id_ride": 999999, "description": RideEventType.STATUS_PICKUP}]
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("999999", str(response.data["events"]))
+
+    def test_drivers_only_add_to_their_own_rides(self):
+        self._authenticate_as(self.driver_user)
+        response = self._post(
+            [{"id_ride": self.ride.id_ride, "description": RideEventType.STATUS_PICKUP}]
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        response = self._post(
+            [
+                {
+                    "id_ride": self.other_ride.id_ride,
+                    "description": RideEventType.STATUS_PICKUP,
+                }
+            ]
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_riders_forbidden(self):
+        self._authenticate_as(self.rider_user)
+        response = self._post(
+            [{"id_ride": self.ride.id_ride, "description": RideEventType.STATUS_PICKUP}]
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_full_buffer_refuses_events(self):
+        self.buffer.max_buffered = 1
+        event = {
+            "id_ride": self.ride.id_ride,
+            "description": "Status changed to pickup",
+        }
+
+        response = self._post([event, event])
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response["Retry-After"], "1")
+
+    def test_events_of_deleted_rides_dropped(self):
+        self._post(
+            [
+                {
+                    "id_ride": self.other_ride.id_ride,
+                    "description": RideEventType.STATUS_PICKUP,
+                },
+                {
+                    "id_ride": self.ride.id_ride,
+                    "description": "Status changed to pickup",
+                },
+            ]
+        )
+        self.other_ride.delete()
+
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(
+            list(RideEvent.objects.values_list("id_ride", flat=True)),
+            [self.ride.id_ride],
+        )
+
+
+class RideEventBufferTests(TransactionTestCase):
+    """
+    Flushes from the background thread and at shutdown, against committed data.
+    """
+
+    def setUp(self):
+        user = User.objects.create_user(
+            username="buffer_driver",
+            email="buffer.driver@example.com",
+            role=UserRole.DRIVER,
+        )
+        self.ride = Ride.objects.create(
+            status=RideStatus.EN_ROUTE,
+            id_rider=user,
+            id_driver=user,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+
+    def _events(self, count, key_prefix=None):
+        return [
+            (
+                self.ride.id_ride,
+                RideEventType.STATUS_EN_ROUTE,
+                timezone.now(),
+                f"{key_prefix}-{i}" if key_prefix else None,
+            )
+            for i in range(count)
+        ]
+
+    def _wait_for_events(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while RideEvent.objects.count() < count and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return RideEvent.objects.count()
+
+    def _buffer(self, **kwargs):
+        buffer = RideEventBuffer(**kwargs)
+        # not registered with atexit, closed here instead
+        buffer._atexit_registered = True
+        self.addCleanup(buffer.close)
+        return buffer
+
+    def test_flushes_when_full(self):
+        buffer = self._buffer(flush_size=3, flush_interval=60)
+
+        buffer.add(self._events(2))
+        time.sleep(0.2)
+        self.assertEqual(RideEvent.objects.count(), 0)
+
+        buffer.add(self._events(1))
+        self.assertEqual(self._wait_for_events(3), 3)
+
+    def test_flushes_on_interval(self):
+        buffer = self._buffer(flush_interval=0.05)
+
+        buffer.add(self._events(2))
+
+        self.assertEqual(self._wait_for_events(2), 2)
+
+    def test_close_writes_pending_and_later_events(self):
+        buffer = self._buffer(flush_interval=60)
+        buffer.add(self._events(2))
+
+        buffer.close()
+        self.assertEqual(RideEvent.objects.count(), 2)
+
+        # e.g. requests still finishing during shutdown
+        buffer.add(self._events(1))
+        self.assertEqual(RideEvent.objects.count(), 3)
+
+    def test_failed_flush_keeps_events(self):
+        buffer = self._buffer(flush_interval=60)
+        buffer.add(self._events(2, key_prefix="kept"))
+
+        with mock.patch("rides.ingest.write_events", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                buffer.flush()
+        self.assertEqual(len(buffer), 2)
+        # keys are still known while buffered
+        self.assertEqual(buffer.add(self._events(1, key_prefix="kept")), (0, 1))
+
+        self.assertEqual(buffer.flush(), 2)
+
+    def _run_process(self, exit_how):
+        """
+        A separate Django process that buffers one event and then exits.
+        """
+        script = (
+            "import os, signal, sys, django\n"
+            "django.setup()\n"
+            "from django.utils import timezone\n"
+            "from rides.ingest import ride_event_buffer\n"
+            "ride_event_buffer.flush_interval = 3600\n"
+            "ride_event_buffer.add([(int(sys.argv[1]), 'Status changed to pickup',"
+            " timezone.now(), None)])\n"
+            "if sys.argv[2] == 'kill':\n"
+            "    os.kill(os.getpid(), signal.SIGKILL)\n"
+        )
+        return subprocess.run(
+            [sys.executable, "-c", script, str(self.ride.id_ride), exit_how],
+            cwd=settings.BASE_DIR,
+            env={
+                **os.environ,
+                "DJANGO_SETTINGS_MODULE": "api.settings",
+                "DB_NAME": connection.settings_dict["NAME"],
+            },
+            capture_output=True,
+            timeout=60,
+        )
+
+    def test_process_exit_writes_buffered_events(self):
+        result = self._run_process("exit")
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(RideEvent.objects.count(), 1)
+
+    def test_killed_process_loses_buffered_events(self):
+        # the documented limit: no exit handlers, no final flush
+        result = self._run_process("kill")
+
+        self.assertEqual(result.returncode, -signal.SIGKILL)
+        self.assertEqual(RideEvent.objects.count(), 0)
+
+
+class RideTransitionTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ride = Ride.objects.create(
+            status=RideStatus.EN_ROUTE,
+            id_rider=cls.rider_user,
+            id_driver=cls.driver_user,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=timezone.now(),
+        )
+
+    def _transition_path(self, ride_id):
+        return f"{RIDES_LIST_PATH}{ride_id}/transition/"
+
+    def test_full_lifecycle_emits_events(self):
+        self._authenticate_as(self.admin_user)
+
+        for new_status in (RideStatus.PICKUP, RideStatus.DROPOFF):
+            with self.subTest(status=new_status):
+                response = self.client.post(
+                    self._transition_path(self.ride.id_ride),
+                    {"status": new_status},
+                    format="json",
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data["status"], new_status)
+
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.status, RideStatus.DROPOFF)
+        self.assertEqual(
+            list(
+                self.ride.ride_events.order_by("id_ride_event").values_list(
+                    "description", flat=True
+                )
+            ),
+            [RideEventType.STATUS_PICKUP, RideEventType.STATUS_DROPOFF],
+        )
+
+    def test_skipping_a_status_conflicts(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.post(
+            self._transition_path(self.ride.id_ride),
+            {"status": RideStatus.DROPOFF},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.status, RideStatus.EN_ROUTE)
+        self.assertFalse(self.ride.ride_events.exists())
+
+    def test_transition_is_a_single_statement(self):
+        """
+        Expected queries:
+        1. Auth user lookup
+        2. UPDATE ... RETURNING + INSERT of the event
+        """
+        self._authenticate_as(self.admin_user)
+
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                self._transition_path(self.ride.id_ride),
+                {"status": RideStatus.PICKUP},
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # conflicts cost the same, no extra reads
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                self._transition_path(self.ride.id_ride),
+                {"status": RideStatus.PICKUP},
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_missing_ride_conflicts(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.post(
+            self._transition_path(999999),
+            {"status": RideStatus.PICKUP},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_en_route_is_not_a_transition_target(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.post(
+            self._transition_path(self.ride.id_ride),
+            {"status": RideStatus.EN_ROUTE},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_plain_update_transitions_status(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.patch(
+            f"{RIDES_LIST_PATH}{self.ride.id_ride}/",
+            {"status": RideStatus.PICKUP, "pickup_latitude": 40.72},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.ride.refresh_from_db()
+        self.assertEqual(
+            (self.ride.status, self.ride.pickup_latitude), (RideStatus.PICKUP, 40.72)
+        )
+        self.assertEqual(
+            list(self.ride.ride_events.values_list("description", flat=True)),
+            [RideEventType.STATUS_PICKUP],
+        )
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.STATUS),
+            {RideStatus.EN_ROUTE: 0, RideStatus.PICKUP: 1},
+        )
+
+    def test_plain_update_skipping_a_status_conflicts(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.patch(
+            f"{RIDES_LIST_PATH}{self.ride.id_ride}/",
+            {"status": RideStatus.DROPOFF, "pickup_latitude": 40.72},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.ride.refresh_from_db()
+        self.assertEqual(
+            (self.ride.status, self.ride.pickup_latitude),
+            (RideStatus.EN_ROUTE, 40.7128),
+        )
+
+    def test_instance_transition_to(self):
+        self.assertIsNotNone(self.ride.transition_to(RideStatus.PICKUP))
+        self.assertEqual(self.ride.status, RideStatus.PICKUP)
+        self.assertIsNone(self.ride.transition_to(RideStatus.PICKUP))
+
+
+class RideTransitionConcurrencyTests(TransactionTestCase):
+    WORKERS = 8
+
+    def test_parallel_dispatchers_only_one_wins(self):
+        rider = User.objects.create_user(
+            username="race_rider", email="race.rider@example.com"
+        )
+        driver = User.objects.create_user(
+            username="race_driver",
+            email="race.driver@example.com",
+            role=UserRole.DRIVER,
+        )
+        rides = [
+            Ride.objects.create(
+                status=RideStatus.EN_ROUTE,
+                id_rider=rider,
+                id_driver=driver,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=timezone.now(),
+            )
+            for _ in range(20)
+        ]
+
+        barrier = threading.Barrier(self.WORKERS)
+
+        def dispatch():
+            barrier.wait()
+            try:
+                # every worker races every other one on every ride
+                return [
+                    Ride.objects.transition(ride.id_ride, new_status)
+                    for new_status in (RideStatus.PICKUP, RideStatus.DROPOFF)
+                    for ride in rides
+                ]
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(self.WORKERS) as pool:
+            results = [
+                f.result() for f in [pool.submit(dispatch) for _ in range(self.WORKERS)]
+            ]
+
+        wins = [
+            id_ride_event
+            for result in results
+            for id_ride_event in result
+            if id_ride_event
+        ]
+        self.assertEqual(len(wins), len(rides) * 2)
+        self.assertEqual(
+            Ride.objects.filter(status=RideStatus.DROPOFF).count(), len(rides)
+        )
+        for ride in rides:
+            self.assertEqual(
+                list(
+                    RideEvent.objects.filter(id_ride=ride)
+                    .order_by("id_ride_event")
+                    .values_list("description", flat=True)
+                ),
+                [RideEventType.STATUS_PICKUP, RideEventType.STATUS_DROPOFF],
+            )
+
+
+class RideStatsTests(BaseAPITestCase):
+    STATS_PATH = f"{RIDES_LIST_PATH}stats/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.pickup_time = timezone.now()
+        cls.rides = [
+            Ride.objects.create(
+                status=RideStatus.EN_ROUTE,
+                id_rider=cls.rider_user,
+                id_driver=cls.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=cls.pickup_time,
+            )
+            for _ in range(3)
+        ]
+
+    def _ride(self, **extra):
+        return Ride(
+            id_rider=self.rider_user,
+            id_driver=self.driver_user,
+            pickup_latitude=40.7128,
+            pickup_longitude=-74.0060,
+            dropoff_latitude=40.7580,
+            dropoff_longitude=-73.9855,
+            pickup_time=self.pickup_time,
+            **extra,
+        )
+
+    def test_creation_counts_towards_every_dimension(self):
+        day = timezone.localdate(self.pickup_time).isoformat()
+
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.STATUS),
+            {RideStatus.EN_ROUTE: 3},
+        )
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.DRIVER),
+            {str(self.driver_user.id_user): 3},
+        )
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.DAY), {day: 3}
+        )
+
+    def test_transitions_move_status_counts(self):
+        Ride.objects.transition(self.rides[0].id_ride, RideStatus.PICKUP)
+        Ride.objects.transition(self.rides[0].id_ride, RideStatus.DROPOFF)
+        Ride.objects.transition(self.rides[1].id_ride, RideStatus.PICKUP)
+        # conflict, no change
+        Ride.objects.transition(self.rides[2].id_ride, RideStatus.DROPOFF)
+
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.STATUS),
+            {RideStatus.EN_ROUTE: 1, RideStatus.PICKUP: 1, RideStatus.DROPOFF: 1},
+        )
+
+    def test_changing_driver_moves_driver_counts(self):
+        ride = Ride.objects.get(pk=self.rides[0].pk)
+        ride.id_driver = self.rider_user_2
+        ride.save()
+
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.DRIVER),
+            {str(self.driver_user.id_user): 2, str(self.rider_user_2.id_user): 1},
+        )
+
+    def test_deletion_uncounts_the_ride(self):
+        Ride.objects.get(pk=self.rides[0].pk).delete()
+
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.STATUS),
+            {RideStatus.EN_ROUTE: 2},
+        )
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.DRIVER),
+            {str(self.driver_user.id_user): 2},
+        )
+
+    def test_stats_endpoint_reads_counters_only(self):
+        self._authenticate_as(self.admin_user)
+
+        # auth user lookup + counter totals, nothing touches rides_ride
+        with self.assertNumQueries(2) as ctx:
+            response = self.client.get(f"{self.STATS_PATH}?dimension=status")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["counts"], {RideStatus.EN_ROUTE: 3})
+        self.assertNotIn('rides_ride"', ctx.captured_queries[-1]["sql"])
+
+    def test_stats_endpoint_filters_by_key(self):
+        self._authenticate_as(self.admin_user)
+        response = self.client.get(
+            f"{self.STATS_PATH}?dimension=driver&key={self.rider_user.id_user}"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["counts"], {})
+
+    def test_reconcile_fixes_drift(self):
+        # bypasses Ride.save(), so the counters miss these
+        Ride.objects.bulk_create([self._ride(status=RideStatus.PICKUP)] * 2)
+        Ride.objects.filter(pk=self.rides[0].pk).delete()
+
+        out = StringIO()
+        call_command("reconcile_ride_stats", stdout=out)
+        self.assertIn("Fixed", out.getvalue())
+
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.STATUS),
+            {RideStatus.EN_ROUTE: 2, RideStatus.PICKUP: 2},
+        )
+        self.assertEqual(
+            RideStatsCounter.objects.totals(RideStatsDimension.DRIVER),
+            {str(self.driver_user.id_user): 4},
+        )
+
+        out = StringIO()
+        call_command("reconcile_ride_stats", stdout=out)
+        self.assertIn("Counters are in sync", out.getvalue())
+
+
+class RideHeatmapTests(BaseAPITestCase):
+    ZOOM = 12
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.pickup_time = timezone.now()
+        cls.tile = tile_for_point(cls.ZOOM, 40.7128, -74.0060)
+        cls.rides = [
+            Ride.objects.create(
+                status=ride_status,
+                id_rider=cls.rider_user,
+                id_driver=cls.driver_user,
+                pickup_latitude=latitude,
+                pickup_longitude=longitude,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=cls.pickup_time,
+            )
+            for ride_status, latitude, longitude in [
+                (RideStatus.EN_ROUTE, 40.7128, -74.0060),
+                (RideStatus.EN_ROUTE, 40.7128, -74.0060),
+                (RideStatus.DROPOFF, 40.7130, -74.0055),
+                # a different tile
+                (RideStatus.EN_ROUTE, 51.5074, -0.1278),
+            ]
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self._authenticate_as(self.admin_user)
+
+    def _path(self, z=None, x=None, y=None):
+        x_default, y_default = self.tile
+        z = self.ZOOM if z is None else z
+        x = x_default if x is None else x
+        y = y_default if y is None else y
+        return f"{RIDES_LIST_PATH}heatmap/{z}/{x}/{y}/"
+
+    def test_tile_bounds_contain_point(self):
+        south, west, north, east = tile_bounds(self.ZOOM, *self.tile)
+        self.assertTrue(south <= 40.7128 < north)
+        self.assertTrue(west <= -74.0060 < east)
+
+    def test_tile_counts_pickups_inside(self):
+        response = self.client.get(self._path())
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["total"], 3)
+        self.assertEqual(sum(count for _, _, count in response.data["counts"]), 3)
+        self.assertIn(2, [count for _, _, count in response.data["counts"]])
+
+    def test_whole_world_tile(self):
+        response = self.client.get(self._path(z=0, x=0, y=0))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["total"], 4)
+
+    def test_filters(self):
+        response = self.client.get(f"{self._path()}?status=dropoff")
+        self.assertEqual(response.data["total"], 1)
+
+        after = (self.pickup_time + timedelta(minutes=1)).isoformat()
+        response = self.client.get(self._path(), {"pickup_after": after})
+        self.assertEqual(response.data["total"], 0)
+
+    def test_tile_is_cached(self):
+        self.client.get(self._path())
+
+        # only the auth user lookup
+        with self.assertNumQueries(1):
+            response = self.client.get(self._path())
+        self.assertEqual(response.data["total"], 3)
+
+    def test_new_ride_invalidates_tile(self):
+        self.client.get(self._path())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Ride.objects.create(
+                id_rider=self.rider_user,
+                id_driver=self.driver_user,
+                pickup_latitude=40.7129,
+                pickup_longitude=-74.0061,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=self.pickup_time,
+            )
+
+        self.assertEqual(self.client.get(self._path()).data["total"], 4)
+
+    def test_deleted_ride_invalidates_tile(self):
+        self.client.get(self._path())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Ride.objects.get(pk=self.rides[0].pk).delete()
+
+        self.assertEqual(self.client.get(self._path()).data["total"], 2)
+
+    def test_transition_invalidates_status_tiles(self):
+        path = f"{self._path()}?status=pickup"
+        self.assertEqual(self.client.get(path).data["total"], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Ride.objects.transition(self.rides[0].id_ride, RideStatus.PICKUP)
+
+        self.assertEqual(self.client.get(path).data["total"], 1)
+
+    def test_tile_out_of_range(self):
+        response = self.client.get(self._path(z=2, x=4, y=0))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(self._path(z=30, x=0, y=0))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_requires_admin(self):
+        self._authenticate_as(self.rider_user)
+        response = self.client.get(self._path())
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class RideAdminScaleTests(BaseAPITestCase):
+    """
+    Changelists on tables past `ESTIMATED_COUNT_THRESHOLD`: the query count
+    must not depend on the row count, nothing may COUNT(*) the full tables,
+    and the page queries must read an index rather than scan and sort.
+    """
+
+    ROWS = 50_000
+    RIDES_ADMIN_PATH = "/admin/rides/ride/"
+    EVENTS_ADMIN_PATH = "/admin/rides/rideevent/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.staff_user = User.objects.create_superuser(
+            username="staff", email="staff@example.com", password="testpass123"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO rides_ride (
+                    status, id_rider, id_driver, pickup_latitude, pickup_longitude,
+                    dropoff_latitude, dropoff_longitude, pickup_time
+                )
+                SELECT
+                    (ARRAY['en-route', 'pickup', 'dropoff'])[1 + i %% 3],
+                    CASE WHEN i %% 2 = 0 THEN %s ELSE %s END,
+                    %s, 40.7128, -74.0060, 40.7580, -73.9855,
+                    now() - i * interval '1 minute'
+                FROM generate_series(1, %s) AS i
+                """,
+                [
+                    cls.rider_user.id_user,
+                    cls.rider_user_2.id_user,
+                    cls.driver_user.id_user,
+                    cls.ROWS,
+                ],
+            )
+            cursor.execute(
+                """
+                INSERT INTO rides_rideevent (id_ride, description, created_at)
+                SELECT id_ride, %s, pickup_time FROM rides_ride
+                """,
+                [RideEventType.STATUS_PICKUP],
+            )
+            # run the deferred FK checks once here, not again after every test
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+            # the estimated counts come from the planner statistics
+            cursor.execute("ANALYZE rides_ride, rides_rideevent")
+
+    def setUp(self):
+        self.client.force_login(self.staff_user)
+
+    def _get(self, path, params=None, num_queries=4):
+        # session, user, estimated count (+ exact count when small), page
+        with self.assertNumQueries(num_queries) as ctx:
+            response = self.client.get(path, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, [query["sql"] for query in ctx.captured_queries]
+
+    def assertReadsIndex(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {sql}")
+            plan = "\n".join(line for (line,) in cursor.fetchall())
+        self.assertNotIn("Seq Scan", plan)
+        self.assertNotIn("Sort", plan)
+
+    def test_ride_changelist(self):
+        response, queries = self._get(self.RIDES_ADMIN_PATH)
+
+        self.assertFalse(any("COUNT(" in sql for sql in queries))
+        self.assertTrue(any(sql.startswith("EXPLAIN") for sql in queries))
+        self.assertReadsIndex(queries[-1])
+        self.assertContains(response, "Driver")
+        self.assertGreaterEqual(response.context["cl"].result_count, self.ROWS * 0.9)
+
+    def test_ride_changelist_filtered(self):
+        _, queries = self._get(
+            self.RIDES_ADMIN_PATH, {"status__exact": RideStatus.PICKUP}
+        )
+        self.assertFalse(any("COUNT(" in sql for sql in queries))
+        self.assertReadsIndex(queries[-1])
+
+    def test_ride_search_uses_indexed_columns(self):
+        # the email -> id lookup is cached by the first search
+        User.objects.id_for_email(self.rider_user.email)
+        _, queries = self._get(self.RIDES_ADMIN_PATH, {"q": self.rider_user.email})
+
+        self.assertFalse(any("LIKE" in sql for sql in queries))
+
+    def test_small_results_get_exact_counts(self):
+        ride = Ride.objects.only("pk").first()
+        response, _ = self._get(
+            self.RIDES_ADMIN_PATH, {"q": str(ride.pk)}, num_queries=5
+        )
+        self.assertEqual(response.context["cl"].result_count, 1)
+
+    def test_ride_change_form_doesnt_load_users(self):
+        ride = Ride.objects.only("pk").first()
+        response = self.client.get(f"{self.RIDES_ADMIN_PATH}{ride.pk}/change/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # autocomplete widgets only render the selected users
+        self.assertNotContains(response, self.admin_user.email)
+
+    def test_ride_event_changelist(self):
+        response, queries = self._get(self.EVENTS_ADMIN_PATH)
+
+        self.assertFalse(any("COUNT(" in sql for sql in queries))
+        self.assertReadsIndex(queries[-1])
+        self.assertContains(response, "Status changed to pickup")
+
+    def test_ride_event_search(self):
+        response, queries = self._get(
+            self.EVENTS_ADMIN_PATH, {"q": "dropoff"}, num_queries=5
+        )
+
+        self.assertFalse(any("LIKE" in sql for sql in queries))
+        self.assertEqual(response.context["cl"].result_count, 0)
+
+
+class LoadTestCommandTests(LiveServerTestCase):
+    def setUp(self):
+        admin = User.objects.create_user(
+            username="admin",
+            email="admin@example.com",
+            role=UserRole.ADMIN,
+            password="password123",
+        )
+        # enough for every page the scenarios ask for
+        Ride.objects.bulk_create(
+            Ride(
+                id_rider=admin,
+                id_driver=admin,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=timezone.now(),
+            )
+            for _ in range(50)
+        )
+
+    def test_report(self):
+        out = StringIO()
+        call_command(
+            "loadtest",
+            url=self.live_server_url,
+            rate=40,
+            duration=1,
+            concurrency=4,
+            seed=1,
+            stdout=out,
+        )
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report["total"]["requests"], 40)
+        self.assertEqual(report["total"]["errors"], 0, report)
+        self.assertEqual(report["scenarios"]["login"]["requests"], 1)
+        for name, scenario in report["scenarios"].items():
+            self.assertIn(name, [*SCENARIOS, "login"])
+            self.assertEqual(set(scenario["latency_ms"]), {"p50", "p95", "p99"}, name)
+
+    def test_wrong_password(self):
+        with self.assertRaisesMessage(CommandError, "No user could log in"):
+            call_command(
+                "loadtest",
+                url=self.live_server_url,
+                password="wrong",
+                duration=1,
+                stdout=StringIO(),
+            )
+
+    def test_only_local_servers(self):
+        with self.assertRaisesMessage(CommandError, "Only http://localhost"):
+            call_command("loadtest", url="http://example.com:8000")
+
+
+class RideAnalyticsCommandTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+
+        def at(month, day, hour, minute):
+            return datetime(2024, month, day, hour, minute, tzinfo=UTC)
+
+        def ride(driver, pickup_time, events):
+            ride = Ride.objects.create(
+                id_rider=cls.rider_user,
+                id_driver=driver,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=pickup_time,
+            )
+            for description, created_at in events:
+                event = RideEvent.objects.create(id_ride=ride, description=description)
+                RideEvent.objects.filter(pk=event.pk).update(created_at=created_at)
+
+        pickup, dropoff = RideEventType.STATUS_PICKUP, RideEventType.STATUS_DROPOFF
+        # 30 min trip, picked up 5 min late
+        ride(
+            cls.driver_user,
+            at(1, 10, 10, 0),
+            [
+                (RideEventType.STATUS_EN_ROUTE, at(1, 10, 9, 50)),
+                (pickup, at(1, 10, 10, 5)),
+                (dropoff, at(1, 10, 10, 35)),
+            ],
+        )
+        # 90 min trip, picked up 2 min early, the repeated pickup is ignored
+        ride(
+            cls.driver_user,
+            at(1, 20, 12, 0),
+            [
+                (pickup, at(1, 20, 11, 58)),
+                (pickup, at(1, 20, 12, 10)),
+                (dropoff, at(1, 20, 13, 28)),
+            ],
+        )
+        # next month
+        ride(
+            cls.driver_user,
+            at(2, 1, 10, 0),
+            [(pickup, at(2, 1, 10, 0)), (dropoff, at(2, 1, 10, 20))],
+        )
+        # not trips: no dropoff, dropoff before pickup
+        ride(cls.admin_user, at(1, 5, 8, 0), [(pickup, at(1, 5, 8, 0))])
+        ride(
+            cls.admin_user,
+            at(1, 6, 8, 0),
+            [(dropoff, at(1, 6, 7, 0)), (pickup, at(1, 6, 8, 0))],
+        )
+
+    def _run(self, file_format="csv", **options):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / f"metrics.{file_format}"
+            call_command(
+                "ride_analytics",
+                str(path),
+                format=file_format,
+                stdout=StringIO(),
+                **options,
+            )
+            if file_format == "npz":
+                with np.load(path) as columns:
+                    return {name: columns[name].tolist() for name in columns.files}
+            with open(path, newline="") as f:
+                return list(csv.DictReader(f))
+
+    def test_csv(self):
+        january, february = self._run()
+
+        self.assertEqual(january["month"], "2024-01")
+        self.assertEqual(january["id_driver"], str(self.driver_user.id_user))
+        self.assertEqual(january["driver"], "Test D")
+        self.assertEqual(january["trips"], "2")
+        self.assertEqual(january["trips_over_1h"], "1")
+        self.assertAlmostEqual(float(january["duration_mean_min"]), 60)
+        self.assertAlmostEqual(float(january["pickup_delay_mean_min"]), 1.5)
+        # histogram percentiles, within half a bin
+        self.assertAlmostEqual(float(january["duration_p50_min"]), 30, delta=1.5)
+        self.assertAlmostEqual(float(january["duration_p99_min"]), 90, delta=4.5)
+        self.assertAlmostEqual(float(january["pickup_delay_p50_min"]), -2, delta=0.1)
+        distance = haversine_km(40.7128, -74.0060, 40.7580, -73.9855)
+        self.assertAlmostEqual(
+            float(january["distance_total_km"]), 2 * distance, places=2
+        )
+        self.assertAlmostEqual(float(january["distance_mean_km"]), distance, places=2)
+
+        self.assertEqual(february["month"], "2024-02")
+        self.assertEqual(february["trips"], "1")
+        self.assertAlmostEqual(float(february["duration_mean_min"]), 20)
+
+    def test_batches_split_rides(self):
+        # every batch boundary falls inside a ride's events
+        self.assertEqual(self._run(batch_size=1), self._run())
+
+    def test_compacted_events(self):
+        expected = self._run()
+        Ride.objects.update(status=RideStatus.DROPOFF)
+        call_command("compact_ride_events", older_than=0, sleep=0, stdout=StringIO())
+
+        self.assertFalse(RideEvent.objects.exists())
+        self.assertEqual(self._run(batch_size=1), expected)
+
+    def test_npz(self):
+        columns = self._run("npz")
+
+        self.assertEqual(columns["month"], ["2024-01", "2024-02"])
+        self.assertEqual(columns["driver"], ["Test D", "Test D"])
+        self.assertEqual(columns["trips"], [2, 1])
+        self.assertAlmostEqual(columns["duration_mean_min"][1], 20)
+
+
+class RideEventCompactionTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.long_ago = timezone.now() - timedelta(days=10)
+
+        def ride(status, events_at):
+            ride = Ride.objects.create(
+                status=status,
+                id_rider=cls.rider_user,
+                id_driver=cls.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=events_at,
+            )
+            for minutes, description in enumerate(RideEventType.values):
+                event = RideEvent.objects.create(id_ride=ride, description=description)
+                RideEvent.objects.filter(pk=event.pk).update(
+                    created_at=events_at + timedelta(minutes=minutes)
+                )
+            return ride
+
+        cls.finished = ride(RideStatus.DROPOFF, cls.long_ago)
+        cls.recently_finished = ride(
+            RideStatus.DROPOFF, timezone.now() - timedelta(hours=1)
+        )
+        cls.unfinished = ride(RideStatus.PICKUP, cls.long_ago + timedelta(hours=1))
+
+    def setUp(self):
+        cache.clear()
+        self._authenticate_as(self.admin_user)
+
+    def _compact(self, **options):
+        out = StringIO()
+        call_command("compact_ride_events", sleep=0, stdout=out, **options)
+        return out.getvalue()
+
+    def _events(self, ride):
+        return list(
+            RideEvent.objects.filter(id_ride=ride)
+            .order_by("created_at")
+            .values_list("id_ride_event", "description", "created_at")
+        )
+
+    def test_folds_finished_rides(self):
+        expected = self._events(self.finished)
+        output = self._compact()
+
+        self.assertIn("3 events of 1 rides compacted", output)
+        self.assertEqual(self._events(self.finished), [])
+        ride = Ride.objects.get(pk=self.finished.pk)
+        self.assertEqual(
+            [
+                (event.id_ride_event, event.description, event.created_at)
+                for event in ride.timeline_events()
+            ],
+            expected,
+        )
+        # too recent, or not finished
+        self.assertIsNone(Ride.objects.get(pk=self.recently_finished.pk).event_timeline)
+        self.assertEqual(len(self._events(self.recently_finished)), 3)
+        self.assertEqual(len(self._events(self.unfinished)), 3)
+
+    def test_rerun_appends_late_events(self):
+        self._compact()
+        late = RideEvent.objects.create(
+            id_ride=self.finished, description=RideEventType.STATUS_DROPOFF
+        )
+        RideEvent.objects.filter(pk=late.pk).update(created_at=self.long_ago)
+        self.assertIn("1 events of 1 rides compacted", self._compact())
+
+        timeline = Ride.objects.get(pk=self.finished.pk).timeline_events()
+        self.assertEqual(len(timeline), 4)
+        # in created_at order
+        self.assertEqual(timeline[1].id_ride_event, late.pk)
+
+    def test_list_reads_either_representation(self):
+        paths = [
+            RIDES_LIST_PATH,
+            f"{RIDES_LIST_PATH}?fields=id_ride,todays_ride_events",
+            f"{RIDES_LIST_PATH}?format=sideloaded",
+            f"{RIDES_LIST_PATH}?ordering=-pickup_time",
+        ]
+        expected = [self.client.get(path).json()["results"] for path in paths]
+        self._compact(older_than=0)
+        cache.clear()
+
+        self.assertEqual(RideEvent.objects.count(), 3)
+        for path, results in zip(paths, expected):
+            self.assertEqual(self.client.get(path).json()["results"], results, path)
+        self.assertEqual(len(expected[0][1]["todays_ride_events"]), 3)
+
+    def test_pickup_ordering_mixes_representations(self):
+        self._compact()
+        ids = [
+            ride["id_ride"]
+            for ride in self.client.get(
+                RIDES_LIST_PATH, {"ordering": "pickup_time"}
+            ).data["results"]
+        ]
+        self.assertEqual(
+            ids, [self.finished.pk, self.unfinished.pk, self.recently_finished.pk]
+        )
+
+    def test_invalid_options(self):
+        with self.assertRaisesMessage(CommandError, "--older-than"):
+            self._compact(older_than=-1)
+
+
+SHARDS = {"us_central": "rides_us_central", "us_east": "rides_us_east"}
+
+
+@override_settings(RIDE_SHARDS=SHARDS)
+class RideShardingTests(BaseAPITestCase):
+    # pickup longitudes in us_west ("default"), us_central and us_east
+    CITIES = [(37.7749, -122.4194), (41.8781, -87.6298), (40.7128, -74.0060)]
+
+    @classmethod
+    def setUpClass(cls):
+        # stand-in shards, test databases next to the default one that only
+        # exist while these tests run
+        for alias in SHARDS.values():
+            cls._create_shard_database(alias)
+        # not known to the test runner, which checks every alias it's told of
+        cls.databases = {*cls.databases, *SHARDS.values()}
+        super().setUpClass()
+
+    @classmethod
+    def _create_shard_database(cls, alias):
+        default = connections[DEFAULT_DB_ALIAS].settings_dict
+        name = f"{default['NAME']}_{alias.removeprefix('rides_')}"
+        # connections.settings is settings.DATABASES
+        connections.settings[alias] = {
+            **default,
+            "NAME": name,
+            "TEST": {**default["TEST"], "NAME": name},
+        }
+        cls.addClassCleanup(cls._drop_shard_database, alias)
+        connections[alias].creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+
+    @staticmethod
+    def _drop_shard_database(alias):
+        connections[alias].creation.destroy_test_db(verbosity=0)
+        del connections[alias]
+        del connections.settings[alias]
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for alias in shard_aliases():
+            configure_sequences(alias)
+
+        cls.rides = []
+        for i in range(6):
+            latitude, longitude = cls.CITIES[i % 3]
+            ride = Ride.objects.create(
+                status=RideStatus.EN_ROUTE,
+                id_rider=cls.rider_user,
+                id_driver=cls.driver_user,
+                pickup_latitude=latitude,
+                pickup_longitude=longitude,
+                dropoff_latitude=latitude + 0.01,
+                dropoff_longitude=longitude,
+                pickup_time=timezone.now() + timedelta(hours=i),
+            )
+            RideEvent.objects.create(
+                id_ride=ride, description=RideEventType.STATUS_EN_ROUTE
+            )
+            cls.rides.append(ride)
+
+    def setUp(self):
+        cache.clear()
+        self._authenticate_as(self.admin_user)
+
+    def _ids(self, response):
+        return [ride["id_ride"] for ride in response.data["results"]]
+
+    def test_rows_live_on_their_regions_shard(self):
+        self.assertEqual(
+            shard_aliases(), ["default", "rides_us_central", "rides_us_east"]
+        )
+        for i, ride in enumerate(self.rides):
+            alias = shard_aliases()[i % 3]
+            self.assertEqual(ride._state.db, alias)
+            self.assertEqual(shard_for_ride_id(ride.id_ride), alias)
+            self.assertTrue(
+                RideEvent.objects.using(alias).filter(id_ride=ride).exists()
+            )
+            self.assertEqual(
+                RideStatsCounter.objects.using(alias).totals(RideStatsDimension.STATUS),
+                {RideStatus.EN_ROUTE: 2},
+            )
+
+        # the riders and drivers the shard's rides reference
+        self.assertEqual(
+            set(User.objects.using("rides_us_east").values_list("pk", flat=True)),
+            {self.rider_user.pk, self.driver_user.pk},
+        )
+
+    def test_refuses_ids_routed_to_another_shard(self):
+        # as if shard_sequences hadn't run, setval isn't rolled back
+        self.addCleanup(configure_sequences, "rides_us_east")
+        with connections["rides_us_east"].cursor() as cursor:
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence('rides_ride', 'id_ride'),"
+                " 30000, false)"
+            )
+        latitude, longitude = self.CITIES[2]
+
+        with self.assertRaisesMessage(ImproperlyConfigured, "shard_sequences"):
+            Ride.objects.create(
+                id_rider=self.rider_user,
+                id_driver=self.driver_user,
+                pickup_latitude=latitude,
+                pickup_longitude=longitude,
+                dropoff_latitude=latitude,
+                dropoff_longitude=longitude,
+                pickup_time=timezone.now(),
+            )
+        self.assertFalse(Ride.objects.using("rides_us_east").filter(pk=30000).exists())
+
+    def test_list_merges_shards(self):
+        response = self.client.get(RIDES_LIST_PATH, {"page_size": 4})
+        second = self.client.get(RIDES_LIST_PATH, {"page_size": 4, "page": 2})
+
+        ids = sorted(ride.id_ride for ride in self.rides)
+        self.assertEqual(response.data["count"], 6)
+        self.assertEqual(self._ids(response), ids[:4])
+        self.assertEqual(self._ids(second), ids[4:])
+
+    def test_list_merges_descending_ordering(self):
+        # farthest from New York first, ties newest first
+        params = {"ordering": "-distance", "latitude": 40.7, "longitude": -74.0}
+        first = self.client.get(RIDES_LIST_PATH, {**params, "page_size": 4})
+        second = self.client.get(RIDES_LIST_PATH, {**params, "page_size": 4, "page": 2})
+
+        self.assertEqual(
+            self._ids(first) + self._ids(second),
+            [self.rides[i].pk for i in (3, 0, 4, 1, 5, 2)],
+        )
+
+    def test_region_filter_queries_one_shard(self):
+        with self.assertNumQueries(0, using="rides_us_central"):
+            response = self.client.get(RIDES_LIST_PATH, {"region": "us_east"})
+
+        self.assertEqual(self._ids(response), [self.rides[2].pk, self.rides[5].pk])
+
+    def test_detail_transition_and_batch(self):
+        ride = self.rides[1]
+
+        response = self.client.get(f"{RIDES_LIST_PATH}{ride.pk}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["pickup_longitude"], ride.pickup_longitude)
+
+        response = self.client.post(
+            f"{RIDES_LIST_PATH}{ride.pk}/transition/", {"status": RideStatus.PICKUP}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            Ride.objects.using("rides_us_central").get(pk=ride.pk).status,
+            RideStatus.PICKUP,
+        )
+
+        ids = [self.rides[2].pk, self.rides[0].pk, ride.pk]
+        response = self.client.get(
+            f"{RIDES_LIST_PATH}batch/", {"ids": ",".join(map(str, ids))}
+        )
+        self.assertEqual(self._ids(response), ids)
+
+    def test_event_feed_merges_shards(self):
+        self.enterContext(mock.patch.object(ride_event_notifier, "start"))
+        ride_event_notifier.latest_ids = {}
+        events = sorted(
+            (
+                event
+                for alias in shard_aliases()
+                for event in RideEvent.objects.using(alias).all()
+            ),
+            key=attrgetter("id_ride_event"),
+        )
+
+        pages, cursor = [], "0"
+        while True:
+            response = self.client.get(
+                "/api/ride-events/feed/", {"after": cursor, "limit": 4}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            if not response.data["results"]:
+                break
+            pages.append([e["id_ride_event"] for e in response.data["results"]])
+            cursor = response.data["cursor"]
+
+        ids = [event.id_ride_event for event in events]
+        self.assertEqual(pages, [ids[:4], ids[4:]])
+        # the last id of every shard
+        self.assertEqual(
+            cursor,
+            ".".join(
+                str(max(e.id_ride_event for e in events if e._state.db == alias))
+                for alias in shard_aliases()
+            ),
+        )
+
+        # behind the default shard's latest id, still after us_east's
+        new_event = RideEvent.objects.create(
+            id_ride=self.rides[2], description=RideEventType.STATUS_PICKUP
+        )
+        response = self.client.get("/api/ride-events/feed/", {"after": cursor})
+        self.assertEqual(
+            [e["id_ride_event"] for e in response.data["results"]],
+            [new_event.id_ride_event],
+        )
+
+        response = self.client.get("/api/ride-events/feed/", {"after": "1.2"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_admin_lists_every_shard(self):
+        staff = User.objects.create_superuser(
+            username="shard_staff", email="shard.staff@example.com", password="pw"
+        )
+        self.client.force_login(staff)
+
+        response = self.client.get("/admin/rides/ride/", {"o": "-2"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        cl = response.context["cl"]
+        self.assertEqual(cl.result_count, 6)
+        # status descending, then -pk
+        self.assertEqual(
+            [ride.pk for ride in cl.result_list],
+            sorted((ride.pk for ride in self.rides), reverse=True),
+        )
+
+        response = self.client.get("/admin/rides/rideevent/")
+        cl = response.context["cl"]
+        self.assertEqual(cl.result_count, 6)
+        self.assertEqual(
+            [event.pk for event in cl.result_list],
+            sorted(
+                (
+                    event.pk
+                    for alias in shard_aliases()
+                    for event in RideEvent.objects.using(alias).all()
+                ),
+                reverse=True,
+            ),
+        )
+
+        ride = self.rides[2]
+        response = self.client.get(f"/admin/rides/ride/{ride.pk}/change/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.context["original"]._state.db, "rides_us_east")
+
+    def test_ride_history_merges_shards(self):
+        self._authenticate_as(self.rider_user)
+        first = self.client.get(f"{RIDES_LIST_PATH}mine/", {"page_size": 4})
+        second = self.client.get(
+            f"{RIDES_LIST_PATH}mine/",
+            {"page_size": 4, "cursor": first.data["cursor"]},
+        )
+
+        self.assertEqual(
+            self._ids(first) + self._ids(second),
+            [ride.pk for ride in reversed(self.rides)],
+        )
+        self.assertIsNone(second.data["cursor"])
+
+    def test_stats_add_up_shards(self):
+        response = self.client.get(
+            f"{RIDES_LIST_PATH}stats/", {"dimension": RideStatsDimension.STATUS}
+        )
+
+        self.assertEqual(response.data["counts"], {RideStatus.EN_ROUTE: 6})
+
+    def test_event_delete_invalidates_after_its_shards_commit(self):
+        event = RideEvent.objects.using("rides_us_east").get(id_ride=self.rides[2])
+
+        with self.captureOnCommitCallbacks(using="rides_us_east") as callbacks:
+            event.delete()
+
+        self.assertEqual(len(callbacks), 1)
+
+    def test_reconcile_stats_on_every_shard(self):
+        # bypasses the counters
+        Ride.objects.using("rides_us_east").filter(pk=self.rides[2].pk).update(
+            status=RideStatus.PICKUP
+        )
+
+        out = StringIO()
+        call_command("reconcile_ride_stats", stdout=out)
+
+        self.assertIn("default: Counters are in sync", out.getvalue())
+        self.assertIn("rides_us_east: Fixed 2 counters", out.getvalue())
+        self.assertEqual(
+            RideStatsCounter.objects.using("rides_us_east").totals(
+                RideStatsDimension.STATUS
+            ),
+            {RideStatus.EN_ROUTE: 1, RideStatus.PICKUP: 1},
+        )
+
+
+@override_settings(RIDE_LIST_PREPARED_STATEMENTS=True)
+class RideListPreparedStatementTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i, status_ in enumerate([RideStatus.EN_ROUTE, RideStatus.PICKUP] * 3):
+            ride = Ride.objects.create(
+                status=status_,
+                id_rider=cls.rider_user if i % 2 else cls.rider_user_2,
+                id_driver=cls.driver_user,
+                pickup_latitude=40.7128 + i / 100,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=timezone.now() + timedelta(hours=i),
+            )
+            RideEvent.objects.create(
+                id_ride=ride, description=RideEventType.STATUS_PICKUP
+            )
+
+    def setUp(self):
+        prepared._templates.clear()
+        self._authenticate_as(self.admin_user)
+
+    def _prepared_statements(self) -> list[str]:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT statement FROM pg_prepared_statements")
+            return [statement for (statement,) in cursor.fetchall()]
+
+    def test_same_results_as_compiled(self):
+        for params in [
+            {},
+            {"status": RideStatus.PICKUP, "page_size": 2, "page": 2},
+            {"rider_email": self.rider_user.email.upper()},
+            {"rider_email": "nobody@example.com"},
+            {"ordering": "-pickup_time", "fields": "id_ride,status"},
+            {"ordering": "distance", "latitude": 40.75, "longitude": -74.0},
+            {"region": "us_east", "format": "sideloaded"},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(RIDES_LIST_PATH, params)
+                with self.settings(RIDE_LIST_PREPARED_STATEMENTS=False):
+                    compiled = self.client.get(RIDES_LIST_PATH, params)
+
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.json(), compiled.json())
+
+    def test_shape_compiled_once_and_prepared(self):
+        first = self.client.get(RIDES_LIST_PATH, {"status": RideStatus.EN_ROUTE})
+        with mock.patch.object(
+            SQLCompiler, "as_sql", autospec=True, side_effect=SQLCompiler.as_sql
+        ) as as_sql:
+            second = self.client.get(RIDES_LIST_PATH, {"status": RideStatus.PICKUP})
+
+        self.assertEqual(len(prepared._templates), 1)
+        # the auth user lookup and the events prefetch, no ride query
+        compiled = [call.args[0].query.model for call in as_sql.call_args_list]
+        self.assertEqual(compiled, [User, RideEvent])
+        self.assertNotEqual(first.data["results"], second.data["results"])
+
+        statements = self._prepared_statements()
+        count_sql = prepared._templates.popitem()[1].count_sql
+        self.assertIn(count_sql.replace("%s", "$1"), statements)
+
+    def test_coordinates_without_distance_ordering_share_the_shape(self):
+        with self.assertNoLogs("rides.prepared"):
+            for latitude in (40.75, 41.0):
+                response = self.client.get(
+                    RIDES_LIST_PATH,
+                    {
+                        "status": RideStatus.PICKUP,
+                        "latitude": latitude,
+                        "longitude": -74.0,
+                    },
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.client.get(RIDES_LIST_PATH, {"status": RideStatus.EN_ROUTE})
+
+        self.assertEqual(len(prepared._templates), 1)
+        self.assertIsNotNone(next(iter(prepared._templates.values())))
+
+    def test_unpreparable_shape_compiled_as_usual(self):
+        with (
+            mock.patch.object(prepared.Template, "__init__", side_effect=ValueError),
+            self.assertLogs("rides.prepared", "INFO") as logs,
+        ):
+            response = self.client.get(RIDES_LIST_PATH, {"status": RideStatus.PICKUP})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 3)
+        self.assertEqual([record.levelname for record in logs.records], ["INFO"])
+
+    def test_changed_queryset_compiled_as_usual(self):
+        view = RideViewSet(action_map={"get": "list"}, format_kwarg=None, kwargs={})
+        view.request = view.initialize_request(
+            APIRequestFactory().get(RIDES_LIST_PATH, {"status": RideStatus.PICKUP})
+        )
+        queryset = view.get_queryset()
+
+        self.assertEqual(queryset.count(), 3)
+        self.assertEqual(
+            list(queryset.order_by("-id_ride").values_list("id_ride", flat=True)),
+            sorted(queryset.values_list("id_ride", flat=True), reverse=True),
+        )
+        self.assertTrue(queryset.exists())
+
+
+class PreparedStatementFallbackTests(TransactionTestCase):
+    def test_missing_statement_retried_unprepared(self):
+        with prepared.execute(connection, "SELECT %s::int + 1", [1]) as cursor:
+            self.assertEqual(cursor.fetchone(), (2,))
+        # what a pooler handing out another server connection looks like
+        connection.connection.pgconn.exec_(b"DEALLOCATE ALL")
+
+        with self.assertLogs("rides.prepared", "WARNING"):
+            with prepared.execute(connection, "SELECT %s::int + 1", [2]) as cursor:
+                self.assertEqual(cursor.fetchone(), (3,))
+        self.assertIn(connection.connection, prepared._unpreparable)
+
+
+class RideTripGeometryTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+
+        def ride(pickup, dropoff):
+            return Ride.objects.create(
+                id_rider=cls.rider_user,
+                id_driver=cls.driver_user,
+                pickup_latitude=pickup[0],
+                pickup_longitude=pickup[1],
+                dropoff_latitude=dropoff[0],
+                dropoff_longitude=dropoff[1],
+                pickup_time=timezone.now(),
+            )
+
+        manhattan, brooklyn = (40.7580, -73.9855), (40.6782, -73.9442)
+        philadelphia, san_francisco = (39.9526, -75.1652), (37.7749, -122.4194)
+        cls.short = ride(manhattan, brooklyn)
+        cls.long = ride(manhattan, philadelphia)
+        cls.west = ride(san_francisco, (37.8044, -122.2712))
+
+    def setUp(self):
+        self._authenticate_as(self.admin_user)
+
+    def _ids(self, params):
+        response = self.client.get(RIDES_LIST_PATH, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [ride["id_ride"] for ride in response.data["results"]]
+
+    def test_trigger_matches_save(self):
+        stored = Ride.objects.get(pk=self.long.pk)
+
+        self.assertAlmostEqual(self.long.distance_km, 134.2, delta=0.1)
+        self.assertAlmostEqual(stored.distance_km, self.long.distance_km, places=6)
+        self.assertEqual(
+            (stored.bbox_south, stored.bbox_west, stored.bbox_north, stored.bbox_east),
+            (39.9526, -75.1652, 40.7580, -73.9855),
+        )
+
+    def test_writes_bypassing_save_are_kept_in_sync(self):
+        (ride,) = Ride.objects.bulk_create([Ride(**self._coordinates(self.short))])
+        self.assertAlmostEqual(
+            Ride.objects.get(pk=ride.pk).distance_km, self.short.distance_km
+        )
+
+        Ride.objects.filter(pk=ride.pk).update(
+            dropoff_latitude=self.long.dropoff_latitude,
+            dropoff_longitude=self.long.dropoff_longitude,
+        )
+        self.assertAlmostEqual(
+            Ride.objects.get(pk=ride.pk).distance_km, self.long.distance_km
+        )
+
+    def _coordinates(self, ride):
+        return {
+            field: getattr(ride, field)
+            for field in (
+                "id_rider_id",
+                "id_driver_id",
+                "pickup_latitude",
+                "pickup_longitude",
+                "dropoff_latitude",
+                "dropoff_longitude",
+                "pickup_time",
+            )
+        }
+
+    def test_distance_filters(self):
+        self.assertEqual(self._ids({"min_distance_km": 50}), [self.long.pk])
+        self.assertEqual(
+            self._ids({"max_distance_km": 50}), [self.short.pk, self.west.pk]
+        )
+        self.assertEqual(
+            self._ids({"min_distance_km": 10, "max_distance_km": 50}), [self.west.pk]
+        )
+
+    def test_bbox_filter_matches_overlapping_trips(self):
+        # around Trenton, between the long trip's ends
+        self.assertEqual(self._ids({"bbox": "-74.9,40.1,-74.6,40.3"}), [self.long.pk])
+        self.assertEqual(
+            self._ids({"bbox": "-74.1,40.6,-73.9,40.8", "max_distance_km": 50}),
+            [self.short.pk],
+        )
+
+    def test_invalid_filters(self):
+        for params in [
+            {"bbox": "-74,40,-73"},
+            {"bbox": "-73,40,-74,41"},
+            {"bbox": "-74,95,-73,96"},
+            {"min_distance_km": -1},
+            {"min_distance_km": 10, "max_distance_km": 5},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(RIDES_LIST_PATH, params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_backfill(self):
+        # rides stored before the columns existed
+        Ride.objects.update(
+            distance_km=None,
+            bbox_south=None,
+            bbox_west=None,
+            bbox_north=None,
+            bbox_east=None,
+        )
+
+        out = StringIO()
+        call_command("backfill_ride_geometry", batch_size=2, sleep=0, stdout=out)
+
+        self.assertIn("default: 3 rides backfilled", out.getvalue())
+        self.assertFalse(Ride.objects.filter(bbox_east__isnull=True).exists())
+        self.assertAlmostEqual(
+            Ride.objects.get(pk=self.long.pk).distance_km, self.long.distance_km
+        )
+
+    def test_coordinate_constraints_still_enforced(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Ride.objects.bulk_create(
+                [Ride(**{**self._coordinates(self.short), "dropoff_latitude": 91})]
+            )
+
+
+class RideTimeRangeTests(BaseAPITestCase):
+    FEED_PATH = "/api/ride-events/feed/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.start = datetime(2026, 3, 1, tzinfo=UTC)
+        cls.rides = [
+            Ride.objects.create(
+                id_rider=cls.rider_user,
+                id_driver=cls.driver_user,
+                pickup_latitude=40.7128,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=cls.start + timedelta(days=day),
+            )
+            for day in range(4)
+        ]
+        cls.events = []
+        for ride in cls.rides:
+            for minutes in (0, 30):
+                event = RideEvent.objects.create(
+                    id_ride=ride, description=RideEventType.STATUS_EN_ROUTE
+                )
+                # auto_now_add
+                RideEvent.objects.filter(pk=event.pk).update(
+                    created_at=ride.pickup_time + timedelta(minutes=minutes)
+                )
+                cls.events.append(event)
+
+    def setUp(self):
+        patcher = mock.patch.object(ride_event_notifier, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ride_event_notifier.latest_ids = {}
+        self._authenticate_as(self.admin_user)
+
+    def _ids(self, params):
+        response = self.client.get(RIDES_LIST_PATH, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [ride["id_ride"] for ride in response.data["results"]]
+
+    def _day(self, day):
+        return (self.start + timedelta(days=day)).isoformat()
+
+    def test_pickup_range_includes_start_excludes_end(self):
+        self.assertEqual(
+            self._ids({"pickup_after": self._day(1), "pickup_before": self._day(3)}),
+            [self.rides[1].pk, self.rides[2].pk],
+        )
+        self.assertEqual(self._ids({"pickup_after": self._day(3)}), [self.rides[3].pk])
+        self.assertEqual(self._ids({"pickup_before": self._day(1)}), [self.rides[0].pk])
+
+    def test_pickup_range_combines_with_filters_and_prepared_statements(self):
+        params = {
+            "pickup_after": self._day(1),
+            "pickup_before": self._day(3),
+            "ordering": "-pickup_time",
+            "status": RideStatus.EN_ROUTE,
+        }
+        expected = self._ids(params)
+
+        with override_settings(RIDE_LIST_PREPARED_STATEMENTS=True):
+            self.assertEqual(self._ids(params), expected)
+            self.assertEqual(
+                self._ids({**params, "pickup_after": self._day(2)}),
+                [self.rides[2].pk],
+            )
+
+    def test_invalid_ranges(self):
+        for params in [
+            {"pickup_after": "yesterday"},
+            {"pickup_after": self._day(2), "pickup_before": self._day(2)},
+            {"pickup_after": self._day(3), "pickup_before": self._day(1)},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(RIDES_LIST_PATH, params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(
+            self.FEED_PATH,
+            {"created_after": self._day(3), "created_before": self._day(1)},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_feed_pages_through_created_range(self):
+        params = {"created_after": self._day(1), "created_before": self._day(3)}
+        in_range = [event.id_ride_event for event in self.events[2:6]]
+
+        pages, cursor = [], 0
+        while True:
+            response = self.client.get(
+                self.FEED_PATH, {**params, "limit": 3, "after": cursor}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            if not response.data["results"]:
+                break
+            pages.append([e["id_ride_event"] for e in response.data["results"]])
+            cursor = response.data["cursor"]
+
+        self.assertEqual(pages, [in_range[:3], in_range[3:]])
+
+    def test_ranges_can_use_brin_indexes(self):
+        with connection.cursor() as cursor:
+            for table, index, column in [
+                ("rides_ride", "ride_pickup_time_brin_idx", "pickup_time"),
+                ("rides_rideevent", "rideevent_created_brin_idx", "created_at"),
+            ]:
+                constraints = connection.introspection.get_constraints(cursor, table)
+                self.assertEqual(constraints[index]["type"], "brin")
+                self.assertEqual(constraints[index]["columns"], [column])
+
+        after = self.start + timedelta(days=1)
+        with transaction.atomic(), connection.cursor() as cursor:
+            # a handful of rows, scanning everything would be cheapest
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("SET LOCAL enable_indexscan = off")
+            # a full scan of these (tiny) indexes costs the same, rolled back
+            cursor.execute("DROP INDEX ride_rider_pickup_idx, ride_driver_pickup_idx")
+            self.assertIn(
+                "ride_pickup_time_brin_idx",
+                Ride.objects.pickup_between(after, after + timedelta(hours=1))
+                .order_by()
+                .explain(),
+            )
+
+
+class RideSearchTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.johnson = User.objects.create_user(
+            username="johnson",
+            email="m.johnson@example.org",
+            first_name="Maria",
+            last_name="Johnson",
+            role=UserRole.DRIVER,
+            phone_number="+15550104242",
+        )
+
+        def ride(rider, driver, status=RideStatus.EN_ROUTE, latitude=40.7128):
+            return Ride.objects.create(
+                status=status,
+                id_rider=rider,
+                id_driver=driver,
+                pickup_latitude=latitude,
+                pickup_longitude=-74.0060,
+                dropoff_latitude=40.7580,
+                dropoff_longitude=-73.9855,
+                pickup_time=timezone.now(),
+            )
+
+        # John Rider matches "John" exactly, Maria Johnson partially
+        cls.by_johnson = ride(
+            cls.rider_user_2, cls.johnson, RideStatus.DROPOFF, latitude=40.0
+        )
+        cls.by_rider = ride(cls.rider_user, cls.driver_user)
+        cls.unrelated = ride(cls.rider_user_2, cls.driver_user)
+
+    def setUp(self):
+        cache.clear()
+        self._authenticate_as(self.admin_user)
+
+    def _ids(self, params):
+        response = self.client.get(RIDES_LIST_PATH, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [ride["id_ride"] for ride in response.data["results"]]
+
+    def test_best_matches_first(self):
+        self.assertEqual(
+            self._ids({"q": "John"}), [self.by_rider.pk, self.by_johnson.pk]
+        )
+        self.assertEqual(self._ids({"q": "johnsen"}), [self.by_johnson.pk])
+        self.assertEqual(self._ids({"q": "0104242"}), [self.by_johnson.pk])
+
+    def test_combines_with_filters_and_ordering(self):
+        self.assertEqual(
+            self._ids({"q": "John", "status": RideStatus.DROPOFF}),
+            [self.by_johnson.pk],
+        )
+        self.assertEqual(
+            self._ids(
+                {"q": "John", "ordering": "distance", "latitude": 0, "longitude": 0}
+            ),
+            [self.by_johnson.pk, self.by_rider.pk],
+        )
+        with override_settings(RIDE_LIST_PREPARED_STATEMENTS=True):
+            self.assertEqual(
+                self._ids({"q": "John"}), [self.by_rider.pk, self.by_johnson.pk]
+            )
+
+    def test_no_match(self):
+        self.assertEqual(self._ids({"q": "zzqx"}), [])
+
+    def test_invalid_or_too_broad_terms(self):
+        response = self.client.get(RIDES_LIST_PATH, {"q": "jo"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with mock.patch.object(
+            User.objects, "search", side_effect=SearchTooBroad("too broad")
+        ):
+            response = self.client.get(RIDES_LIST_PATH, {"q": "example"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("q", response.data)
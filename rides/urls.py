@@ -1,10 +1,20 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from .views import RideViewSet
+from .views import (
+    DriverViewSet,
+    MemoryProfileViewSet,
+    RequestProfileViewSet,
+    RideEventViewSet,
+    RideViewSet,
+)
 
 router = DefaultRouter()
 router.register(r"rides", RideViewSet, basename="ride")
+router.register(r"drivers", DriverViewSet, basename="driver")
+router.register(r"ride-events", RideEventViewSet, basename="ride-event")
+router.register(r"memory-profiles", MemoryProfileViewSet, basename="memory-profile")
+router.register(r"request-profiles", RequestProfileViewSet, basename="request-profile")
 
 urlpatterns = [
     path("", include(router.urls)),
@@ -1,14 +1,69 @@
 import logging
+import time
+from collections import Counter
+from functools import partial
+from heapq import merge
+from itertools import islice
+from operator import attrgetter
 
-from django.db import connection, reset_queries
-from rest_framework import viewsets
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, reset_queries
+from django.http import FileResponse
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
 
-from api.permissions import IsAdminUser
+from api.memory import MemoryProfile, get_report, list_reports
+from api.permissions import IsAdminOrDriverUser, IsAdminUser, IsRiderOrDriverUser
+from api.profiling import list_profiles, profile_path
+from users.models import SearchTooBroad, User, UserRole
+from users.serializers import BaseUserSerializer
 
-from .models import Ride
-from .pagination import RidePagination
-from .serializers import RideSerializer, RideQueryParamsSerializer
+from .feed import format_cursor, ride_event_notifier
+from .heatmap import get_tile
+from .ingest import BufferFull, ride_event_buffer
+from .locations import driver_locations
+from .models import RIDE_STATUS_TRANSITIONS, Ride, RideEvent, RideStatsCounter
+from .pagination import RidePagination, encode_history_cursor
+from .prepared import prepare_ride_list
+from .queryset import RELATED_FIELDS
+from .renderers import (
+    SIDELOADED_FORMATS,
+    ColumnarJSONRenderer,
+    SideloadedJSONRenderer,
+    to_columns,
+)
+from .ride_cache import (
+    RIDE_HISTORY_CACHE_TIMEOUT,
+    cache_rides,
+    get_cached_rides,
+    ride_history_cache_key,
+)
+from .serializers import (
+    DriverLocationBatchSerializer,
+    HeatmapTileParamsSerializer,
+    NearestDriversQueryParamsSerializer,
+    OwnRideSerializer,
+    RideBatchSerializer,
+    RideEventBatchSerializer,
+    RideEventFeedQueryParamsSerializer,
+    RideEventFeedSerializer,
+    RideHistoryQueryParamsSerializer,
+    RideQueryParamsSerializer,
+    RideSerializer,
+    RideStatsQueryParamsSerializer,
+    RideTransitionSerializer,
+)
+from .sharding import (
+    ScatteredQuerySet,
+    group_by_shard,
+    shard_aliases,
+    shard_for_region,
+    shard_for_ride_id,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -18,48 +73,557 @@ class RideViewSet(viewsets.ModelViewSet):
     serializer_class = RideSerializer
     permission_classes = [IsAdminUser]
     pagination_class = RidePagination
+    lookup_value_regex = r"\d+"
+    # `?memory_profile=1` on the list, see api.memory
+    memory_profile = None
 
     def get_queryset(self):
-        queryset = (
-            super()
-            .get_queryset()
-            .with_rider_and_driver()
-            .with_todays_ride_events()
-            .with_pickup_event_time()
-        )
-
         params_serializer = RideQueryParamsSerializer(data=self.request.query_params)
         params_serializer.is_valid(raise_exception=True)
         validated_data = params_serializer.validated_data
 
-        if status := validated_data.get("status"):
-            queryset = queryset.status(status)
-
-        if rider_email := validated_data.get("rider_email"):
-            queryset = queryset.rider_email(rider_email)
+        queryset = super().get_queryset()
 
-        if ordering := validated_data.get("ordering"):
-            if ordering in ("pickup_time", "-pickup_time"):
-                order_field = ordering.replace("pickup_time", "pickup_event_time")
-                queryset = queryset.order_by(order_field)
-            elif ordering in ("distance", "-distance"):
-                latitude = validated_data.get("latitude")
-                longitude = validated_data.get("longitude")
+        # the databases to query, see rides.sharding
+        if "pk" in self.kwargs:
+            self.shards = [shard_for_ride_id(int(self.kwargs["pk"]))]
+        elif region := validated_data.get("region"):
+            self.shards = [shard_for_region(region)]
+        else:
+            self.shards = shard_aliases()
+        if len(self.shards) == 1:
+            queryset = queryset.using(self.shards[0])
 
-                if latitude is not None and longitude is not None:
-                    queryset = queryset.distance_from(latitude, longitude).order_by(
-                        ordering
-                    )
+        self.sparse_fields = validated_data.get("fields")
+        build = partial(self._build_queryset, queryset)
+        try:
+            queryset = build(validated_data)
+        except SearchTooBroad:
+            raise ValidationError(
+                {"q": "Matches too many users, try a longer or more specific term."}
+            ) from None
 
+        if (
+            settings.RIDE_LIST_PREPARED_STATEMENTS
+            and self.action == "list"
+            and len(self.shards) == 1
+        ):
+            queryset = prepare_ride_list(
+                queryset, validated_data, build, key=(self.sideloaded,)
+            )
         return queryset
 
+    def _build_queryset(self, queryset, params: dict):
+        if self.sideloaded:
+            # users are fetched once per page instead of joined per ride
+            queryset = queryset.for_fields(
+                self.sparse_fields or RideSerializer.readable_field_names(),
+                join_users=False,
+            )
+        elif self.sparse_fields:
+            queryset = queryset.for_fields(self.sparse_fields)
+        else:
+            queryset = queryset.with_rider_and_driver().with_todays_ride_events()
+
+        return queryset.apply_query_params(params)
+
+    def paginate_queryset(self, queryset):
+        if len(self.shards) > 1:
+            # cross-region: every shard's page, merged on the ordering
+            queryset = ScatteredQuerySet(queryset, self.shards)
+        page = super().paginate_queryset(queryset)
+        if self.memory_profile:
+            self.memory_profile.mark("queryset")
+        return page
+
+    def get_paginated_response(self, data):
+        if self.memory_profile:
+            self.memory_profile.mark("serialization")
+        return super().get_paginated_response(data)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.memory_profile:
+            profile, self.memory_profile = self.memory_profile, None
+            try:
+                response.render()
+                profile.mark("rendering")
+                report = profile.finish(response)
+            finally:
+                # releases the profiling lock if rendering failed
+                profile.stop()
+            response["X-Memory-Profile"] = report["id"]
+        return response
+
+    @property
+    def sideloaded(self) -> bool:
+        renderer = getattr(self.request, "accepted_renderer", None)
+        return getattr(renderer, "format", None) in SIDELOADED_FORMATS
+
+    def get_renderers(self):
+        renderers = super().get_renderers()
+        if self.action == "list":
+            renderers += [SideloadedJSONRenderer(), ColumnarJSONRenderer()]
+        return renderers
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.request.method in SAFE_METHODS:
+            context["fields"] = getattr(self, "sparse_fields", None)
+            context["sideload"] = self.sideloaded
+        return context
+
+    @action(detail=False, methods=["get"])
+    def stats(self, request):
+        """
+        Ride counts per status, driver or pickup day, read from the counter
+        table rather than counting rides_ride.
+        """
+        params_serializer = RideStatsQueryParamsSerializer(data=request.query_params)
+        params_serializer.is_valid(raise_exception=True)
+        dimension = params_serializer.validated_data["dimension"]
+        key = params_serializer.validated_data.get("key")
+
+        counts = Counter()
+        for alias in shard_aliases():
+            counts.update(
+                RideStatsCounter.objects.using(alias).totals(dimension, key=key)
+            )
+        return Response(
+            {"dimension": dimension, "counts": dict(sorted(counts.items()))}
+        )
+
+    @action(
+        detail=False,
+        methods=["get"],
+        url_path=r"heatmap/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)",
+    )
+    def heatmap(self, request, z, x, y):
+        """
+        Pickup counts binned over a z/x/y map tile, optionally filtered by
+        status and pickup time. Tiles are cached until a ride inside changes.
+        """
+        params_serializer = HeatmapTileParamsSerializer(
+            data={**request.query_params.dict(), "z": z, "x": x, "y": y}
+        )
+        params_serializer.is_valid(raise_exception=True)
+        params = params_serializer.validated_data
+
+        queryset = Ride.objects.all()
+        filters = {}
+        if status_filter := params.get("status"):
+            queryset = queryset.status(status_filter)
+            filters["status"] = status_filter
+        queryset = queryset.pickup_between(
+            params.get("pickup_after"), params.get("pickup_before")
+        )
+        # part of the tile's cache key
+        for name in ("pickup_after", "pickup_before"):
+            if name in params:
+                filters[name] = params[name].isoformat()
+
+        return Response(
+            get_tile(
+                [queryset.using(alias) for alias in shard_aliases()],
+                params["z"],
+                params["x"],
+                params["y"],
+                filters,
+            )
+        )
+
+    @action(detail=False, methods=["get", "post"])
+    def batch(self, request):
+        """
+        Rides by id (`?ids=1,2,3` or `{"ids": [...]}`), in the requested order.
+        Served from the per-ride cache, misses are loaded together through the
+        list's select_related/prefetch pipeline.
+        """
+        data = request.query_params if request.method == "GET" else request.data
+        serializer = RideBatchSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data["ids"]
+
+        rides = self._rides_by_id(ids)
+        return Response(
+            {
+                "results": [rides[id_ride] for id_ride in ids if id_ride in rides],
+                "missing": [id_ride for id_ride in ids if id_ride not in rides],
+            }
+        )
+
+    @action(detail=False, methods=["get"], permission_classes=[IsRiderOrDriverUser])
+    def mine(self, request):
+        """
+        The requesting rider's (or driver's) own rides, latest pickup first,
+        keyset paged: `cursor` is the previous response's, null on the last
+        page. The latest page's ids come from a per-user cache, the rides
+        themselves from the per-ride cache like `batch`.
+        """
+        params_serializer = RideHistoryQueryParamsSerializer(data=request.query_params)
+        params_serializer.is_valid(raise_exception=True)
+        page_size = params_serializer.validated_data["page_size"]
+        before = params_serializer.validated_data.get("cursor")
+
+        role, id_user = request.user.role, request.user.id_user
+        key = ride_history_cache_key(role, id_user)
+        rows = cache.get(key) if before is None else None
+        if rows is None:
+            # the latest page is cached at its largest size, for every page_size
+            limit = RidePagination.max_page_size if before is None else page_size
+            queryset = Ride.objects.history(RELATED_FIELDS[role], id_user, before)
+            rides = ScatteredQuerySet(
+                queryset.only("id_ride", "pickup_time"), shard_aliases()
+            )[: limit + 1]
+            rows = [(ride.id_ride, ride.pickup_time) for ride in rides]
+            if before is None:
+                cache.set(key, rows, RIDE_HISTORY_CACHE_TIMEOUT)
+
+        page = rows[:page_size]
+        rides = self._rides_by_id([id_ride for id_ride, _ in page], role=role)
+        return Response(
+            {
+                "cursor": (
+                    encode_history_cursor(page[-1][1], page[-1][0])
+                    if len(rows) > page_size
+                    else None
+                ),
+                # a ride deleted since its id was cached is left out
+                "results": [rides[id_ride] for id_ride, _ in page if id_ride in rides],
+            }
+        )
+
+    def _rides_by_id(self, ids, role: str | None = None) -> dict[int, dict]:
+        """
+        Serialized rides from the per-ride cache, misses are loaded together
+        through the list's select_related/prefetch pipeline. With `role`, as
+        that rider's or driver's own rides (`OwnRideSerializer`).
+        """
+        variant = role or ""
+        rides = get_cached_rides(ids, variant)
+        if missing := [id_ride for id_ride in ids if id_ride not in rides]:
+            instances = [
+                ride
+                for alias, shard_ids in group_by_shard(missing).items()
+                for ride in Ride.objects.using(alias)
+                .with_rider_and_driver()
+                .with_todays_ride_events()
+                .filter(pk__in=shard_ids)
+            ]
+            if role:
+                serializer = OwnRideSerializer(
+                    instances, many=True, context={"role": role}
+                )
+            else:
+                serializer = RideSerializer(instances, many=True)
+            serialized = serializer.data
+            cache_rides(instances, serialized, variant)
+            rides.update((ride["id_ride"], ride) for ride in serialized)
+        return rides
+
+    @action(detail=True, methods=["post"])
+    def transition(self, request, pk=None):
+        """
+        en-route -> pickup -> dropoff, one conditional UPDATE + event INSERT and
+        no reads; 409 when the ride isn't in the expected status.
+        """
+        serializer = RideTransitionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        new_status = serializer.validated_data["status"]
+
+        id_ride_event = Ride.objects.using(shard_for_ride_id(int(pk))).transition(
+            int(pk), new_status
+        )
+        if id_ride_event is None:
+            return Response(
+                {
+                    "detail": f"Ride {pk} is not {RIDE_STATUS_TRANSITIONS[new_status]}"
+                    " (or does not exist)."
+                },
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        return Response(
+            {"id_ride": int(pk), "status": new_status, "id_ride_event": id_ride_event}
+        )
+
     def list(self, request, *args, **kwargs):
         if settings.DEBUG:
             reset_queries()
+        # not a RideQueryParamsSerializer field, so it can't change the
+        # prepared statement shapes
+        if request.query_params.get("memory_profile") in ("1", "true"):
+            self.memory_profile = MemoryProfile.start(request)
 
-        response = super().list(request, *args, **kwargs)
+        try:
+            if self.sideloaded:
+                response = self._sideloaded_list()
+            else:
+                response = super().list(request, *args, **kwargs)
+        except Exception:
+            if self.memory_profile:
+                self.memory_profile.stop()
+                self.memory_profile = None
+            raise
 
         if settings.DEBUG:
             logger.debug(f"{len(connection.queries)} queries")
 
         return response
+
+    def _sideloaded_list(self):
+        """
+        `?format=sideloaded|columnar`: rides reference rider/driver by id and
+        every distinct user on the page is serialized once under "users".
+        """
+        rides = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        serializer = self.get_serializer(rides, many=True)
+        results = serializer.data
+
+        user_ids = {
+            ride[name] for ride in results for name in RELATED_FIELDS if name in ride
+        }
+        users = BaseUserSerializer(
+            User.objects.filter(id_user__in=user_ids)
+            .only(*BaseUserSerializer.Meta.fields)
+            .order_by("id_user"),
+            many=True,
+        ).data
+
+        if self.request.accepted_renderer.format == ColumnarJSONRenderer.format:
+            fields = serializer.child.fields
+            results = to_columns(
+                results,
+                [name for name, field in fields.items() if not field.write_only],
+            )
+            users = to_columns(users, BaseUserSerializer.Meta.fields)
+
+        response = self.get_paginated_response(results)
+        response.data["users"] = users
+        return response
+
+
+class MemoryProfileViewSet(viewsets.ViewSet):
+    """
+    Reports of `GET /api/rides/?memory_profile=1` requests, see api.memory.
+    """
+
+    permission_classes = [IsAdminUser]
+    lookup_value_regex = r"[0-9a-f]{32}"
+
+    def list(self, request):
+        return Response(list_reports())
+
+    def retrieve(self, request, pk=None):
+        report = get_report(pk)
+        if report is None:
+            raise NotFound
+        return Response(report)
+
+
+class RequestProfileViewSet(viewsets.ViewSet):
+    """
+    CPU profiles of requests sent with `X-Profile-Request` or `?profile=1`, see
+    api.profiling.
+    """
+
+    permission_classes = [IsAdminUser]
+    lookup_value_regex = r"\d{13}-[0-9a-f]{8}"
+
+    def list(self, request):
+        return Response(list_profiles())
+
+    def retrieve(self, request, pk=None):
+        """
+        The profile's collapsed stacks, for flame graph tools.
+        """
+        path = profile_path(pk)
+        if path is None:
+            raise NotFound
+        return FileResponse(
+            path.open("rb"),
+            as_attachment=True,
+            filename=path.name,
+            content_type="text/plain; charset=utf-8",
+        )
+
+
+class DriverViewSet(viewsets.ViewSet):
+    permission_classes = [IsAdminOrDriverUser]
+
+    @action(detail=False, methods=["post"])
+    def locations(self, request):
+        """
+        Batched location pings. Drivers may only report their own location,
+        admins (e.g. an ingestion gateway) may report any driver's.
+        """
+        serializer = DriverLocationBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        pings = serializer.validated_data["pings"]
+
+        id_drivers = {ping[0] for ping in pings}
+        if request.user.role == UserRole.DRIVER:
+            if id_drivers != {request.user.id_user}:
+                raise PermissionDenied("Drivers can only report their own location.")
+        else:
+            # drivers already in the store were validated on an earlier batch
+            untracked = {i for i in id_drivers if not driver_locations.tracks(i)}
+            if untracked:
+                drivers = set(
+                    User.objects.filter(
+                        id_user__in=untracked, role=UserRole.DRIVER
+                    ).values_list("id_user", flat=True)
+                )
+                if unknown := sorted(untracked - drivers):
+                    raise ValidationError({"pings": f"Unknown drivers: {unknown}"})
+
+        driver_locations.start()
+        accepted = driver_locations.ingest(pings)
+        return Response(
+            {"received": len(pings), "accepted": accepted},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+    @action(detail=False, methods=["get"], permission_classes=[IsAdminUser])
+    def nearest(self, request):
+        params_serializer = NearestDriversQueryParamsSerializer(
+            data=request.query_params
+        )
+        params_serializer.is_valid(raise_exception=True)
+        params = params_serializer.validated_data
+
+        driver_locations.start()
+        drivers = driver_locations.nearest_available(
+            params["latitude"],
+            params["longitude"],
+            radius_km=params["radius_km"],
+            limit=params["limit"],
+        )
+
+        results = []
+        for distance_km, id_driver in drivers:
+            latitude, longitude, _ = driver_locations.get(id_driver)
+            results.append(
+                {
+                    "id_driver": id_driver,
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "distance_km": round(distance_km, 3),
+                }
+            )
+        return Response({"results": results})
+
+
+class RideEventViewSet(viewsets.ViewSet):
+    permission_classes = [IsAdminUser]
+
+    @action(detail=False, methods=["get"])
+    def feed(self, request):
+        """
+        Events after the `after` cursor, oldest first. With `wait`, blocks until
+        new events arrive (or the wait runs out) instead of returning empty.
+
+        `created_after`/`created_before` narrow the feed to a time range, the
+        cursor still pages through it.
+
+        Cursors follow id order, so only settled events are returned (see
+        `RideEventQuerySet.settled()`): an event waits until every transaction
+        that could still commit a lower id has finished.
+
+        With shards, every shard is read after its own id in the cursor and the
+        events are merged by id.
+        """
+        params_serializer = RideEventFeedQueryParamsSerializer(
+            data=request.query_params
+        )
+        params_serializer.is_valid(raise_exception=True)
+        params = params_serializer.validated_data
+        after = params["after"]
+        wait = params["wait"]
+        fetch = partial(
+            self._events_after,
+            limit=params["limit"],
+            created_after=params.get("created_after"),
+            created_before=params.get("created_before"),
+        )
+
+        ride_event_notifier.start()
+
+        # the settled ids a fetch that came back empty has looked at, e.g.
+        # events outside created_after/created_before
+        checked = ride_event_notifier.settled_cursor(after)
+        events = []
+        # skip the query entirely when the notifier knows nothing is newer
+        if ride_event_notifier.has_events_after(after):
+            events = fetch(after)
+
+        deadline = time.monotonic() + wait
+        while not events and (remaining := deadline - time.monotonic()) > 0:
+            seen = checked
+            if not ride_event_notifier.wait_for_events_after(seen, timeout=remaining):
+                break
+            checked = ride_event_notifier.settled_cursor(seen)
+            events = fetch(seen)
+
+        cursor = dict(after)
+        for event in events:
+            cursor[event._state.db] = event.id_ride_event
+        return Response(
+            {
+                "cursor": format_cursor(cursor),
+                "results": RideEventFeedSerializer(events, many=True).data,
+            }
+        )
+
+    @action(detail=False, methods=["post"], permission_classes=[IsAdminOrDriverUser])
+    def batch(self, request):
+        """
+        Buffered bulk ingestion, events are written within a second or so (see
+        `rides.ingest`). Drivers may only add events to their own rides.
+        """
+        serializer = RideEventBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        events = serializer.validated_data["events"]
+
+        id_rides = {event[0] for event in events}
+        known = set()
+        for alias, shard_ids in group_by_shard(id_rides).items():
+            rides = Ride.objects.using(alias).filter(id_ride__in=shard_ids)
+            if request.user.role == UserRole.DRIVER:
+                rides = rides.filter(id_driver=request.user.id_user)
+            known.update(rides.values_list("id_ride", flat=True))
+        if unknown := sorted(id_rides - known):
+            raise ValidationError({"events": f"Unknown rides: {unknown}"})
+
+        try:
+            accepted, duplicates = ride_event_buffer.add(events)
+        except BufferFull:
+            return Response(
+                {"detail": "Too many events waiting to be written, retry later."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": "1"},
+            )
+        return Response(
+            {"received": len(events), "accepted": accepted, "duplicates": duplicates},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+    def _events_after(
+        self, after: dict[str, int], limit: int, created_after=None, created_before=None
+    ) -> list[RideEvent]:
+        """
+        The first `limit` events after the cursor, each shard's settled events in
+        id order, merged by id. Skips the shards the notifier knows are caught up.
+        """
+        aliases = ride_event_notifier.shards_with_events_after(after)
+        shards = [
+            RideEvent.objects.using(alias)
+            .filter(id_ride_event__gt=after[alias])
+            .settled()
+            .created_between(created_after, created_before)
+            .order_by("id_ride_event")[:limit]
+            for alias in aliases
+        ]
+        if len(shards) == 1:
+            return list(shards[0])
+        return list(islice(merge(*shards, key=attrgetter("id_ride_event")), limit))
@@ -1,7 +1,18 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
-from .models import User
+from .models import SEARCH_MIN_LENGTH, SearchTooBroad, User, search_rank
+
+
+class SearchRankChangeList(ChangeList):
+    def get_queryset(self, request, exclude_parameters=None):
+        # search results by rank, unless a column was clicked (the ordering is
+        # set before the search runs, so it can't go in get_ordering())
+        queryset = super().get_queryset(request, exclude_parameters)
+        if ORDER_VAR not in self.params and "search_rank" in queryset.query.annotations:
+            return queryset.order_by("search_rank", "-pk")
+        return queryset
 
 
 @admin.register(User)
@@ -9,6 +20,10 @@ class UserAdmin(BaseUserAdmin):
     list_display = ("email", "first_name", "last_name", "role", "is_staff")
     list_filter = ("role", "is_staff", "is_superuser", "is_active")
     search_fields = ("email", "first_name", "last_name", "phone_number")
+    search_help_text = (
+        f"Part of the name, email or phone number (at least {SEARCH_MIN_LENGTH} "
+        "characters, typos allowed), best matches first"
+    )
     ordering = ("email",)
 
     fieldsets = (
@@ -49,3 +64,36 @@ class UserAdmin(BaseUserAdmin):
             },
         ),
     )
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Trigram search (`User.objects.search()`) instead of `search_fields`'
+        unindexed `LIKE '%term%'` on every field.
+        """
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+
+        ids = []
+        if len(term) < SEARCH_MIN_LENGTH:
+            self.message_user(
+                request,
+                f"Search for at least {SEARCH_MIN_LENGTH} characters.",
+                messages.WARNING,
+            )
+        else:
+            try:
+                ids = User.objects.search(term)
+            except SearchTooBroad:
+                self.message_user(
+                    request,
+                    "That matches too many users, try a longer or more specific term.",
+                    messages.WARNING,
+                )
+        return (
+            queryset.filter(pk__in=ids).annotate(search_rank=search_rank(ids, "pk")),
+            False,
+        )
+
+    def get_changelist(self, request, **kwargs):
+        return SearchRankChangeList
@@ -0,0 +1,32 @@
+# Generated by Django 6.1.2 on 2026-10-19 10:05
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.contrib.postgres.operations import AddIndexConcurrently, TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0002_user_email_lower_idx'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        AddIndexConcurrently(
+            model_name='user',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Concat('first_name', models.Value(' '), 'last_name', output_field=models.TextField()), name='gin_trgm_ops'), name='user_full_name_trgm_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='user',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass('email', name='gin_trgm_ops'), name='user_email_trgm_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='user',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass('phone_number', name='gin_trgm_ops'), name='user_phone_trgm_idx'),
+        ),
+    ]
@@ -1,5 +1,59 @@
+import hashlib
+
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.contrib.auth.models import UserManager as BaseUserManager
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.core.cache import cache
+from django.db import OperationalError, connections, models, transaction
+from django.db.models import Q, Value
+from django.db.models.functions import Concat, Greatest, Lower
+from psycopg import errors
+
+EMAIL_ID_CACHE_TIMEOUT = 60 * 5
+
+# `?q=` search: shortest term worth a trigram lookup, how many users it resolves
+# to, how long they're cached (pages of one search) and its time budget
+SEARCH_MIN_LENGTH = 3
+SEARCH_MAX_USERS = 100
+SEARCH_CACHE_TIMEOUT = 60
+SEARCH_TIMEOUT_MS = 500
+
+
+def email_id_cache_key(email: str) -> str:
+    return f"users:email-id:{email.lower()}"
+
+
+def search_cache_key(term: str, limit: int) -> str:
+    digest = hashlib.sha256(term.lower().encode()).hexdigest()
+    return f"users:search:{limit}:{digest}"
+
+
+def full_name() -> Concat:
+    """
+    `first_name last_name`, the expression `user_full_name_trgm_idx` is on.
+    """
+    return Concat(
+        "first_name", Value(" "), "last_name", output_field=models.TextField()
+    )
+
+
+def search_rank(ids: list[int], field: str) -> models.Func:
+    """
+    1-based position of `field` in `ids` (UserManager.search() order), NULL
+    when it isn't there.
+    """
+    return models.Func(
+        Value(ids, output_field=ArrayField(models.IntegerField())),
+        models.F(field),
+        function="array_position",
+        output_field=models.IntegerField(),
+    )
+
+
+class SearchTooBroad(Exception):
+    pass
 
 
 class UserRole(models.TextChoices):
@@ -8,6 +62,78 @@ class UserRole(models.TextChoices):
     RIDER = "rider", "Rider"
 
 
+class UserManager(BaseUserManager):
+    def id_for_email(self, email: str) -> int | None:
+        """
+        Resolve an email (case-insensitive) to an id_user.
+
+        Served by the `lower(email)` index, results (including misses) are cached
+        so repeated filters don't hit users_user at all.
+        """
+        key = email_id_cache_key(email)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached or None
+
+        id_user = (
+            self.alias(email_lower=Lower("email"))
+            .filter(email_lower=email.lower())
+            .values_list("id_user", flat=True)
+            .first()
+        )
+        # 0 marks a cached miss
+        cache.set(key, id_user or 0, EMAIL_ID_CACHE_TIMEOUT)
+        return id_user
+
+    def search(self, term: str, limit: int = SEARCH_MAX_USERS) -> list[int]:
+        """
+        ids of the users whose name, email or phone number best match `term`,
+        best first. Fuzzy (trigram word similarity, so partial words and typos
+        match) and served by the trigram indexes; results are cached briefly.
+
+        Raises SearchTooBroad when the lookup runs past SEARCH_TIMEOUT_MS, e.g.
+        a term matching a large share of all users.
+        """
+        key = search_cache_key(term, limit)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+        fields = [full_name(), "email", "phone_number"]
+        queryset = (
+            self.alias(full_name=full_name())
+            .filter(
+                Q(full_name__trigram_word_similar=term)
+                | Q(email__trigram_word_similar=term)
+                | Q(phone_number__trigram_word_similar=term)
+            )
+            .annotate(
+                search_rank=Greatest(
+                    *(TrigramWordSimilarity(term, field) for field in fields)
+                )
+            )
+            .order_by("-search_rank", "id_user")
+            .values_list("id_user", flat=True)[:limit]
+        )
+        using = queryset.db
+        try:
+            with transaction.atomic(using=using):
+                with connections[using].cursor() as cursor:
+                    cursor.execute(f"SET LOCAL statement_timeout = {SEARCH_TIMEOUT_MS}")
+                ids = list(queryset)
+                # rolling back (to the savepoint) is what resets SET LOCAL
+                transaction.set_rollback(True, using=using)
+        except OperationalError as e:
+            if not isinstance(e.__cause__, errors.QueryCanceled):
+                raise
+            raise SearchTooBroad(
+                f"Search for {term!r} took over {SEARCH_TIMEOUT_MS}ms"
+            ) from e
+
+        cache.set(key, ids, SEARCH_CACHE_TIMEOUT)
+        return ids
+
+
 class User(AbstractUser):
     id_user = models.AutoField(primary_key=True)
 
@@ -23,5 +149,36 @@ class User(AbstractUser):
     last_name = models.CharField(max_length=150)
     email = models.EmailField(unique=True)
 
+    objects = UserManager()
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            models.Index(Lower("email"), name="user_email_lower_idx"),
+            # `?q=` search, see UserManager.search()
+            GinIndex(
+                OpClass(full_name(), name="gin_trgm_ops"),
+                name="user_full_name_trgm_idx",
+            ),
+            GinIndex(OpClass("email", name="gin_trgm_ops"), name="user_email_trgm_idx"),
+            GinIndex(
+                OpClass("phone_number", name="gin_trgm_ops"),
+                name="user_phone_trgm_idx",
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_email = instance.__dict__.get("email")
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        # drop cached email -> id mappings for both the old and new email
+        emails = {self.email, getattr(self, "_loaded_email", None)}
+        cache.delete_many([email_id_cache_key(email) for email in emails if email])
+        self._loaded_email = self.email
+
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.email})"
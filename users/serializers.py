@@ -7,3 +7,13 @@ class BaseUserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ["id_user", "first_name", "last_name", "email", "phone_number"]
+
+
+class UserNameSerializer(serializers.ModelSerializer):
+    """
+    A user without their contact details.
+    """
+
+    class Meta:
+        model = User
+        fields = ["id_user", "first_name", "last_name"]
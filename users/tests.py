@@ -1,8 +1,16 @@
+from unittest import mock
+
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 
 from api.tests.base import BaseAPITestCase
+from users.models import SearchTooBroad, User
 
 RIDES_LIST_PATH = "/api/rides/"
+USERS_ADMIN_PATH = "/admin/users/user/"
 
 
 class RideListAuthenticationTests(BaseAPITestCase):
@@ -24,3 +32,79 @@ class RideListAuthenticationTests(BaseAPITestCase):
         self._authenticate_as(self.admin_user)
         response = self.client.get(RIDES_LIST_PATH)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class UserSearchTests(BaseAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.johnson = User.objects.create_user(
+            username="johnson",
+            email="m.johnson@example.org",
+            first_name="Maria",
+            last_name="Johnson",
+            phone_number="+15550104242",
+        )
+        cls.staff_user = User.objects.create_superuser(
+            username="staff", email="staff@example.com", password="testpass123"
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_matches_partial_and_misspelled_names(self):
+        self.assertEqual(User.objects.search("Johnso")[0], self.johnson.pk)
+        self.assertEqual(User.objects.search("maria jonson")[0], self.johnson.pk)
+        self.assertEqual(User.objects.search("jane do")[0], self.rider_user_2.pk)
+
+    def test_matches_email_and_phone_fragments(self):
+        self.assertEqual(User.objects.search("m.johnson@exa"), [self.johnson.pk])
+        self.assertEqual(User.objects.search("0104242"), [self.johnson.pk])
+        self.assertEqual(User.objects.search("zzqx"), [])
+
+    def test_best_match_first(self):
+        # "John Rider" is the exact name, Maria Johnson a partial match
+        ids = User.objects.search("John")
+        self.assertEqual(ids[:2], [self.rider_user.pk, self.johnson.pk])
+
+    def test_results_are_cached(self):
+        User.objects.search("Johnson")
+        with self.assertNumQueries(0):
+            self.assertEqual(User.objects.search("johnson"), [self.johnson.pk])
+
+    def test_search_uses_trigram_indexes(self):
+        with CaptureQueriesContext(connection) as ctx:
+            User.objects.search("Johnson")
+        (sql,) = [q["sql"] for q in ctx.captured_queries if "users_user" in q["sql"]]
+        self.assertIn("%>", sql)
+        self.assertNotIn("LIKE", sql)
+
+    def test_admin_search_ranks_results(self):
+        self.client.force_login(self.staff_user)
+        response = self.client.get(USERS_ADMIN_PATH, {"q": "John"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = list(response.context["cl"].result_list)
+        self.assertEqual(results[:2], [self.rider_user, self.johnson])
+
+        # a clicked column still wins
+        response = self.client.get(USERS_ADMIN_PATH, {"q": "John", "o": "1"})
+        self.assertEqual(
+            list(response.context["cl"].result_list)[:2],
+            [self.johnson, self.rider_user],
+        )
+
+    def test_admin_search_too_short_or_broad(self):
+        self.client.force_login(self.staff_user)
+        response = self.client.get(USERS_ADMIN_PATH, {"q": "jo"})
+        self.assertEqual(list(response.context["cl"].result_list), [])
+        self.assertIn("at least 3", str(list(get_messages(response.wsgi_request))[0]))
+
+        with mock.patch.object(
+            User.objects, "search", side_effect=SearchTooBroad("too broad")
+        ):
+            response = self.client.get(USERS_ADMIN_PATH, {"q": "example"})
+        self.assertEqual(list(response.context["cl"].result_list), [])
+        self.assertIn(
+            "too many users", str(list(get_messages(response.wsgi_request))[0])
+        )